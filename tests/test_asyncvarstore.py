@@ -0,0 +1,128 @@
+#
+# AsyncVarstore tests
+#
+# python -m unittest discover tests (with the modules installed as aoutils)
+#
+import os
+import shutil
+import asyncio
+import tempfile
+import unittest
+from aoutils.varstore import *
+from aoutils.asyncvarstore import AsyncVarstore
+
+SCHEMA = {
+    'net': { 'desc': 'Network', 'value': {
+        'mtu': { 'desc': 'MTU', 'value': 1500, 'range': [ 576, 9000 ] },
+        'name': { 'desc': 'Name', 'value': 'eth0' },
+    } },
+}
+
+# Storage counting the files it writes
+class _CountingStorage(VarstoreStorage):
+    def __init__(self):
+        self.writes = 0
+
+    def Write(self, filename, encoded):
+        size = super(_CountingStorage, self).Write(filename, encoded)
+        self.writes += 1
+
+        return size
+
+class AsyncVarstoreTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.filename = os.path.join(directory, 'store.json')
+
+    def open(self, schema=SCHEMA, **kwargs):
+        return AsyncVarstore(Varstore(schema, filename=self.filename, **kwargs))
+
+    async def test_get_set(self):
+        store = self.open()
+
+        await store.set('net.mtu', 2000)
+        await store.set_many({ 'net.name': 'eth1' })
+        await store.apply({ 'net': { 'mtu': 3000 } })
+
+        self.assertEqual(await store.get('net'), { 'mtu': 3000, 'name': 'eth1' })
+        self.assertEqual((await store.export())['net']['mtu'], 3000)
+        self.assertEqual(store.varstore.Get('net.mtu'), 3000)
+
+        await store.close()
+
+    async def test_errors_raised(self):
+        store = self.open()
+
+        with self.assertRaises(VarstoreExceptionRange):
+            await store.set('net.mtu', 100)
+
+        with self.assertRaises(VarstoreExceptionUndefinedVar):
+            await store.get('net.nothing')
+
+        await store.close()
+
+    async def test_save_and_load(self):
+        store = self.open()
+        await store.set('net.mtu', 2000)
+        await store.save()
+
+        loaded = self.open()
+        await loaded.load(propagate=False)
+
+        self.assertEqual(await loaded.get('net.mtu'), 2000)
+
+    async def test_coroutine_functions(self):
+        propagated = []
+
+        async def value(op, var, value=None):
+            await asyncio.sleep(0)
+            return 42
+
+        async def propagate(values):
+            propagated.append(values['net']['mtu'])
+
+        schema = dict(SCHEMA)
+        schema['answer'] = { 'desc': 'Answer', 'value': value }
+        store = AsyncVarstore(Varstore(schema, propagate=propagate))
+
+        self.assertEqual(await store.get('answer'), 42)
+
+        await store.set('net.mtu', 2000, propagate=True)
+        await store.save()
+
+        self.assertEqual(propagated[-1], 2000)
+
+        await store.close()
+
+    async def test_saves_coalesced(self):
+        storage = _CountingStorage()
+        store = self.open(storage=storage)
+
+        await asyncio.gather(*[ store.save() for i in range(20) ])
+
+        self.assertLessEqual(storage.writes, 2)
+
+        await store.close()
+
+# The awaiter hook without the asyncio front-end
+class AwaiterTests(unittest.TestCase):
+    def test_set_awaiter(self):
+        async def value(op, var, value=None):
+            return 42
+
+        schema = dict(SCHEMA)
+        schema['answer'] = { 'desc': 'Answer', 'value': value }
+        varstore = Varstore(schema)
+
+        varstore.SetAwaiter(asyncio.run)
+        self.assertEqual(varstore.Get('answer'), 42)
+
+        # Without an awaiter the coroutine is returned as is
+        varstore.SetAwaiter(None)
+        result = varstore.Get('answer')
+        self.assertTrue(asyncio.iscoroutine(result))
+        result.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,744 @@
+#
+# Synchronized thread tests
+#
+# python -m unittest discover tests (with the modules installed as aoutils)
+#
+import asyncio
+import itertools
+import os
+import queue
+import threading
+import time
+import unittest
+from concurrent.futures import CancelledError
+from aoutils.synchronized_thread import *
+from aoutils import synchronized_thread
+
+# Unique thread names, so a test never meets a thread left by another
+_names = itertools.count()
+
+def _name(prefix):
+    return "%s-%d" % (prefix, next(_names))
+
+# Thread recording the messages it gets in 'received' and replying [ 'echo', message ].
+# [ 'fail', text ] raises ValueError(text).
+class _EchoThread(SynchronizedThreadWithQueue):
+    def __init__(self, name, **kwargs):
+        super(_EchoThread, self).__init__(name, **kwargs)
+        self.received = queue.Queue()
+
+    def message(self, message, from_thread):
+        self.received.put((message, from_thread))
+
+        if message and message[0] == 'fail':
+            raise ValueError(message[1])
+
+        return [ 'echo', message ]
+
+class _ThreadTests(unittest.TestCase):
+    # Create, start and release a thread; it is stopped when the test ends.  'queued' messages
+    # are put in its queue before it is released.
+    def start(self, thread, queued=()):
+        thread.start()
+        thread.wait_ready()
+
+        for message in queued:
+            thread.put(message)
+
+        thread.signal_sync()
+        self.addCleanup(self.stop, thread)
+        return thread
+
+    def stop(self, thread):
+        if thread.is_alive():
+            thread.stop()
+
+    # Next message received by 'thread'
+    def received(self, thread, timeout=5):
+        return thread.received.get(timeout=timeout)
+
+class RegistryTests(_ThreadTests):
+    def test_send_by_name(self):
+        thread = self.start(_EchoThread(_name('echo')))
+
+        self.assertEqual(send_message([ 'ping' ], to=thread.name, reply=True, timeout=5), [ 'echo', [ 'ping' ] ])
+
+    def test_send_by_handle(self):
+        thread = self.start(_EchoThread(_name('echo')))
+        handle = get_thread_handle(thread.name)
+
+        self.assertEqual(handle.send([ 'ping' ], reply=True, timeout=5), [ 'echo', [ 'ping' ] ])
+        self.assertEqual(send_message([ 'pong' ], to=handle, reply=True, timeout=5), [ 'echo', [ 'pong' ] ])
+        self.assertEqual(str(handle), thread.name)
+
+    def test_handle_follows_restart(self):
+        name = _name('echo')
+        handle = get_thread_handle(name)
+
+        first = self.start(_EchoThread(name))
+        self.assertIs(handle.resolve(), first)
+        first.stop()
+
+        second = self.start(_EchoThread(name))
+        self.assertIs(handle.resolve(), second)
+        self.assertEqual(handle.send([ 'ping' ], reply=True, timeout=5), [ 'echo', [ 'ping' ] ])
+
+    def test_reply_to_thread(self):
+        thread = self.start(_EchoThread(_name('echo')))
+        listener = self.start(_EchoThread(_name('listener')))
+
+        send_message([ 'ping' ], to=thread.name, reply=listener.name, reply_token='answer')
+        self.assertEqual(self.received(listener), ([ 'answer', [ 'echo', [ 'ping' ] ] ], thread.name))
+
+        send_message([ 'pong' ], to=thread.name, reply=get_thread_handle(listener.name))
+        self.assertEqual(self.received(listener), ([ 'reply', [ 'echo', [ 'pong' ] ] ], thread.name))
+
+    def test_broadcast(self):
+        threads = [ self.start(_EchoThread(_name('echo'))) for i in range(3) ]
+
+        send_message([ 'all' ])
+
+        for thread in threads:
+            self.assertEqual(self.received(thread)[0], [ 'all' ])
+
+    def test_duplicate_name_keeps_entry(self):
+        name = _name('echo')
+        first = self.start(_EchoThread(name))
+
+        second = _EchoThread(name)
+        self.assertFalse(second._registered)
+        self.start(second)
+        second.stop()
+
+        self.assertIs(synchronized_thread._thread_objects.get(name), first)
+        self.assertEqual(send_message([ 'ping' ], to=name, reply=True, timeout=5), [ 'echo', [ 'ping' ] ])
+
+    def test_unregistered_on_exit(self):
+        thread = self.start(_EchoThread(_name('echo')))
+        thread.stop()
+
+        self.assertNotIn(thread.name, synchronized_thread._thread_objects)
+        self.assertIsNone(get_thread_handle(thread.name).resolve())
+
+    def test_invalid_message(self):
+        thread = self.start(_EchoThread(_name('echo')))
+
+        self.assertIsInstance(send_message('ping', to=thread.name), str)
+
+# Echo thread recording the size of each batch it gets
+class _BatchThread(_EchoThread):
+    def __init__(self, name, **kwargs):
+        super(_BatchThread, self).__init__(name, **kwargs)
+        self.batches = []
+
+    def message_batch(self, messages):
+        self.batches.append(len(messages))
+        return super(_BatchThread, self).message_batch(messages)
+
+# Batch thread returning a result for the first message only
+class _ShortBatchThread(_BatchThread):
+    def message_batch(self, messages):
+        return super(_ShortBatchThread, self).message_batch(messages)[:1]
+
+class BatchTests(_ThreadTests):
+    def test_queued_messages_batched(self):
+        thread = self.start(_BatchThread(_name('batch'), batch_size=8), queued=[ [ i ] for i in range(20) ])
+
+        self.assertEqual([ self.received(thread)[0] for i in range(20) ], [ [ i ] for i in range(20) ])
+        self.assertEqual(thread.batches, [ 8, 8, 4 ])
+
+    def test_each_message_replied(self):
+        thread = _BatchThread(_name('batch'), batch_size=8)
+        listener = self.start(_EchoThread(_name('listener')))
+
+        thread.start()
+        thread.wait_ready()
+
+        for i in range(5):
+            send_message([ i ], to=thread.name, reply=listener.name)
+
+        thread.signal_sync()
+        self.addCleanup(self.stop, thread)
+
+        self.assertEqual([ self.received(listener)[0] for i in range(5) ], [ [ 'reply', [ 'echo', [ i ] ] ] for i in range(5) ])
+        self.assertEqual(thread.batches, [ 5 ])
+
+    def test_batch_latency(self):
+        thread = self.start(_BatchThread(_name('batch'), batch_size=3, batch_latency=5))
+
+        for i in range(3):
+            thread.put([ i ])
+            time.sleep(0.05)
+
+        self.assertEqual([ self.received(thread)[0] for i in range(3) ], [ [ 0 ], [ 1 ], [ 2 ] ])
+        self.assertEqual(thread.batches, [ 3 ])
+
+    def test_stops_at_exit_request(self):
+        thread = _BatchThread(_name('batch'), batch_size=8)
+        thread.start()
+        thread.wait_ready()
+
+        for i in range(3):
+            thread.put([ i ])
+
+        thread.stop(join=False)
+        thread.put([ 'late' ])
+        thread.signal_sync()
+        thread.join()
+
+        self.assertEqual(thread.batches, [ 3 ])
+        self.assertEqual(thread.received.qsize(), 3)
+
+    def test_missing_results_fail(self):
+        thread = _ShortBatchThread(_name('batch'), batch_size=8)
+        thread.start()
+        thread.wait_ready()
+
+        futures = [ request([ i ], thread.name) for i in range(3) ]
+
+        thread.signal_sync()
+        self.addCleanup(self.stop, thread)
+
+        self.assertEqual(futures[0].result(timeout=5), [ 'echo', [ 0 ] ])
+
+        for future in futures[1:]:
+            with self.assertRaises(ThreadMessageException):
+                future.result(timeout=5)
+
+class TimerTests(_ThreadTests):
+    # Messages received within 'seconds'
+    def drain(self, thread, seconds):
+        time.sleep(seconds)
+        messages = []
+
+        while not thread.received.empty():
+            messages.append(thread.received.get()[0])
+
+        return messages
+
+    def test_timer(self):
+        thread = self.start(_EchoThread(_name('timers')))
+
+        thread.set_timer('later', 0.05, value=7)
+        thread.set_timer('sooner', 0.01)
+
+        self.assertEqual(self.received(thread), ([ 'sooner', None ], None))
+        self.assertEqual(self.received(thread), ([ 'later', 7 ], None))
+        self.assertEqual(self.drain(thread, 0.1), [])
+
+    def test_periodic_and_kill(self):
+        thread = self.start(_EchoThread(_name('timers')))
+
+        thread.set_timer('tick', 0.02, value='t', periodic=True)
+
+        for i in range(3):
+            self.assertEqual(self.received(thread)[0], [ 'tick', 't' ])
+
+        thread.kill_timer('tick')
+        self.drain(thread, 0.05)
+
+        self.assertEqual(self.drain(thread, 0.1), [])
+
+    def test_killed_before_firing(self):
+        thread = self.start(_EchoThread(_name('timers')))
+
+        thread.set_timer('never', 0.05)
+        thread.kill_timer('never')
+        thread.kill_timer('unknown')
+
+        self.assertEqual(self.drain(thread, 0.15), [])
+
+    def test_replaced(self):
+        thread = self.start(_EchoThread(_name('timers')))
+
+        thread.set_timer('t', 0.05, value=1)
+        thread.set_timer('t', 0.05, value=2)
+
+        self.assertEqual(self.drain(thread, 0.2), [ [ 't', 2 ] ])
+
+    def test_one_thread_for_all_timers(self):
+        thread = self.start(_EchoThread(_name('timers')))
+        thread.set_timer('first', 60)
+        count = threading.active_count()
+
+        for i in range(100):
+            thread.set_timer('t%d' % i, 60)
+
+        self.assertEqual(threading.active_count(), count)
+
+        for i in range(100):
+            thread.kill_timer('t%d' % i)
+
+        thread.kill_timer('first')
+
+    def test_delivered_by_put(self):
+        other = self.start(_EchoThread(_name('timers')))
+        thread = self.start(_PutThread(_name('timers'), other))
+
+        thread.set_timer('t', 0.01, value=1)
+
+        self.assertEqual(self.received(thread), ([ 't', 1 ], None))
+        self.assertEqual(thread.put_calls, [ ([ 't', 1 ], False) ])
+
+        # put() ran without the scheduler's lock: another thread could arm a timer meanwhile
+        self.assertEqual(self.received(other), ([ 'from put', None ], None))
+
+    def test_full_queue_does_not_block(self):
+        full = _EchoThread(_name('timers'), max_queue=1)
+        full.start()
+        full.wait_ready()
+        full.put([ 'queued' ])
+        self.addCleanup(self.stop, full)
+        self.addCleanup(full.signal_sync)
+
+        thread = self.start(_EchoThread(_name('timers')))
+
+        full.set_timer('dropped', 0.01)
+        thread.set_timer('delivered', 0.02)
+
+        self.assertEqual(self.received(thread), ([ 'delivered', None ], None))
+        self.assertEqual(full.queue_stats()['dropped'], 1)
+
+# Echo thread recording its put() calls.  A put() arms a timer of 'other' from another thread
+# and waits for it to have done so.
+class _PutThread(_EchoThread):
+    def __init__(self, name, other, **kwargs):
+        super(_PutThread, self).__init__(name, **kwargs)
+        self.other = other
+        self.put_calls = []
+
+    def put(self, message, block=True, **kwargs):
+        self.put_calls.append((message, block))
+
+        arm = threading.Thread(target=self.other.set_timer, args=('from put', 0.01))
+        arm.start()
+        arm.join(timeout=1)
+
+        return super(_PutThread, self).put(message, block=block, **kwargs)
+
+class RequestTests(_ThreadTests):
+    def test_reply(self):
+        thread = self.start(_EchoThread(_name('actor')))
+
+        futures = [ request([ i ], thread.name) for i in range(10) ]
+
+        self.assertEqual([ future.result(timeout=5) for future in futures ], [ [ 'echo', [ i ] ] for i in range(10) ])
+        self.assertTrue(all(future.done() and not future.cancelled() for future in futures))
+        self.assertIsNone(futures[0].exception())
+
+    def test_exception(self):
+        thread = self.start(_EchoThread(_name('actor')))
+
+        future = request([ 'fail', 'bad request' ], get_thread_handle(thread.name))
+
+        with self.assertRaises(ValueError):
+            future.result(timeout=5)
+
+        self.assertEqual(str(future.exception()), 'bad request')
+
+        # The thread keeps running
+        self.assertEqual(request([ 'ping' ], thread.name).result(timeout=5), [ 'echo', [ 'ping' ] ])
+        self.assertEqual(send_message([ 'fail', 'again' ], to=thread.name, reply=True, timeout=5), { 'error': 'again' })
+
+    # Wait for the locks of 'future' to go back to the pool
+    def released(self, future):
+        deadline = time.monotonic() + 5
+        while future._signal is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        return future._signal is None
+
+    def test_timeout(self):
+        thread = _EchoThread(_name('actor'))
+        thread.start()
+        thread.wait_ready()
+
+        future = request([ 'late' ], thread.name)
+
+        with self.assertRaises(TimeoutError):
+            future.result(timeout=0.05)
+
+        with self.assertRaises(TimeoutError):
+            future.exception(timeout=0.05)
+
+        self.assertFalse(future.done())
+
+        thread.signal_sync()
+        self.addCleanup(self.stop, thread)
+
+        # Returned by the handler once it is done, although the sender hasn't asked again
+        self.assertTrue(self.released(future))
+        self.assertEqual(future.result(), [ 'echo', [ 'late' ] ])
+
+    def test_slots_reused(self):
+        thread = self.start(_EchoThread(_name('actor')))
+
+        first = request([ 1 ], thread.name)
+        slot = (first._signal, first._mutex)
+        self.assertEqual(first.result(timeout=5), [ 'echo', [ 1 ] ])
+        self.assertTrue(self.released(first))
+
+        # The pool is a stack: the next future takes the slot just returned
+        second = request([ 2 ], thread.name)
+        self.assertIs(second._signal, slot[0])
+        self.assertIs(second._mutex, slot[1])
+        self.assertEqual(second.result(timeout=5), [ 'echo', [ 2 ] ])
+
+        # Results are kept after the slot has gone
+        self.assertTrue(self.released(second))
+        self.assertEqual((first.result(), first.exception()), ([ 'echo', [ 1 ] ], None))
+
+    def test_unknown_thread(self):
+        with self.assertRaises(ThreadMessageException):
+            request([ 'ping' ], _name('nobody')).result(timeout=5)
+
+        self.assertIn('error', send_message([ 'ping' ], to=_name('nobody'), reply=True, timeout=5))
+
+    def test_cancel(self):
+        thread = _EchoThread(_name('actor'))
+        thread.start()
+        thread.wait_ready()
+
+        cancelled = request([ 'cancelled' ], thread.name)
+        kept = request([ 'kept' ], thread.name)
+
+        self.assertTrue(cancelled.cancel())
+        self.assertTrue(cancelled.cancelled())
+
+        thread.signal_sync()
+        self.addCleanup(self.stop, thread)
+
+        self.assertEqual(kept.result(timeout=5), [ 'echo', [ 'kept' ] ])
+        self.assertFalse(kept.cancel())
+        self.assertEqual(self.received(thread)[0], [ 'kept' ])
+        self.assertTrue(thread.received.empty())
+
+        with self.assertRaises(CancelledError):
+            cancelled.result()
+
+    def test_done_callback(self):
+        thread = self.start(_EchoThread(_name('actor')))
+        done = queue.Queue()
+
+        future = request([ 'ping' ], thread.name)
+        future.add_done_callback(done.put)
+
+        self.assertIs(done.get(timeout=5), future)
+
+        future.add_done_callback(done.put)
+        self.assertIs(done.get_nowait(), future)
+
+    def test_queued_requests_fail_on_exit(self):
+        thread = _EchoThread(_name('actor'))
+        thread.start()
+        thread.wait_ready()
+
+        thread.stop(join=False)
+        future = request([ 'late' ], thread.name)
+        thread.signal_sync()
+        thread.join()
+
+        with self.assertRaises(ThreadMessageException):
+            future.result(timeout=5)
+
+    def test_request_async(self):
+        thread = self.start(_EchoThread(_name('actor')))
+
+        async def requests():
+            results = await asyncio.gather(*[ request_async([ i ], thread.name, timeout=5) for i in range(5) ])
+
+            with self.assertRaises(ValueError):
+                await request_async([ 'fail', 'bad' ], thread.name, timeout=5)
+
+            return results
+
+        self.assertEqual(asyncio.run(requests()), [ [ 'echo', [ i ] ] for i in range(5) ])
+
+class MailboxTests(_ThreadTests):
+    # A thread that is ready but not yet released, so messages stay queued.  It is released (if
+    # the test didn't) and stopped when the test ends.
+    def held(self, **kwargs):
+        thread = _EchoThread(_name('mailbox'), **kwargs)
+        thread.start()
+        thread.wait_ready()
+        thread.held = True
+        self.addCleanup(self.stop, thread)
+        self.addCleanup(self.release, thread, 0)
+        return thread
+
+    # Release a held thread and return the first 'count' messages it gets
+    def release(self, thread, count):
+        if thread.held:
+            thread.held = False
+            thread.signal_sync()
+
+        return [ self.received(thread)[0] for i in range(count) ]
+
+    def test_lanes(self):
+        thread = self.held()
+
+        thread.put([ 'low' ], priority=PRIORITY_LOW)
+        thread.put([ 'normal 1' ])
+        thread.put([ 'high' ], priority=PRIORITY_HIGH)
+        send_message([ 'normal 2' ], to=thread.name)
+
+        self.assertEqual(thread.queue_stats()['lanes'], [ 1, 2, 1 ])
+        self.assertEqual(self.release(thread, 4), [ [ 'high' ], [ 'normal 1' ], [ 'normal 2' ], [ 'low' ] ])
+
+    def test_block_with_timeout(self):
+        thread = self.held(max_queue=2, overflow=OVERFLOW_BLOCK, overflow_timeout=0.05)
+
+        self.assertTrue(thread.put([ 1 ]))
+        self.assertTrue(thread.put([ 2 ]))
+        self.assertFalse(thread.put([ 3 ]))
+
+        stats = thread.queue_stats()
+        self.assertEqual((stats['depth'], stats['high_water'], stats['blocked'], stats['dropped']), (2, 2, 1, 1))
+        self.assertEqual(self.release(thread, 2), [ [ 1 ], [ 2 ] ])
+
+    def test_block_until_taken(self):
+        thread = self.held(max_queue=2)
+
+        thread.put([ 1 ])
+        thread.put([ 2 ])
+
+        sender = threading.Thread(target=thread.put, args=([ 3 ],))
+        sender.start()
+
+        while not thread.queue_stats()['blocked']:
+            time.sleep(0.01)
+
+        self.assertEqual(self.release(thread, 3), [ [ 1 ], [ 2 ], [ 3 ] ])
+        sender.join()
+        self.assertEqual(thread.queue_stats()['dropped'], 0)
+
+    def test_drop_newest(self):
+        thread = self.held(max_queue=2, overflow=OVERFLOW_DROP_NEWEST)
+
+        for i in range(4):
+            thread.put([ i ])
+
+        self.assertEqual(thread.queue_stats()['dropped'], 2)
+        self.assertEqual(self.release(thread, 2), [ [ 0 ], [ 1 ] ])
+
+    def test_drop_oldest(self):
+        thread = self.held(max_queue=2, overflow=OVERFLOW_DROP_OLDEST)
+
+        thread.put([ 'high' ], priority=PRIORITY_HIGH)
+        for i in range(3):
+            thread.put([ i ])
+
+        # Only messages of the same or a lower priority make room
+        self.assertEqual(thread.queue_stats()['dropped'], 2)
+        self.assertEqual(self.release(thread, 2), [ [ 'high' ], [ 2 ] ])
+
+    def test_coalesce(self):
+        thread = self.held(max_queue=10, overflow=OVERFLOW_COALESCE)
+
+        for i in range(5):
+            thread.put([ 'position', i ], key='position')
+        thread.put([ 'other' ])
+        send_message([ 'position', 5 ], to=thread.name, key='position')
+
+        stats = thread.queue_stats()
+        self.assertEqual((stats['depth'], stats['coalesced']), (2, 5))
+        self.assertEqual(self.release(thread, 2), [ [ 'position', 5 ], [ 'other' ] ])
+
+    def test_dropped_request_fails(self):
+        thread = self.held(max_queue=1, overflow=OVERFLOW_DROP_OLDEST)
+
+        first = request([ 1 ], thread.name)
+        second = request([ 2 ], thread.name)
+
+        with self.assertRaises(ThreadMessageException):
+            first.result(timeout=5)
+
+        self.release(thread, 1)
+        self.assertEqual(second.result(timeout=5), [ 'echo', [ 2 ] ])
+
+    def test_stats_reset(self):
+        thread = self.held(max_queue=1, overflow=OVERFLOW_DROP_NEWEST)
+
+        thread.put([ 1 ])
+        thread.put([ 2 ])
+
+        self.assertEqual(thread.queue_stats(reset=True)['dropped'], 1)
+        self.assertEqual(thread.queue_stats()['dropped'], 0)
+        self.assertEqual(thread.queue_stats()['high_water'], 1)
+
+    def test_stop_handles_queued(self):
+        thread = self.held(max_queue=10)
+
+        for i in range(5):
+            thread.put([ i ], priority=PRIORITY_LOW if i % 2 else PRIORITY_NORMAL)
+
+        thread.stop(join=False)
+        self.release(thread, 0)
+        thread.join()
+
+        self.assertEqual(sorted(thread.received.get()[0][0] for i in range(5)), list(range(5)))
+
+    def test_later_messages_do_not_delay_stop(self):
+        thread = self.held()
+
+        thread.put([ 'low' ], priority=PRIORITY_LOW)
+        thread.put([ 'normal' ])
+
+        thread.stop(join=False)
+        for i in range(100):
+            thread.put([ 'late', i ], priority=PRIORITY_HIGH if i % 2 else PRIORITY_NORMAL)
+
+        self.release(thread, 0)
+        thread.join(timeout=5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([ self.received(thread)[0] for i in range(2) ], [ [ 'normal' ], [ 'low' ] ])
+        self.assertTrue(thread.received.empty())
+
+# Pool recording (message, worker thread ident) for each message it handles.  [ 'wait', n ]
+# blocks until n of them are being handled at once.
+class _PoolThread(SynchronizedThreadPool):
+    def __init__(self, name, **kwargs):
+        super(_PoolThread, self).__init__(name, **kwargs)
+        self.received = queue.Queue()
+        self.calls = []
+        self.barrier = None
+
+    def initialize(self):
+        self.calls.append(('initialize', threading.get_ident()))
+
+    def shutdown(self):
+        self.calls.append(('shutdown', threading.get_ident()))
+
+    def message(self, message, from_thread):
+        if message[0] == 'wait':
+            self.barrier.wait(timeout=5)
+
+        self.received.put((message, threading.get_ident()))
+        return [ 'echo', message ]
+
+class PoolTests(_ThreadTests):
+    def test_ordered_messages_handled_in_turn(self):
+        messages = [ [ key, i ] for i in range(50) for key in 'abcdef' ]
+        pool = _PoolThread(_name('pool'), workers=4)
+        pool.start()
+        pool.wait_ready()
+
+        for message in messages:
+            send_message(message, to=pool.name, order=message[0])
+
+        pool.signal_sync()
+        self.addCleanup(self.stop, pool)
+
+        seen = {}
+        workers = {}
+        for i in range(len(messages)):
+            ((key, sequence), worker) = self.received(pool)
+            seen.setdefault(key, []).append(sequence)
+            workers.setdefault(key, set()).add(worker)
+
+        for key in 'abcdef':
+            self.assertEqual(seen[key], list(range(50)))
+            self.assertEqual(len(workers[key]), 1)
+
+    def test_unordered_messages_shared(self):
+        pool = self.start(_PoolThread(_name('pool'), workers=3))
+        pool.barrier = threading.Barrier(3)
+
+        futures = [ request([ 'wait', i ], pool.name) for i in range(3) ]
+
+        self.assertEqual([ future.result(timeout=5) for future in futures ], [ [ 'echo', [ 'wait', i ] ] for i in range(3) ])
+        self.assertEqual(len(set(self.received(pool)[1] for i in range(3))), 3)
+
+    def test_replies_and_handles(self):
+        pool = self.start(_PoolThread(_name('pool'), workers=2))
+        listener = self.start(_EchoThread(_name('listener')))
+
+        self.assertEqual(get_thread_handle(pool.name).send([ 'ping' ], reply=True, timeout=5, order=1), [ 'echo', [ 'ping' ] ])
+
+        send_message([ 'pong' ], to=pool.name, reply=listener.name)
+        self.assertEqual(self.received(listener), ([ 'reply', [ 'echo', [ 'pong' ] ] ], pool.name))
+
+    def test_lifecycle_once(self):
+        pool = self.start(_PoolThread(_name('pool'), workers=4))
+        self.assertEqual(send_message([ 'ping' ], to=pool.name, reply=True, timeout=5), [ 'echo', [ 'ping' ] ])
+
+        pool.stop()
+
+        self.assertEqual([ call for (call, worker) in pool.calls ], [ 'initialize', 'shutdown' ])
+        self.assertEqual(pool.calls[0][1], pool.ident)
+        self.assertEqual(pool.calls[1][1], pool.ident)
+        self.assertFalse([ thread for thread in threading.enumerate() if thread.name == pool.name ])
+
+# Handler run in the child processes (at module level, so they can import it).  Replies
+# [ message, process id ]; [ 'fail', text ] raises ValueError(text), [ 'function' ] replies
+# something that can't be pickled and [ 'exit' ] ends the process.
+class _PidHandler(ProcessHandler):
+    def message(self, message, from_thread):
+        if message[0] == 'fail':
+            raise ValueError(message[1])
+
+        if message[0] == 'function':
+            return lambda: None
+
+        if message[0] == 'exit':
+            os._exit(1)
+
+        return [ message, os.getpid() ]
+
+class ProcessTests(_ThreadTests):
+    def test_round_trip(self):
+        actor = self.start(SynchronizedProcessWithQueue(_name('process'), _PidHandler()))
+
+        (message, pid) = send_message([ 'ping', 1 ], to=actor.name, reply=True, timeout=30)
+        self.assertEqual(message, [ 'ping', 1 ])
+        self.assertNotEqual(pid, os.getpid())
+
+        self.assertEqual(request([ 'ping', 2 ], actor.name).result(timeout=30), [ [ 'ping', 2 ], pid ])
+
+    def test_errors_propagated(self):
+        actor = self.start(SynchronizedProcessWithQueue(_name('process'), _PidHandler()))
+
+        with self.assertRaisesRegex(ValueError, 'broken'):
+            request([ 'fail', 'broken' ], actor.name).result(timeout=30)
+
+        with self.assertRaises(ThreadMessageException):
+            request([ 'function' ], actor.name).result(timeout=30)
+
+        with self.assertRaises(ThreadMessageException):
+            request([ 'function', lambda: None ], actor.name).result(timeout=30)
+
+        # Still serving
+        self.assertEqual(request([ 'ping' ], actor.name).result(timeout=30)[0], [ 'ping' ])
+
+    def test_ordered_messages_one_process(self):
+        actor = self.start(SynchronizedProcessWithQueue(_name('process'), _PidHandler(), processes=2))
+
+        futures = [ request([ i ], actor.name, order='same') for i in range(10) ]
+        results = [ future.result(timeout=30) for future in futures ]
+
+        self.assertEqual([ message for (message, pid) in results ], [ [ i ] for i in range(10) ])
+        self.assertEqual(len(set(pid for (message, pid) in results)), 1)
+
+    def test_process_exit_fails_outstanding(self):
+        actor = self.start(SynchronizedProcessWithQueue(_name('process'), _PidHandler(), processes=2))
+
+        futures = [ request([ 'exit' ], actor.name, order='doomed') ] + [ request([ i ], actor.name, order='doomed') for i in range(20) ]
+
+        for future in futures:
+            with self.assertRaises(ThreadMessageException):
+                future.result(timeout=30)
+
+        # The other process takes everything else
+        self.assertEqual([ request([ i ], actor.name).result(timeout=30)[0] for i in range(5) ], [ [ i ] for i in range(5) ])
+
+    def test_outstanding_answered_at_stop(self):
+        actor = self.start(SynchronizedProcessWithQueue(_name('process'), _PidHandler()))
+
+        futures = [ request([ i ], actor.name) for i in range(5) ]
+        actor.stop()
+
+        self.assertEqual([ future.result(timeout=30)[0] for future in futures ], [ [ i ] for i in range(5) ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1525 @@
+#
+# Varstore tests
+#
+# python -m unittest discover tests (with the modules installed as aoutils)
+#
+import os
+import datetime
+import json
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+from copy import deepcopy
+from aoutils.varstore import *
+
+# Tests writing files into a fresh directory
+class _FileTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+DEEP_SCHEMA = {
+    'a': { 'desc': 'A', 'value': {
+        'b': { 'desc': 'B', 'value': {
+            'c': { 'desc': 'C', 'value': 1 },
+            'd': { 'desc': 'D', 'value': 2 },
+        } },
+        'p': { 'desc': 'Protected', 'value': 3, 'protection': 0 },
+    } },
+    'n': { 'desc': 'Not saved', 'not_saved': True, 'value': {
+        't': { 'desc': 'T', 'value': 4 },
+    } },
+}
+
+class PathCacheTests(_FileTests):
+    # Each test runs with and without the path cache
+    def stores(self, schema=DEEP_SCHEMA, **kwargs):
+        for path_cache in (True, False):
+            with self.subTest(path_cache=path_cache):
+                yield Varstore(schema, path_cache=path_cache, **kwargs)
+
+    def test_set_seen_by_get(self):
+        for varstore in self.stores():
+            self.assertEqual(varstore.Get('a.b.c'), 1)
+
+            varstore.Set('a.b.c', 10)
+
+            self.assertEqual(varstore.Get('a.b.c'), 10)
+            self.assertEqual(varstore.Get('a.b'), { 'c': 10, 'd': 2 })
+
+    def test_protection_checked_when_cached(self):
+        for varstore in self.stores():
+            self.assertEqual(varstore.Get('a.p', protection=NO_PROTECTION), 3)
+
+            with self.assertRaises(VarstoreExceptionProtectedVar):
+                varstore.Get('a.p')
+
+    def test_replaced_table(self):
+        for varstore in self.stores():
+            varstore.Get('a.b.c')
+
+            varstore.Set('a.b', 5)
+
+            self.assertEqual(varstore.Get('a.b'), 5)
+            with self.assertRaises(VarstoreExceptionUndefinedVar):
+                varstore.Get('a.b.c')
+
+    def test_delete(self):
+        for varstore in self.stores():
+            varstore.Get('a.b.c')
+
+            varstore.Delete('a.b.c')
+
+            self.assertEqual(varstore.Get('a.b'), { 'd': 2 })
+            with self.assertRaises(VarstoreExceptionUndefinedVar):
+                varstore.Get('a.b.c')
+
+    def test_add_schema(self):
+        for varstore in self.stores():
+            varstore.Get('a.b.c')
+
+            varstore.AddSchema({ 'a': { 'desc': 'A', 'value': { 'b': { 'desc': 'B', 'value': { 'c': { 'desc': 'C', 'value': 7 } } } } } })
+
+            self.assertEqual(varstore.Get('a.b.c'), 7)
+            varstore.Set('a.b.c', 8)
+            self.assertEqual(varstore.Get('a'), { 'b': { 'c': 8 } })
+
+    def test_add_varstore(self):
+        for varstore in self.stores():
+            varstore.Get('a.b.c')
+
+            varstore.AddVarstore({ 'a': { 'desc': 'A', 'value': { 'b': { 'desc': 'B', 'value': { 'c': { 'desc': 'C', 'value': 9 } } } } } })
+
+            self.assertEqual(varstore.Get('a.b.c'), 9)
+
+    def test_load(self):
+        Varstore(DEEP_SCHEMA, filename=self.path('store.json')).Set('a.b.c', 11)
+
+        for varstore in self.stores(filename=self.path('store.json')):
+            self.assertEqual(varstore.Get('a.b.c'), 1)
+
+            varstore.Load(propagate=False)
+
+            self.assertEqual(varstore.Get('a.b.c'), 11)
+
+    def test_callable_tables_not_remembered(self):
+        tables = [ { 'x': { 'desc': 'X', 'value': 1 } }, { 'x': { 'desc': 'X', 'value': 2 } } ]
+        schema = { 'dyn': { 'desc': 'Produced', 'value': lambda op, var: tables[0] } }
+
+        for varstore in self.stores(schema):
+            self.assertEqual(varstore.Get('dyn.x'), 1)
+
+            tables.reverse()
+            self.assertEqual(varstore.Get('dyn.x'), 2)
+            tables.reverse()
+
+    def test_many_names(self):
+        schema = { 'v%d' % n: { 'desc': 'V', 'value': n } for n in range(PATH_CACHE_SIZE + 10) }
+        varstore = Varstore(schema)
+
+        for rounds in range(2):
+            for n in range(PATH_CACHE_SIZE + 10):
+                self.assertEqual(varstore.Get('v%d' % n), n)
+
+SAVED_SCHEMA = {
+    'tmp': { 'desc': 'Not saved', 'value': 1, 'not_saved': True },
+    'net': { 'desc': 'Network', 'value': {
+        'mtu': { 'desc': 'MTU', 'value': 1500, 'range': [ 576, 9000 ] },
+        'name': { 'desc': 'Name', 'value': 'eth0' },
+        'scratch': { 'desc': 'Protected', 'value': 0, 'protection': 0 },
+    } },
+    'cache': { 'desc': 'Not saved table', 'not_saved': True, 'value': {
+        'hits': { 'desc': 'Hits', 'value': 0 },
+    } },
+}
+
+# JSON storage counting its writes, failing the first 'failures' of them
+class _CountingStorage(VarstoreStorage):
+    def __init__(self, failures=0):
+        self.writes = 0
+        self.failures = failures
+
+    def Write(self, filename, encoded):
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError("disk full")
+
+        size = super(_CountingStorage, self).Write(filename, encoded)
+        self.writes += 1
+
+        return size
+
+class WriteBehindTests(_FileTests):
+    def open(self, storage, debounce=0.1):
+        varstore = Varstore(SAVED_SCHEMA, filename=self.path('store.json'), storage=storage, write_behind=debounce)
+        self.addCleanup(varstore.Close)
+        return varstore
+
+    def saved(self):
+        varstore = Varstore(SAVED_SCHEMA, filename=self.path('store.json'))
+        varstore.Load(propagate=False)
+        return varstore.Get('net.mtu')
+
+    def test_burst_written_once(self):
+        storage = _CountingStorage()
+        varstore = self.open(storage)
+
+        for mtu in range(1000, 1100):
+            varstore.Set('net.mtu', mtu)
+
+        self.assertEqual(storage.writes, 0)
+
+        for wait in range(50):
+            if storage.writes:
+                break
+            time.sleep(0.05)
+
+        self.assertEqual(storage.writes, 1)
+        self.assertEqual(self.saved(), 1099)
+
+    def test_flush(self):
+        storage = _CountingStorage()
+        varstore = self.open(storage, debounce=60)
+
+        varstore.Set('net.mtu', 2000)
+
+        self.assertTrue(varstore.Flush())
+        self.assertFalse(varstore.Flush())
+        self.assertEqual(self.saved(), 2000)
+
+    def test_close_writes_pending(self):
+        storage = _CountingStorage()
+        varstore = self.open(storage, debounce=60)
+
+        varstore.Set('net.mtu', 3000)
+        varstore.Close()
+
+        self.assertEqual(storage.writes, 1)
+        self.assertEqual(self.saved(), 3000)
+
+    def test_failed_write_retried(self):
+        storage = _CountingStorage(failures=1)
+        varstore = self.open(storage, debounce=60)
+
+        varstore.Set('net.mtu', 4000)
+
+        with self.assertRaises(VarstoreExceptionFile):
+            varstore.Flush()
+
+        # Still dirty
+        self.assertTrue(varstore.Flush())
+        self.assertEqual(self.saved(), 4000)
+
+    def test_failed_background_write_retried_on_close(self):
+        storage = _CountingStorage(failures=1)
+        varstore = self.open(storage, debounce=0.01)
+
+        varstore.Set('net.mtu', 5000)
+
+        # Let the flusher fail
+        for wait in range(50):
+            if storage.failures == 0:
+                break
+            time.sleep(0.05)
+
+        self.assertEqual(storage.failures, 0)
+
+        varstore.Close()
+
+        self.assertEqual(storage.writes, 1)
+        self.assertEqual(self.saved(), 5000)
+
+    def test_saved_file_replaced_whole(self):
+        varstore = Varstore(SAVED_SCHEMA, filename=self.path('store.json'))
+        varstore.Set('net.mtu', 4000)
+
+        self.assertEqual(os.listdir(self.directory), [ 'store.json' ])
+        self.assertEqual(self.saved(), 4000)
+
+class JournalTests(_FileTests):
+    def open(self, storage=None, **kwargs):
+        if storage is None:
+            storage = VarstoreJournalStorage(**kwargs)
+
+        return Varstore(SAVED_SCHEMA, filename=self.path('store.json'), storage=storage)
+
+    def reload(self):
+        varstore = self.open()
+        varstore.Load(propagate=False)
+        return varstore
+
+    # The journal records (after the generation line)
+    def journal(self):
+        with open(self.path('store.json.journal')) as f:
+            return f.read().splitlines()[1:]
+
+    def test_changes_appended_and_replayed(self):
+        varstore = self.open()
+        varstore.Set('net.mtu', 9000)          # first save: a snapshot
+        varstore.Set('net.name', 'eth1')
+        varstore.Set('net.mtu', 1400)
+
+        self.assertEqual(len(self.journal()), 2)
+        self.assertEqual(self.reload().Export(), { 'tmp': 1, 'net': { 'mtu': 1400, 'name': 'eth1' }, 'cache': { 'hits': 0 } })
+
+    def test_compacted_into_snapshot(self):
+        varstore = self.open(max_entries=3)
+
+        for mtu in range(1000, 1006):
+            varstore.Set('net.mtu', mtu)
+
+        self.assertLessEqual(len(self.journal()), 3)
+        self.assertEqual(self.reload().Get('net.mtu'), 1005)
+
+    def test_torn_record_ignored(self):
+        varstore = self.open()
+        varstore.Set('net.mtu', 9000)
+        varstore.Set('net.mtu', 2000)
+
+        with open(self.path('store.json.journal'), 'a') as f:
+            f.write('["net.mtu", 30')
+
+        reloaded = self.reload()
+        self.assertEqual(reloaded.Get('net.mtu'), 2000)
+
+        # Appends start on a clean line
+        reloaded.Set('net.name', 'eth2')
+        self.assertEqual(self.reload().Get('net'), { 'mtu': 2000, 'name': 'eth2' })
+
+    def test_journal_matches_snapshot(self):
+        journalled = self.open()
+        plain = Varstore(SAVED_SCHEMA, filename=self.path('plain.json'))
+
+        for varstore in (journalled, plain):
+            varstore.Apply({ 'tmp': 99, 'net': { 'scratch': 42, 'mtu': 20000 } }, protection=NO_PROTECTION)
+            varstore.SetMany({ 'tmp': 77, 'cache.hits': 5, 'net.name': 'wan' })
+            varstore.Set('net.scratch', 41, protection=NO_PROTECTION)
+
+        reloaded_plain = Varstore(SAVED_SCHEMA, filename=self.path('plain.json'))
+        reloaded_plain.Load(propagate=False)
+
+        self.assertEqual(self.reload().Export(protection=NO_PROTECTION), reloaded_plain.Export(protection=NO_PROTECTION))
+        self.assertEqual(self.reload().Get('net.mtu'), 9000)
+        self.assertEqual(self.reload().Get('tmp'), 1)
+        self.assertEqual(self.reload().Get('net.scratch', protection=NO_PROTECTION), 41)
+
+        # Only what Save would write is journalled: the protected var only when set with its protection
+        self.assertEqual([ json.loads(record) for record in self.journal() ], [ [ None, { 'net': { 'name': 'wan' } } ], [ 'net.scratch', 41 ] ])
+
+    # A crash after writing a snapshot leaves the journal it replaced
+    def test_replaced_journal_not_replayed(self):
+        varstore = self.open()
+        varstore.Set('net.mtu', 9000)
+        varstore.Set('net.mtu', 2000)
+
+        shutil.copy(self.path('store.json.journal'), self.path('old.journal'))
+
+        varstore.Set('net.name', 'eth1')
+        varstore.Save()
+        varstore.Set('net.mtu', 3000)
+        varstore.Save()
+
+        os.replace(self.path('old.journal'), self.path('store.json.journal'))
+
+        reloaded = self.reload()
+        self.assertEqual(reloaded.Get('net'), { 'mtu': 3000, 'name': 'eth1' })
+
+        # Changes after it are replayed
+        reloaded.Set('net.name', 'eth2')
+        self.assertEqual(self.reload().Get('net'), { 'mtu': 3000, 'name': 'eth2' })
+        self.assertEqual(self.journal(), [ '["net.name", "eth2"]' ])
+
+    # Files written before generations were kept
+    def test_without_generation(self):
+        with open(self.path('store.json'), 'w') as f:
+            json.dump({ 'net': { 'mtu': 9000, 'name': 'eth0' } }, f)
+
+        with open(self.path('store.json.journal'), 'w') as f:
+            f.write('["net.mtu", 2000]\n')
+
+        reloaded = self.reload()
+        self.assertEqual(reloaded.Get('net.mtu'), 2000)
+
+        reloaded.Set('net.name', 'eth1')
+        self.assertEqual(self.reload().Get('net'), { 'mtu': 2000, 'name': 'eth1' })
+
+# Writers keep x == -y in every change they make
+PAIR_SCHEMA = {
+    'a': { 'desc': 'A', 'value': {
+        'x': { 'desc': 'X', 'value': 0 },
+        'y': { 'desc': 'Y', 'value': 0 },
+    } },
+}
+
+# Run 'writers' threads making 'changes' changes each against 'readers' threads reading
+# until the writers are done.  Returns (reads, torn reads).
+def _stress(varstore, read, writers=3, readers=2, changes=1000):
+    done = threading.Event()
+    counts = [ [ 0, 0 ] for reader in range(readers) ]
+
+    def writer(k):
+        for i in range(changes):
+            n = i * writers + k
+            varstore.Apply({ 'a': { 'x': n, 'y': -n } })
+
+    def reader(count):
+        while not done.is_set():
+            values = read()
+            count[0] += 1
+            if values['x'] != -values['y']:
+                count[1] += 1
+
+    writer_threads = [ threading.Thread(target=writer, args=(k,)) for k in range(writers) ]
+    reader_threads = [ threading.Thread(target=reader, args=(count,)) for count in counts ]
+
+    for thread in reader_threads + writer_threads:
+        thread.start()
+
+    for thread in writer_threads:
+        thread.join()
+
+    done.set()
+
+    for thread in reader_threads:
+        thread.join()
+
+    return (sum(count[0] for count in counts), sum(count[1] for count in counts))
+
+class SnapshotTests(unittest.TestCase):
+    def test_get_never_torn(self):
+        varstore = Varstore(PAIR_SCHEMA, snapshots=True)
+        (reads, torn) = _stress(varstore, lambda: varstore.Get('a'))
+
+        self.assertGreater(reads, 0)
+        self.assertEqual(torn, 0)
+
+    def test_export_never_torn(self):
+        varstore = Varstore(PAIR_SCHEMA, snapshots=True)
+        (reads, torn) = _stress(varstore, lambda: varstore.Export()['a'])
+
+        self.assertGreater(reads, 0)
+        self.assertEqual(torn, 0)
+
+    def test_readers_keep_their_snapshot(self):
+        varstore = Varstore(PAIR_SCHEMA, snapshots=True)
+        store = varstore._store
+        version = varstore.Version()
+
+        varstore.Set('a.x', 5)
+
+        self.assertEqual(store['a']['value']['x']['value'], 0)
+        self.assertEqual(varstore.Get('a.x'), 5)
+        self.assertEqual(varstore.Version(), version + 1)
+
+    def test_failed_write_publishes_nothing(self):
+        schema = { 'a': { 'desc': 'A', 'value': {
+            'x': { 'desc': 'X', 'value': 0 },
+            'y': { 'desc': 'Y', 'value': 0, 'options': [ 0, 10 ] },
+        } } }
+        varstore = Varstore(schema, snapshots=True)
+        version = varstore.Version()
+
+        with self.assertRaises(VarstoreExceptionOption):
+            varstore.Apply({ 'a': { 'x': 1, 'y': 11 } })
+
+        self.assertEqual(varstore.Get('a'), { 'x': 0, 'y': 0 })
+        self.assertEqual(varstore.Version(), version)
+
+    def test_saves_written_from_snapshot(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        filename = os.path.join(directory, 'store.json')
+
+        varstore = Varstore(PAIR_SCHEMA, filename=filename, snapshots=True)
+        _stress(varstore, lambda: varstore.Get('a'), changes=20)
+        varstore.Save()
+
+        loaded = Varstore(PAIR_SCHEMA, filename=filename)
+        loaded.Load()
+
+        self.assertEqual(loaded.Get('a'), varstore.Get('a'))
+        self.assertEqual(loaded.Get('a.x'), -loaded.Get('a.y'))
+
+class TransactionTests(_FileTests):
+    # Each test runs with and without snapshots
+    def stores(self, **kwargs):
+        for snapshots in (False, True):
+            with self.subTest(snapshots=snapshots):
+                storage = _CountingStorage()
+                filename = self.path('store%d.json' % snapshots)
+                yield (Varstore(SAVED_SCHEMA, filename=filename, storage=storage, snapshots=snapshots, **kwargs), storage)
+
+    def test_set_many(self):
+        for (varstore, storage) in self.stores():
+            varstore.SetMany({ 'net.mtu': 2000, 'net.name': 'eth1', 'tmp': 5 })
+
+            self.assertEqual(varstore.Get('net.mtu'), 2000)
+            self.assertEqual(varstore.Get('net.name'), 'eth1')
+            self.assertEqual(varstore.Get('tmp'), 5)
+            self.assertEqual(storage.writes, 1)
+
+    def test_bad_value_changes_nothing(self):
+        for (varstore, storage) in self.stores():
+            with self.assertRaises(VarstoreExceptionRange):
+                varstore.SetMany({ 'net.name': 'eth1', 'net.mtu': 100 })
+
+            self.assertEqual(varstore.Get('net.name'), 'eth0')
+            self.assertEqual(storage.writes, 0)
+
+    def test_failed_publish_rolled_back(self):
+        def publish(value, var):
+            raise RuntimeError("publish failed")
+
+        schema = { 'a': { 'desc': 'A', 'value': 1 }, 'b': { 'desc': 'B', 'value': 2, 'publish': publish } }
+
+        for snapshots in (False, True):
+            with self.subTest(snapshots=snapshots):
+                varstore = Varstore(schema, snapshots=snapshots)
+
+                with self.assertRaises(RuntimeError):
+                    varstore.SetMany({ 'a': 10, 'b': 20 })
+
+                self.assertEqual(varstore.Get('a'), 1)
+                self.assertEqual(varstore.Get('b'), 2)
+
+    def test_transaction(self):
+        for (varstore, storage) in self.stores():
+            with varstore.Transaction() as transaction:
+                transaction.Set('net.mtu', 2000)
+                transaction.Set('net.name', 'eth1')
+
+                self.assertEqual(transaction.Get('net.mtu'), 2000)
+                self.assertEqual(varstore.Get('net.mtu'), 1500)
+
+            self.assertEqual(varstore.Get('net.mtu'), 2000)
+            self.assertEqual(varstore.Get('net.name'), 'eth1')
+            self.assertEqual(storage.writes, 1)
+
+    def test_transaction_discarded_on_exception(self):
+        for (varstore, storage) in self.stores():
+            with self.assertRaises(KeyError):
+                with varstore.Transaction() as transaction:
+                    transaction.Set('net.mtu', 2000)
+                    raise KeyError('abandoned')
+
+            self.assertEqual(varstore.Get('net.mtu'), 1500)
+            self.assertEqual(storage.writes, 0)
+
+class DeltaPropagateTests(unittest.TestCase):
+    def setUp(self):
+        self.propagated = []
+        self.varstore = Varstore(SAVED_SCHEMA, propagate=lambda values, full: self.propagated.append((values, full)), delta_propagate=True)
+
+    # Propagate, returning everything propagated since the last call (Save propagates too)
+    def sent(self, **kwargs):
+        self.varstore.Propagate(**kwargs)
+        sent = self.propagated[:]
+        del self.propagated[:]
+        return sent
+
+    def test_first_propagate_full(self):
+        [ (values, full) ] = self.sent()
+
+        self.assertTrue(full)
+        self.assertEqual(values['net']['mtu'], 1500)
+        self.assertEqual(self.sent(), [])
+
+    def test_changes_propagated(self):
+        self.sent()
+
+        self.varstore.Set('net.mtu', 2000)
+        self.varstore.Set('tmp', 2)
+        self.assertEqual(self.sent(), [ ({ 'net.mtu': 2000, 'tmp': 2 }, False) ])
+
+        self.varstore.Apply({ 'net': { 'name': 'eth1' }, 'cache': { 'hits': 3 } })
+        self.assertEqual(self.sent(), [ ({ 'net.name': 'eth1', 'cache.hits': 3 }, False) ])
+
+    def test_set_many_propagated(self):
+        self.sent()
+
+        self.varstore.SetMany({ 'net.mtu': 2000, 'net': { 'name': 'eth1' } })
+
+        self.assertEqual(self.sent(), [ ({ 'net.mtu': 2000, 'net.name': 'eth1' }, False) ])
+
+    def test_rollback_propagated(self):
+        def publish(value, var):
+            raise RuntimeError("publish failed")
+
+        self.varstore.AddSchema({ 'hooked': { 'desc': 'Hooked', 'value': 0, 'publish': publish } })
+        self.sent()
+
+        with self.assertRaises(RuntimeError):
+            self.varstore.SetMany({ 'net.mtu': 2000, 'hooked': 1 })
+
+        self.assertEqual(self.sent(), [ ({ 'net.mtu': 1500, 'hooked': 0 }, False) ])
+
+    def test_failed_snapshot_write_not_propagated(self):
+        def publish(value, var):
+            raise RuntimeError("publish failed")
+
+        self.varstore = Varstore(SAVED_SCHEMA, propagate=lambda values, full: self.propagated.append((values, full)), delta_propagate=True, snapshots=True)
+        self.varstore.AddSchema({ 'hooked': { 'desc': 'Hooked', 'value': 0, 'publish': publish } })
+        self.sent()
+
+        for write in (lambda: self.varstore.Apply({ 'net': { 'mtu': 2000 }, 'hooked': 1 }), lambda: self.varstore.SetMany({ 'net.mtu': 2000, 'hooked': 1 })):
+            with self.assertRaises(RuntimeError):
+                write()
+
+            self.assertEqual(self.sent(), [])
+
+        self.varstore.Set('net.name', 'eth1')
+        self.assertEqual(self.sent(), [ ({ 'net.name': 'eth1' }, False) ])
+
+    def test_structure_change_propagates_full(self):
+        self.sent()
+
+        self.varstore.Delete('net.scratch', protection=NO_PROTECTION)
+        [ (values, full) ] = self.sent()
+
+        self.assertTrue(full)
+        self.assertNotIn('scratch', values['net'])
+
+    def test_full_requested(self):
+        self.sent()
+        self.varstore.Set('net.mtu', 2000)
+
+        [ (values, full) ] = self.sent(full=True)
+
+        self.assertTrue(full)
+        self.assertEqual(values['net']['mtu'], 2000)
+        self.assertEqual(self.sent(), [])
+
+    def test_dotted_names_quoted(self):
+        self.varstore.AddSchema({ 'hosts': { 'desc': 'Hosts', 'value': { 'a.example': { 'desc': 'Host', 'value': 1 } } } })
+        self.sent()
+
+        self.varstore.Apply({ 'hosts': { 'a.example': 2 } })
+
+        self.assertEqual(self.sent(), [ ({ 'hosts."a.example"': 2 }, False) ])
+
+class SubscribeTests(unittest.TestCase):
+    # Each test runs with and without snapshots; Close() delivers pending notifications
+    def stores(self):
+        for snapshots in (False, True):
+            with self.subTest(snapshots=snapshots):
+                varstore = Varstore(SAVED_SCHEMA, snapshots=snapshots)
+                yield varstore
+                varstore.Close()
+
+    def test_var_table_and_all(self):
+        for varstore in self.stores():
+            changes = { 'mtu': [], 'net': [], 'all': [] }
+            varstore.Subscribe('net.mtu', lambda path, value: changes['mtu'].append((path, value)))
+            varstore.Subscribe('net', lambda path, value: changes['net'].append((path, value)))
+            varstore.Subscribe(None, lambda path, value: changes['all'].append((path, value)))
+
+            varstore.Set('net.mtu', 2000)
+            varstore.Apply({ 'net': { 'name': 'eth1' } })
+            varstore.Set('tmp', 2)
+            varstore.Close()
+
+            self.assertEqual(changes['mtu'], [ ('net.mtu', 2000) ])
+            self.assertEqual(changes['net'], [ ('net.mtu', 2000), ('net.name', 'eth1') ])
+            self.assertEqual(changes['all'], [ ('net.mtu', 2000), ('net.name', 'eth1'), ('tmp', 2) ])
+
+    def test_unsubscribe(self):
+        for varstore in self.stores():
+            changes = []
+            subscriber = varstore.Subscribe('net', lambda path, value: changes.append(value))
+
+            varstore.Set('net.mtu', 2000)
+            varstore.Unsubscribe(subscriber)
+            varstore.Set('net.mtu', 3000)
+            varstore.Close()
+
+            self.assertEqual(changes, [ 2000 ])
+
+    def test_delivered_in_order(self):
+        for varstore in self.stores():
+            changes = []
+            varstore.Subscribe('net.mtu', lambda path, value: changes.append(value))
+
+            for mtu in range(1000, 1200):
+                varstore.Set('net.mtu', mtu)
+
+            varstore.Close()
+
+            self.assertEqual(changes, list(range(1000, 1200)))
+
+    def test_slow_subscriber_does_not_block(self):
+        for varstore in self.stores():
+            release = threading.Event()
+            changes = []
+
+            def slow(path, value):
+                release.wait(5)
+                changes.append(value)
+
+            varstore.Subscribe('net.mtu', slow)
+
+            start = time.monotonic()
+            for mtu in range(1000, 1010):
+                varstore.Set('net.mtu', mtu)
+
+            self.assertLess(time.monotonic() - start, 1)
+            self.assertEqual(changes, [])
+
+            release.set()
+            varstore.Close()
+
+            self.assertEqual(changes, list(range(1000, 1010)))
+
+    def test_change_visible_to_subscriber(self):
+        for varstore in self.stores():
+            seen = []
+            varstore.Subscribe('net.mtu', lambda path, value: seen.append(varstore.Get(path)))
+
+            varstore.Set('net.mtu', 2000)
+            varstore.Close()
+
+            self.assertEqual(seen, [ 2000 ])
+
+    def test_failing_subscriber_isolated(self):
+        for varstore in self.stores():
+            changes = []
+
+            def failing(path, value):
+                raise RuntimeError("subscriber failed")
+
+            varstore.Subscribe('net.mtu', failing)
+            varstore.Subscribe('net.mtu', lambda path, value: changes.append(value))
+
+            varstore.Set('net.mtu', 2000)
+            varstore.Set('net.mtu', 3000)
+            varstore.Close()
+
+            self.assertEqual(changes, [ 2000, 3000 ])
+
+    def test_notified_after_close(self):
+        for varstore in self.stores():
+            changes = []
+            varstore.Subscribe('net.mtu', lambda path, value: changes.append(value))
+
+            varstore.Set('net.mtu', 2000)
+            varstore.Close()
+            varstore.Set('net.mtu', 3000)
+            varstore.Close()
+
+            self.assertEqual(changes, [ 2000, 3000 ])
+
+# The checks _set_var_value made with eval() before cells had compiled validators
+def _eval_checks(cell, var, value, readonly_check=True, fix_range=False):
+    if 'type' in cell:
+        try:
+            value = eval("%s(%s)" % (cell['type'], value))
+
+        except Exception as e:
+            # eval() failing on text that isn't a literal: now reported as a type error
+            raise VarstoreExceptionType(var, value, cell['type'])
+
+    if readonly_check and 'readonly' in cell and cell['readonly']:
+        raise VarstoreExceptionAccessError(var, extra='is read-only')
+
+    elif 'options' in cell and value not in cell['options']:
+        raise VarstoreExceptionOption(var, value)
+
+    elif 'range' in cell and (value < cell['range'][0] or value > cell['range'][1]):
+        if not fix_range:
+            raise VarstoreExceptionRange(var, value, cell['range'])
+
+        value = cell['range'][0] if value < cell['range'][0] else cell['range'][1]
+
+    return value
+
+VALIDATED_SCHEMA = {
+    'v': { 'desc': 'Validated', 'value': {
+        'count': { 'desc': 'Count', 'type': 'int', 'value': 0, 'range': [ 0, 100 ] },
+        'ratio': { 'desc': 'Ratio', 'type': 'float', 'value': 0.5, 'range': [ 0.0, 1.0 ] },
+        'flag': { 'desc': 'Flag', 'type': 'bool', 'value': False },
+        'mode': { 'desc': 'Mode', 'value': 'auto', 'options': [ 'auto', 'manual' ] },
+        'level': { 'desc': 'Level', 'type': 'int', 'value': 1, 'options': [ 1, 2, 3 ] },
+        'serial': { 'desc': 'Serial', 'value': 'x', 'readonly': True },
+        'label': { 'desc': 'Label', 'type': 'str', 'value': 'a' },
+        'free': { 'desc': 'Free', 'value': 0 },
+    } },
+}
+
+VALIDATED_VALUES = [ 0, 1, 5, 100, 101, -1, 1.5, 0.25, True, False, None, '7', '0x10', ' 42 ', 'True', '2.5', '1e2', 'auto', 'manual', 'other', 'abc', [ 'auto' ] ]
+
+# (path, cell) of each var of 'schema' that isn't a table
+def _leaf_cells(schema, prefix=''):
+    for var in schema:
+        if isinstance(schema[var]['value'], dict):
+            yield from _leaf_cells(schema[var]['value'], prefix + var + '.')
+
+        else:
+            yield (prefix + var, schema[var])
+
+class ValidatorTests(unittest.TestCase):
+    # Outcome of 'write': ('value', stored value) or ('error', exception class)
+    def outcome(self, write):
+        try:
+            return ('value', write())
+
+        except VarstoreException as e:
+            return ('error', type(e))
+
+        except TypeError as e:
+            return ('error', TypeError)
+
+    # Every var of the schema fixtures written with each of VALIDATED_VALUES
+    def check_same_as_eval(self, write, readonly_check, fix_range):
+        for schema in (VALIDATED_SCHEMA, SAVED_SCHEMA, DEEP_SCHEMA, PAIR_SCHEMA):
+            for (path, cell) in _leaf_cells(schema):
+                for value in VALIDATED_VALUES:
+                    # Text for 'str' cells had to be quoted for eval(); it is now taken as is
+                    if cell.get('type') == 'str' and isinstance(value, str):
+                        continue
+
+                    with self.subTest(var=path, value=value):
+                        varstore = Varstore(schema)
+
+                        expected = self.outcome(lambda: _eval_checks(cell, path, value, readonly_check, fix_range))
+                        got = self.outcome(lambda: write(varstore, path, value))
+
+                        # Values that can't be compared with the range raised a bare TypeError
+                        if expected == ('error', TypeError):
+                            expected = ('error', VarstoreExceptionRange)
+
+                        self.assertEqual(got, expected)
+                        if got[0] == 'value' and 'type' in cell:
+                            self.assertIs(type(got[1]), type(expected[1]))
+
+    def test_set_same_as_eval(self):
+        def write(varstore, path, value):
+            varstore.Set(path, value, protection=NO_PROTECTION)
+            return varstore.Get(path, protection=NO_PROTECTION)
+
+        self.check_same_as_eval(write, readonly_check=True, fix_range=False)
+
+    def test_apply_same_as_eval(self):
+        def write(varstore, path, value):
+            for name in reversed(path.split('.')):
+                value = { name: value }
+
+            varstore.Apply(value, protection=NO_PROTECTION)
+            return varstore.Get(path, protection=NO_PROTECTION)
+
+        self.check_same_as_eval(write, readonly_check=False, fix_range=True)
+
+    def test_uncomparable_range(self):
+        varstore = Varstore(SAVED_SCHEMA)
+
+        for write in (lambda: varstore.Set('net.mtu', 'abc'), lambda: varstore.Apply({ 'net': { 'mtu': 'abc' } }), lambda: varstore.SetMany({ 'net.mtu': None })):
+            with self.assertRaises(VarstoreExceptionRange) as raised:
+                write()
+
+            self.assertIn('net.mtu', str(raised.exception))
+
+        self.assertEqual(varstore.Get('net.mtu'), 1500)
+
+    def test_text_for_str_cells(self):
+        varstore = Varstore(VALIDATED_SCHEMA)
+        varstore.Set('v.label', 'hello world')
+        varstore.Set('v.free', 'anything')
+
+        self.assertEqual(varstore.Get('v.label'), 'hello world')
+        self.assertEqual(varstore.Get('v.free'), 'anything')
+
+    def test_text_is_not_evaluated(self):
+        calls = []
+        varstore = Varstore(VALIDATED_SCHEMA)
+
+        with self.assertRaises(VarstoreExceptionType):
+            varstore.Set('v.count', "__import__('builtins').print('evaluated') or 1")
+
+        with self.assertRaises(VarstoreExceptionType):
+            varstore.Set('v.count', "1); calls.append(1); int(1")
+
+        self.assertEqual(calls, [])
+        self.assertEqual(varstore.Get('v.count'), 0)
+
+    def test_unhashable_not_an_option(self):
+        varstore = Varstore(VALIDATED_SCHEMA)
+
+        for value in ([ 'auto' ], [ 'auto', 'manual' ]):
+            with self.assertRaises(VarstoreExceptionOption):
+                varstore.Set('v.mode', value)
+
+        self.assertEqual(varstore.Get('v.mode'), 'auto')
+
+    def test_unknown_type(self):
+        varstore = Varstore({ 'x': { 'desc': 'X', 'type': 'os.system', 'value': 0 } })
+
+        with self.assertRaises(VarstoreExceptionType):
+            varstore.Set('x', 1)
+
+    def test_added_schema_compiled(self):
+        varstore = Varstore(VALIDATED_SCHEMA)
+        varstore.AddSchema({ 'w': { 'desc': 'W', 'type': 'int', 'value': 0, 'range': [ 0, 9 ] } })
+
+        varstore.Set('w', '5')
+        self.assertEqual(varstore.Get('w'), 5)
+
+        with self.assertRaises(VarstoreExceptionRange):
+            varstore.Set('w', 10)
+
+class CompactTests(_FileTests):
+    # A compact store (with and without snapshots) alongside a store of dict cells
+    def stores(self, schema=SAVED_SCHEMA, **kwargs):
+        for snapshots in (False, True):
+            with self.subTest(snapshots=snapshots):
+                yield (Varstore(schema, snapshots=snapshots, **kwargs), Varstore(schema, snapshots=snapshots, compact=True, **kwargs))
+
+    def test_same_as_dict_cells(self):
+        for schema in (SAVED_SCHEMA, DEEP_SCHEMA, VALIDATED_SCHEMA):
+            for (dicts, compact) in self.stores(schema):
+                self.assertEqual(compact.Export(protection=NO_PROTECTION), dicts.Export(protection=NO_PROTECTION))
+                self.assertEqual(compact.GetAttributes(None), dicts.GetAttributes(None))
+
+    def test_set_checked_as_dict_cells(self):
+        for (dicts, compact) in self.stores(VALIDATED_SCHEMA):
+            for (var, value) in [ ('v.count', '7'), ('v.count', 101), ('v.ratio', 0.25), ('v.mode', 'other'), ('v.serial', 'y'), ('v.flag', 'True') ]:
+                results = []
+
+                for varstore in (dicts, compact):
+                    try:
+                        varstore.Set(var, value)
+                        results.append(varstore.Get(var))
+
+                    except VarstoreException as e:
+                        results.append(type(e))
+
+                self.assertEqual(results[1], results[0])
+
+    def test_schema_not_changed(self):
+        schema = deepcopy(SAVED_SCHEMA)
+
+        for (dicts, compact) in self.stores(schema):
+            compact.Set('net.mtu', 2000)
+            compact.SetMany({ 'net.name': 'eth1', 'tmp': 2 })
+
+        self.assertEqual(schema, SAVED_SCHEMA)
+
+    def test_shared_templates(self):
+        template = { 'desc': 'Port', 'type': 'int', 'value': 0, 'range': [ 0, 65535 ] }
+        schema = { 'ports': { 'desc': 'Ports', 'value': { 'p%d' % p: template for p in range(10) } } }
+
+        for (dicts, compact) in self.stores(schema):
+            compact.Set('ports.p1', 80)
+
+            self.assertEqual(compact.Get('ports.p1'), 80)
+            self.assertEqual(compact.Get('ports.p2'), 0)
+            self.assertEqual(compact.GetAttributes('ports.p2'), dicts.GetAttributes('ports.p2'))
+
+            with self.assertRaises(VarstoreExceptionRange):
+                compact.Set('ports.p3', 70000)
+
+    def test_save_and_load(self):
+        for (dicts, compact) in self.stores(filename=self.path('store.json')):
+            compact.Set('net.mtu', 2000)
+
+            loaded = Varstore(SAVED_SCHEMA, filename=self.path('store.json'), compact=True)
+            loaded.Load(propagate=False)
+
+            self.assertEqual(loaded.Get('net.mtu'), 2000)
+
+    def test_rollback(self):
+        def publish(value, var):
+            raise RuntimeError("publish failed")
+
+        schema = { 'a': { 'desc': 'A', 'value': 1 }, 'b': { 'desc': 'B', 'value': 2, 'publish': publish } }
+
+        for (dicts, compact) in self.stores(schema):
+            with self.assertRaises(RuntimeError):
+                compact.SetMany({ 'a': 10, 'b': 20 })
+
+            self.assertEqual(compact.Export(), { 'a': 1, 'b': 2 })
+
+    def test_smaller(self):
+        schema = { 't%d' % t: { 'desc': 'T', 'value': { 'v%d' % v: { 'desc': 'V', 'type': 'int', 'value': v } for v in range(50) } } for t in range(20) }
+        sizes = []
+
+        for compact in (False, True):
+            tracemalloc.start()
+            varstore = Varstore(schema, compact=compact)
+            sizes.append(tracemalloc.get_traced_memory()[0])
+            tracemalloc.stop()
+            del varstore
+
+        self.assertLess(sizes[1], sizes[0] / 2)
+
+# Binary storage whose loaders take a while, to have readers wait on a table being loaded
+class _SlowBinaryStorage(VarstoreBinaryStorage):
+    def _loader(self, decode, data, offset, size):
+        load = super(_SlowBinaryStorage, self)._loader(decode, data, offset, size)
+
+        def slow():
+            time.sleep(0.1)
+            return load()
+
+        return slow
+
+class BinaryStorageTests(_FileTests):
+    def open(self, storage=None, **kwargs):
+        return Varstore(DEEP_SCHEMA, filename=self.path('store.vsb'), storage=storage or VarstoreBinaryStorage(), **kwargs)
+
+    def check_round_trip(self, **kwargs):
+        varstore = self.open(**kwargs)
+        varstore.Set('a.b.c', 10)
+        varstore.Set('a.p', 30, protection=NO_PROTECTION)
+
+        loaded = self.open(**kwargs)
+        loaded.Load(propagate=False)
+
+        self.assertEqual(loaded.Get('a.b'), { 'c': 10, 'd': 2 })
+        self.assertEqual(loaded.Get('a.p', protection=NO_PROTECTION), 30)
+        self.assertEqual(loaded.Export(protection=NO_PROTECTION), varstore.Export(protection=NO_PROTECTION))
+
+    def test_round_trip(self):
+        for options in ({}, { 'snapshots': True }, { 'compact': True }):
+            with self.subTest(**options):
+                self.check_round_trip(**options)
+
+    def test_unread_tables_saved(self):
+        varstore = self.open()
+        varstore.Set('a.b.c', 10)
+
+        loaded = self.open()
+        loaded.Load(propagate=False)
+        loaded.Save(propagate=False)
+
+        reloaded = self.open()
+        reloaded.Load(propagate=False)
+
+        self.assertEqual(reloaded.Get('a.b.c'), 10)
+
+    def test_changed_before_first_read(self):
+        varstore = self.open()
+        varstore.Set('a.b.c', 10)
+
+        for write in (lambda v: v.Set('a.b.d', 20), lambda v: v.Apply({ 'a': { 'b': { 'd': 20 } } })):
+            loaded = self.open()
+            loaded.Load(propagate=False)
+            write(loaded)
+
+            self.assertEqual(loaded.Get('a.b'), { 'c': 10, 'd': 20 })
+
+    def test_readers_wait_for_load(self):
+        self.open().Set('a.b.c', 10)
+
+        for snapshots in (False, True):
+            with self.subTest(snapshots=snapshots):
+                loaded = self.open(storage=_SlowBinaryStorage(), snapshots=snapshots)
+                loaded.Load(propagate=False)
+
+                values = []
+                readers = [ threading.Thread(target=lambda: values.append(loaded.Get('a.b.c'))) for n in range(4) ]
+                writer = threading.Thread(target=loaded.Set, args=('a.b.d', 20))
+
+                for thread in readers + [ writer ]:
+                    thread.start()
+
+                for thread in readers + [ writer ]:
+                    thread.join()
+
+                self.assertEqual(values, [ 10 ] * 4)
+                self.assertEqual(loaded.Get('a.b'), { 'c': 10, 'd': 20 })
+
+    def test_json_copy(self):
+        varstore = self.open()
+        varstore.Set('a.b.c', 10)
+        varstore.Save(filename=self.path('copy.json'), storage=VarstoreStorage(), propagate=False)
+
+        with open(self.path('copy.json')) as f:
+            self.assertEqual(json.load(f)['a']['b']['c'], 10)
+
+        loaded = self.open()
+        loaded.Load(self.path('copy.json'), storage=VarstoreStorage(), propagate=False)
+
+        self.assertEqual(loaded.Get('a.b.c'), 10)
+
+    def test_not_binary(self):
+        with open(self.path('store.vsb'), 'w') as f:
+            f.write('{}')
+
+        with self.assertRaises(VarstoreExceptionFile):
+            self.open().Load(propagate=False)
+
+    def test_classes_refused(self):
+        storage = VarstoreBinaryStorage()
+        storage.Write(self.path('store.vsb'), storage.Encode({ 'a': { 'when': datetime.date(2020, 1, 1) } }))
+
+        with self.assertRaises(pickle.UnpicklingError):
+            storage.Sections(self.path('store.vsb'))['a']()
+
+    def test_other_versions_refused(self):
+        encoded = VarstoreBinaryStorage().Encode({ 'a': { 'b': { 'c': 10 } } })
+
+        with open(self.path('store.vsb'), 'wb') as f:
+            f.write(encoded[:3] + b'1' + encoded[4:])
+
+        with self.assertRaises(VarstoreExceptionFile):
+            self.open().Load(propagate=False)
+
+# A callable value returning the number of its 'get' calls, and keeping the values written
+# to it in 'written' (the store copies the schema, but not functions)
+def _counter(delay=0, written=None):
+    calls = [ 0 ]
+
+    def value(op, var, value=None):
+        if op == 'set':
+            written.append(value)
+            return
+
+        time.sleep(delay)
+        calls[0] += 1
+        return calls[0]
+
+    return value
+
+class CallableCacheTests(unittest.TestCase):
+    def test_cached_for_ttl(self):
+        varstore = Varstore({ 'c': { 'desc': 'C', 'value': _counter(), 'ttl': 60 } })
+
+        self.assertEqual([ varstore.Get('c') for i in range(5) ], [ 1 ] * 5)
+        self.assertEqual(varstore.CacheStats('c'), { 'hits': 4, 'misses': 1, 'stale': 0, 'refreshes': 0 })
+
+    def test_expires(self):
+        varstore = Varstore({ 'c': { 'desc': 'C', 'value': _counter(), 'ttl': 0.05 } })
+
+        self.assertEqual(varstore.Get('c'), 1)
+        time.sleep(0.1)
+        self.assertEqual(varstore.Get('c'), 2)
+        self.assertEqual(varstore.Get('c'), 2)
+        self.assertEqual(varstore.CacheStats('c')['misses'], 2)
+
+    def test_not_cached_without_ttl(self):
+        varstore = Varstore({ 'c': { 'desc': 'C', 'value': _counter() } })
+
+        self.assertEqual([ varstore.Get('c') for i in range(3) ], [ 1, 2, 3 ])
+        self.assertIsNone(varstore.CacheStats('c'))
+
+    def test_stale_while_revalidate(self):
+        varstore = Varstore({ 'c': { 'desc': 'C', 'value': _counter(delay=0.05), 'ttl': 0, 'stale_while_revalidate': True } })
+        self.addCleanup(varstore.Close)
+
+        self.assertEqual(varstore.Get('c'), 1)
+
+        # The expired result is returned while one refresh runs
+        start = time.monotonic()
+        self.assertEqual([ varstore.Get('c') for i in range(3) ], [ 1 ] * 3)
+        self.assertLess(time.monotonic() - start, 0.05)
+
+        varstore.Close()
+
+        self.assertEqual(varstore.Get('c'), 2)
+        self.assertEqual(varstore.CacheStats('c')['refreshes'], 1)
+
+    def test_write_invalidates(self):
+        written = []
+        varstore = Varstore({ 'c': { 'desc': 'C', 'value': _counter(written=written), 'ttl': 60 } })
+
+        self.assertEqual(varstore.Get('c'), 1)
+        varstore.Set('c', 10)
+
+        self.assertEqual(written, [ 10 ])
+        self.assertEqual(varstore.Get('c'), 2)
+
+    def test_store_stats(self):
+        varstore = Varstore({ 't': { 'desc': 'T', 'value': {
+            'c': { 'desc': 'C', 'value': _counter(), 'ttl': 60 },
+            'd': { 'desc': 'D', 'value': _counter() },
+        } } }, compact=True)
+
+        varstore.Get('t.c')
+        varstore.Get('t.c')
+
+        self.assertEqual(varstore.CacheStats(), { 't.c': { 'hits': 1, 'misses': 1, 'stale': 0, 'refreshes': 0 } })
+
+class ExportCacheTests(unittest.TestCase):
+    def check_changes_exported(self, snapshots):
+        varstore = Varstore(SAVED_SCHEMA, export_cache=True, snapshots=snapshots)
+
+        self.assertEqual(varstore.Export()['net'], { 'mtu': 1500, 'name': 'eth0' })
+
+        varstore.Set('net.mtu', 2000)
+        self.assertEqual(varstore.Export()['net'], { 'mtu': 2000, 'name': 'eth0' })
+
+        varstore.Apply({ 'net': { 'name': 'eth1' } })
+        self.assertEqual(varstore.Export()['net'], { 'mtu': 2000, 'name': 'eth1' })
+
+        varstore.AddSchema({ 'extra': { 'desc': 'Extra', 'value': 1 } })
+        self.assertEqual(varstore.Export()['extra'], 1)
+
+        varstore.Delete('extra')
+        self.assertNotIn('extra', varstore.Export())
+
+    def test_changes_exported(self):
+        self.check_changes_exported(snapshots=False)
+
+    def test_changes_exported_from_snapshots(self):
+        self.check_changes_exported(snapshots=True)
+
+    def test_unchanged_tables_reused(self):
+        varstore = Varstore(DEEP_SCHEMA, export_cache=True)
+        exported = varstore.Export()
+
+        self.assertIs(varstore.Export(), exported)
+
+        varstore.Set('n.t', 5)
+        changed = varstore.Export()
+
+        self.assertIsNot(changed, exported)
+        self.assertIs(changed['a'], exported['a'])
+        self.assertEqual(changed['n'], { 't': 5 })
+
+    def test_callables_rebuilt(self):
+        schema = { 't': { 'desc': 'T', 'value': { 'c': { 'desc': 'C', 'value': _counter() } } }, 'u': { 'desc': 'U', 'value': { 'x': { 'desc': 'X', 'value': 1 } } } }
+        varstore = Varstore(schema, export_cache=True)
+
+        self.assertEqual(varstore.Export(callables=True)['t']['c'], 1)
+        self.assertEqual(varstore.Export(callables=True)['t']['c'], 2)
+        self.assertIs(varstore.Export(callables=True)['u'], varstore.Export(callables=True)['u'])
+
+    def test_attributes(self):
+        varstore = Varstore(SAVED_SCHEMA, export_cache=True)
+        plain = Varstore(SAVED_SCHEMA)
+
+        self.assertEqual(varstore.GetAttributes(None), plain.GetAttributes(None))
+        self.assertIs(varstore.GetAttributes('net'), varstore.GetAttributes('net'))
+
+        for v in (varstore, plain):
+            v.AddSchema({ 'net': { 'desc': 'Network', 'value': { 'mtu': { 'desc': 'MTU', 'value': 9000 } } } })
+
+        self.assertEqual(varstore.GetAttributes(None), plain.GetAttributes(None))
+        self.assertEqual(varstore.GetAttributes('net'), plain.GetAttributes('net'))
+
+    def test_exports_never_torn(self):
+        varstore = Varstore(PAIR_SCHEMA, export_cache=True, snapshots=True)
+        (reads, torn) = _stress(varstore, lambda: varstore.Export()['a'])
+
+        self.assertGreater(reads, 0)
+        self.assertEqual(torn, 0)
+
+    def test_results_read_only(self):
+        varstore = Varstore(SAVED_SCHEMA, export_cache=True)
+        exported = varstore.Export()
+
+        with self.assertRaises(TypeError):
+            exported['net']['mtu'] = 0
+
+        with self.assertRaises(TypeError):
+            exported.pop('net')
+
+        # Copies can be changed, and results still serialize as plain dicts
+        copied = deepcopy(exported)
+        copied['net']['mtu'] = 0
+
+        self.assertEqual(varstore.Export()['net']['mtu'], 1500)
+        self.assertEqual(json.loads(json.dumps(exported)), exported)
+        self.assertIs(type(pickle.loads(pickle.dumps(exported))), dict)
+
+class QueryTests(unittest.TestCase):
+    def setUp(self):
+        self.varstore = Varstore(DEEP_SCHEMA)
+
+    def test_patterns(self):
+        self.assertEqual(self.varstore.Query('a.b.*'), { 'a.b.c': 1, 'a.b.d': 2 })
+        self.assertEqual(self.varstore.Query('a.b.c'), { 'a.b.c': 1 })
+        self.assertEqual(self.varstore.Query('*.t'), { 'n.t': 4 })
+        self.assertEqual(self.varstore.Query('**.[cd]'), { 'a.b.c': 1, 'a.b.d': 2 })
+        self.assertEqual(self.varstore.Query('a.**'), { 'a': { 'b': { 'c': 1, 'd': 2 } }, 'a.b': { 'c': 1, 'd': 2 }, 'a.b.c': 1, 'a.b.d': 2 })
+        self.assertEqual(self.varstore.Query('x.*'), {})
+
+    def test_protected_left_out(self):
+        self.assertNotIn('a.p', self.varstore.Query('a.*'))
+        self.assertEqual(self.varstore.Query('a.p', protection=NO_PROTECTION), { 'a.p': 3 })
+
+    def test_attributes(self):
+        self.assertEqual(self.varstore.Query('**', attributes=[ 'not_saved' ]), { 'n': { 't': 4 } })
+        self.assertEqual(self.varstore.Query('**', attributes={ 'desc': 'C' }), { 'a.b.c': 1 })
+
+    def test_values_seen(self):
+        self.varstore.Query('**')
+        self.varstore.Set('a.b.c', 10)
+
+        self.assertEqual(self.varstore.Query('a.b.c'), { 'a.b.c': 10 })
+
+    def test_reindexed(self):
+        self.varstore.Query('**')
+
+        self.varstore.AddSchema({ 'a': { 'desc': 'A', 'value': { 'x': { 'desc': 'X', 'value': 5 } } } })
+        self.assertEqual(self.varstore.Query('a.*'), { 'a.x': 5 })
+
+        self.varstore.AddVarstore({ 'm': { 'desc': 'M', 'value': { 'y': { 'desc': 'Y', 'value': 6 } } } })
+        self.assertEqual(self.varstore.Query('m.*'), { 'm.y': 6 })
+
+        self.varstore.Delete('n.t')
+        self.assertEqual(self.varstore.Query('n.*'), {})
+
+        self.varstore.Set('m', 7)
+        self.assertEqual(self.varstore.Query('m.**'), { 'm': 7 })
+
+        self.assertEqual(self.varstore.Query('**'), { 'a': { 'x': 5 }, 'a.x': 5, 'n': {}, 'm': 7 })
+
+    # A write made while the index is being built isn't lost
+    def test_changed_while_indexing(self):
+        varstore = _ChangingVarstore(DEEP_SCHEMA, snapshots=True)
+        varstore.change = lambda: varstore.AddSchema({ 'm': { 'desc': 'M', 'value': { 'y': { 'desc': 'Y', 'value': 6 } } } })
+        self.assertEqual(varstore.Query('m.*'), { 'm.y': 6 })
+
+        varstore.change = lambda: varstore.Set('a', 7, protection=NO_PROTECTION)
+        varstore._dropIndex()
+        self.assertEqual(varstore.Query('a.**'), { 'a': 7 })
+
+# Varstore making a change (once) while the path index is being built
+class _ChangingVarstore(Varstore):
+    change = None
+
+    def _indexTable(self, table, prefix, elements, names):
+        (change, self.change) = (self.change, None)
+        if change is not None:
+            change()
+
+        super(_ChangingVarstore, self)._indexTable(table, prefix, elements, names)
+
+SHARDED_SCHEMA = {
+    'version': { 'desc': 'Version', 'value': 1 },
+    'net': { 'desc': 'Network', 'value': {
+        'mtu': { 'desc': 'MTU', 'value': 1500 },
+        'dns': { 'desc': 'DNS', 'value': {
+            'primary': { 'desc': 'Primary', 'value': '10.0.0.1' },
+        } },
+    } },
+    'disk': { 'desc': 'Disk', 'value': {
+        'size': { 'desc': 'Size', 'value': 100 },
+    } },
+}
+
+# Sharded storage recording the shards it writes
+class _RecordingShardedStorage(VarstoreShardedStorage):
+    def __init__(self, **kwargs):
+        super(_RecordingShardedStorage, self).__init__(**kwargs)
+        self.written = []
+
+    def WriteShards(self, filename, shards):
+        size = super(_RecordingShardedStorage, self).WriteShards(filename, shards)
+        self.written.append(sorted(shards))
+
+        return size
+
+class ShardedStorageTests(_FileTests):
+    def open(self, storage=None, **kwargs):
+        return Varstore(SHARDED_SCHEMA, filename=self.path('store'), storage=storage or VarstoreShardedStorage(), **kwargs)
+
+    def files(self):
+        return sorted(os.path.relpath(os.path.join(dirpath, name), self.path('store')) for (dirpath, dirnames, filenames) in os.walk(self.path('store')) for name in filenames)
+
+    def test_layout(self):
+        self.open().Save(propagate=False)
+
+        self.assertEqual(self.files(), [ '@.json', '@manifest', 'disk.json', 'net.json' ])
+
+        deeper = self.open(storage=VarstoreShardedStorage(depth=2))
+        shutil.rmtree(self.path('store'))
+        deeper.Save(propagate=False)
+
+        self.assertEqual(self.files(), [ '@.json', '@manifest', os.path.join('disk', '@.json'), os.path.join('net', '@.json'), os.path.join('net', 'dns.json') ])
+
+    def test_round_trip(self):
+        for snapshots in (False, True):
+            with self.subTest(snapshots=snapshots):
+                varstore = self.open(snapshots=snapshots)
+                varstore.Save(propagate=False)
+                varstore.Set('net.dns.primary', '10.0.0.2')
+                varstore.Set('version', 2)
+
+                loaded = self.open()
+                loaded.Load(propagate=False)
+
+                self.assertEqual(loaded.Export(), varstore.Export())
+
+    def test_changed_shards_written(self):
+        for snapshots in (False, True):
+            with self.subTest(snapshots=snapshots):
+                storage = _RecordingShardedStorage()
+                varstore = self.open(storage=storage, snapshots=snapshots)
+                varstore.Save(propagate=False)
+                del storage.written[:]
+
+                varstore.Set('net.mtu', 2000)
+                varstore.Set('version', 2)
+
+                self.assertEqual(storage.written, [ [ (('net',), False) ], [ ((), True) ] ])
+
+    def test_quoted_names_tracked(self):
+        storage = _RecordingShardedStorage(depth=2)
+        varstore = self.open(storage=storage)
+        varstore.AddSchema({ 'hosts': { 'desc': 'Hosts', 'value': { 'a.example': { 'desc': 'Host', 'value': { 'port': { 'desc': 'Port', 'value': 1 } } } } } })
+        varstore.Save(propagate=False)
+        del storage.written[:]
+
+        varstore.Set('hosts."a.example".port', 2)
+        varstore.Set('net.dns.primary', '10.0.0.2')
+
+        self.assertEqual(storage.written, [ [ (('hosts', 'a.example'), False) ], [ (('net', 'dns'), False) ] ])
+
+        loaded = self.open(storage=VarstoreShardedStorage(depth=2))
+        loaded.AddSchema({ 'hosts': { 'desc': 'Hosts', 'value': { 'a.example': { 'desc': 'Host', 'value': { 'port': { 'desc': 'Port', 'value': 1 } } } } } })
+        loaded.Load(propagate=False)
+
+        self.assertEqual(loaded.Get('hosts."a.example".port'), 2)
+
+    def test_deleted_table_removed(self):
+        varstore = self.open()
+        varstore.Save(propagate=False)
+
+        varstore.Delete('disk')
+
+        self.assertEqual(self.files(), [ '@.json', '@manifest', 'net.json' ])
+
+    def test_unrelated_files_kept(self):
+        self.open().Save(propagate=False)
+
+        for name in ('notes.json', os.path.join('net', 'extra.json'), os.path.join('other', 'data.json')):
+            os.makedirs(os.path.dirname(self.path(os.path.join('store', name))), exist_ok=True)
+            with open(self.path(os.path.join('store', name)), 'w') as f:
+                f.write('{ "mtu": 1 }\n')
+
+        # A full save with another layout leaves the shards of the old one stale
+        deeper = self.open(storage=VarstoreShardedStorage(depth=2))
+        deeper.Set('net.mtu', 2000)
+        deeper.Save(propagate=False)
+        deeper.Delete('disk')
+
+        self.assertEqual(self.files(), [ '@.json', '@manifest', os.path.join('net', '@.json'), os.path.join('net', 'dns.json'), os.path.join('net', 'extra.json'), 'notes.json', os.path.join('other', 'data.json') ])
+
+        loaded = self.open(storage=VarstoreShardedStorage(depth=2))
+        loaded.Load(propagate=False)
+
+        self.assertEqual(loaded.Get('net'), deeper.Get('net'))
+        self.assertEqual(loaded.Get('version'), 1)
+
+    def test_without_manifest(self):
+        varstore = self.open()
+        varstore.Set('net.mtu', 2000)
+        os.unlink(self.path(os.path.join('store', '@manifest')))
+
+        loaded = self.open()
+        loaded.Load(propagate=False)
+        self.assertEqual(loaded.Get('net.mtu'), 2000)
+
+        # The files found are listed from then on
+        loaded.Set('version', 2)
+        with open(self.path(os.path.join('store', '@manifest'))) as f:
+            self.assertEqual(json.load(f), [ '@.json', 'disk.json', 'net.json' ])
+
+class ApplyChangesetTests(_FileTests):
+    # Each test runs with and without the export cache
+    def stores(self, **kwargs):
+        for export_cache in (False, True):
+            with self.subTest(export_cache=export_cache):
+                storage = _CountingStorage()
+                yield (Varstore(SAVED_SCHEMA, filename=self.path('store%d.json' % export_cache), storage=storage, export_cache=export_cache, **kwargs), storage)
+
+    def test_changeset(self):
+        for (varstore, storage) in self.stores():
+            changeset = varstore.Apply({ 'net': { 'mtu': 2000, 'name': 'eth0' }, 'tmp': 1, 'cache': { 'hits': 5 } })
+
+            self.assertEqual(changeset, { 'net.mtu': 2000, 'cache.hits': 5 })
+            self.assertEqual(varstore.Get('net.mtu'), 2000)
+            self.assertEqual(storage.writes, 1)
+
+            self.assertEqual(varstore.Apply({ 'name': 'eth1' }, var='net'), { 'net.name': 'eth1' })
+
+    def test_unchanged_does_nothing(self):
+        for (varstore, storage) in self.stores():
+            changes = []
+            varstore.Subscribe(None, lambda path, value: changes.append(path))
+            exported = varstore.Export(protection=NO_PROTECTION)
+
+            self.assertEqual(varstore.Apply(exported), {})
+            self.assertEqual(varstore.Apply({ 'mtu': 1500 }, var='net'), {})
+            varstore.Close()
+
+            self.assertEqual(storage.writes, 0)
+            self.assertEqual(changes, [])
+
+    def test_changes_still_checked(self):
+        for (varstore, storage) in self.stores():
+            varstore.Export()
+
+            self.assertEqual(varstore.Apply({ 'net': { 'mtu': 100 } }), { 'net.mtu': 576 })
+
+class StatsTests(_FileTests):
+    def test_not_instrumented(self):
+        varstore = Varstore(SAVED_SCHEMA)
+
+        self.assertIsNone(varstore.Stats())
+        self.assertNotIn('Get', vars(varstore))
+
+    def test_operations(self):
+        for snapshots in (False, True):
+            with self.subTest(snapshots=snapshots):
+                varstore = Varstore(SAVED_SCHEMA, filename=self.path('store%d.json' % snapshots), snapshots=snapshots, instrument=True)
+
+                for i in range(3):
+                    varstore.Get('net.mtu')
+                varstore.Get('net.name')
+                varstore.Set('net.mtu', 2000)
+
+                stats = varstore.Stats()
+
+                self.assertEqual(stats['operations']['Get']['count'], 4)
+                self.assertEqual(stats['operations']['Set']['count'], 1)
+                self.assertEqual(sum(stats['operations']['Get']['buckets'].values()), 4)
+                self.assertEqual(stats['hot_vars']['Get'], [ ('net.mtu', 3), ('net.name', 1) ])
+                self.assertGreater(stats['lock_wait']['store']['count'], 0)
+
+                self.assertEqual(stats['save_bytes']['count'], 1)
+                self.assertEqual(stats['save_bytes']['total'], os.path.getsize(self.path('store%d.json' % snapshots)))
+
+    # Bytes written by each backend, journal records and shards included
+    def test_storage_bytes(self):
+        varstore = Varstore(SAVED_SCHEMA, filename=self.path('journal.json'), storage=VarstoreJournalStorage(), instrument=True)
+        varstore.Save()
+        varstore.Set('net.name', 'ethé')
+        varstore.Set('net.mtu', 2000)
+
+        stats = varstore.Stats()
+        self.assertEqual(stats['save_bytes']['count'], 3)
+        self.assertEqual(stats['save_bytes']['total'], os.path.getsize(self.path('journal.json')) + os.path.getsize(self.path('journal.json.journal')))
+
+        varstore = Varstore(SHARDED_SCHEMA, filename=self.path('sharded'), storage=VarstoreShardedStorage(), instrument=True)
+        varstore.Save()
+
+        files = [ os.path.join(dirpath, name) for (dirpath, dirnames, filenames) in os.walk(self.path('sharded')) for name in filenames ]
+        self.assertEqual(varstore.Stats()['save_bytes']['total'], sum(os.path.getsize(path) for path in files))
+
+        varstore = Varstore(SAVED_SCHEMA, filename=self.path('store.bin'), storage=VarstoreBinaryStorage(), instrument=True)
+        varstore.Set('net.name', 'ethé')
+        self.assertEqual(varstore.Stats()['save_bytes']['total'], os.path.getsize(self.path('store.bin')))
+
+    def test_callables(self):
+        varstore = Varstore({ 'c': { 'desc': 'C', 'value': _counter() } }, instrument=True)
+        varstore.Get('c')
+
+        self.assertEqual(sum(h['count'] for h in varstore.Stats()['callables'].values()), 1)
+
+    def test_reset(self):
+        varstore = Varstore(SAVED_SCHEMA, instrument=True)
+        varstore.Get('net.mtu')
+
+        self.assertEqual(varstore.Stats(reset=True)['operations']['Get']['count'], 1)
+        self.assertEqual(varstore.Stats()['operations'], {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+#
+# Varstore server and client tests
+#
+# python -m unittest discover tests (with the modules installed as aoutils)
+#
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import itertools
+from aoutils.varstore import *
+from aoutils.varstoreserver import VarstoreServer, VarstoreClient
+
+# Varstore counting the Get()s it serves
+class _CountingVarstore(Varstore):
+    def __init__(self, *args, **kwargs):
+        self.gets = 0
+        super(_CountingVarstore, self).__init__(*args, **kwargs)
+
+    def Get(self, var, **kwargs):
+        self.gets += 1
+        return super(_CountingVarstore, self).Get(var, **kwargs)
+
+# Wait for changes pushed to the clients: returns the last result of 'get'
+def _eventually(get, expected, timeout=5):
+    deadline = time.monotonic() + timeout
+    value = get()
+
+    while value != expected and time.monotonic() < deadline:
+        time.sleep(0.01)
+        value = get()
+
+    return value
+
+class ClientCacheTests(unittest.TestCase):
+    def setUp(self):
+        ticks = itertools.count()
+
+        self.schema = {
+            'net': { 'desc': 'Network', 'value': {
+                'mtu': { 'desc': 'MTU', 'value': 1500, 'range': [ 576, 9000 ] },
+                'name': { 'desc': 'Name', 'value': 'eth0' },
+            } },
+            'clock': { 'desc': 'Clock', 'value': lambda op, var: next(ticks) },
+            'status': { 'desc': 'Status', 'value': {
+                'uptime': { 'desc': 'Uptime', 'value': lambda op, var: next(ticks) },
+            } },
+        }
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.filename = os.path.join(directory, 'store.json')
+
+        self.varstore = _CountingVarstore(self.schema, filename=self.filename)
+        self.addCleanup(self.varstore.Close)
+
+        self.server = VarstoreServer(self.varstore, os.path.join(directory, 'varstore.sock'))
+        self.server.Start()
+        self.addCleanup(self.server.Close)
+
+        self.client = VarstoreClient(os.path.join(directory, 'varstore.sock'), timeout=5)
+        self.addCleanup(self.client.Close)
+
+    def test_get_cached(self):
+        self.assertEqual(self.client.Get('net.mtu'), 1500)
+        self.assertEqual(self.client.Get('net.mtu'), 1500)
+        self.assertEqual(self.varstore.gets, 1)
+
+    def test_cached_values_are_copies(self):
+        self.client.Get('net')['mtu'] = 0
+
+        self.assertEqual(self.client.Get('net'), { 'mtu': 1500, 'name': 'eth0' })
+
+    def test_server_change_invalidates(self):
+        self.client.Get('net.mtu')
+        self.client.Get('net')
+
+        self.varstore.Set('net.mtu', 2000)
+
+        self.assertEqual(_eventually(lambda: self.client.Get('net.mtu'), 2000), 2000)
+        self.assertEqual(_eventually(lambda: self.client.Get('net'), { 'mtu': 2000, 'name': 'eth0' }), { 'mtu': 2000, 'name': 'eth0' })
+
+    def test_client_change_seen_at_once(self):
+        self.client.Get('net')
+
+        self.client.Set('net.name', 'eth1')
+
+        self.assertEqual(self.client.Get('net'), { 'mtu': 1500, 'name': 'eth1' })
+
+    # Only the changed var and the tables above and below it are dropped
+    def test_change_drops_related(self):
+        for var in ('net', 'net.mtu', 'net.name'):
+            self.client.Get(var)
+
+        self.client.Set('net.mtu', 2000)
+        gets = self.varstore.gets
+
+        self.assertEqual(self.client.Get('net.name'), 'eth0')
+        self.assertEqual(self.varstore.gets, gets)
+
+        self.assertEqual(self.client.Get('net.mtu'), 2000)
+        self.assertEqual(self.client.Get('net'), { 'mtu': 2000, 'name': 'eth0' })
+        self.assertEqual(self.varstore.gets, gets + 2)
+
+        # Dropping a table drops the vars cached below it
+        self.client.Apply({ 'mtu': 3000 }, var='net')
+        self.assertEqual(self.client.Get('net.mtu'), 3000)
+        self.assertEqual(self.client.Get('net.name'), 'eth0')
+        self.assertEqual(self.varstore.gets, gets + 4)
+
+    def test_methods(self):
+        self.client.SetMany({ 'net.mtu': 2000, 'net.name': 'eth1' })
+        self.assertEqual(self.varstore.Get('net'), { 'mtu': 2000, 'name': 'eth1' })
+
+        self.client.Apply({ 'net': { 'mtu': 3000 } })
+        self.assertEqual(self.client.Query('net.*'), { 'net.mtu': 3000, 'net.name': 'eth1' })
+        self.assertEqual(self.client.Export(), self.varstore.Export())
+        self.assertEqual(self.client.GetAttributes('net'), self.varstore.GetAttributes('net'))
+
+        self.client.Save()
+        with open(self.filename) as f:
+            self.assertIn('3000', f.read())
+
+    def test_delete_resets(self):
+        self.client.Get('net')
+
+        self.client.Delete('net.name')
+
+        self.assertEqual(self.client.Get('net'), { 'mtu': 1500 })
+
+    def test_volatile_not_cached(self):
+        self.assertNotEqual(self.client.Get('clock'), self.client.Get('clock'))
+        self.assertNotEqual(self.client.Get('status'), self.client.Get('status'))
+        self.assertTrue(self.varstore.IsVolatile('status'))
+        self.assertFalse(self.varstore.IsVolatile('net'))
+
+    def test_structure_change_resets(self):
+        self.client.Get('net')
+        self.client.Get('net.mtu')
+
+        # Replaces the 'net' table
+        self.varstore.AddSchema({ 'net': { 'desc': 'Network', 'value': {
+            'mtu': { 'desc': 'MTU', 'value': 9000 },
+            'gateway': { 'desc': 'Gateway', 'value': '10.0.0.1' },
+        } } })
+
+        expected = { 'mtu': 9000, 'gateway': '10.0.0.1' }
+        self.assertEqual(_eventually(lambda: self.client.Get('net'), expected), expected)
+        self.assertEqual(self.client.Get('net.mtu'), 9000)
+
+        self.varstore.Delete('net.gateway')
+
+        expected = { 'mtu': 9000 }
+        self.assertEqual(_eventually(lambda: self.client.Get('net'), expected), expected)
+
+    def test_server_options_rejected(self):
+        with self.assertRaises(VarstoreException):
+            self.client.Set('net.mtu', 100, protection=NO_PROTECTION)
+
+        with self.assertRaises(VarstoreException):
+            self.client.Save(filename=self.filename + '.other')
+
+        with self.assertRaises(VarstoreException):
+            self.client.Export(protection=NO_PROTECTION)
+
+        self.assertEqual(self.client.Get('net.mtu'), 1500)
+        self.assertFalse(os.path.exists(self.filename + '.other'))
+
+    def test_errors_raised(self):
+        with self.assertRaises(VarstoreExceptionRange):
+            self.client.Set('net.mtu', 100)
+
+        with self.assertRaises(VarstoreExceptionUndefinedVar):
+            self.client.Get('net.nothing')
+
+if __name__ == '__main__':
+    unittest.main()
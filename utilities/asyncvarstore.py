@@ -0,0 +1,110 @@
+#
+# Asyncio front-end for Varstore
+#
+
+import asyncio
+import functools
+from aoutils.varstore import Varstore, VarstoreException
+
+# Awaitable access to a Varstore.  Blocking work (file I/O and user-supplied functions) is
+# run in an executor so the event loop is never held up.  The Varstore ('varstore') can be
+# shared with threads using it directly.
+#
+# Coroutine functions can be used as callable values, 'publish' hooks and propagate targets.
+# They are run on the event loop while the thread that called them waits for the result.
+class AsyncVarstore():
+    def __init__(self, varstore=None, executor=None, loop=None, **kwargs):
+        self.varstore = varstore if varstore is not None else Varstore(**kwargs)
+        self._executor = executor
+        self._loop = None
+
+        # Save() being written and the one that follows it (joined by all callers meanwhile)
+        self._saving = None
+        self._next_save = None
+
+        if loop is not None:
+            self._attach(loop)
+
+    def _attach(self, loop):
+        self._loop = loop
+        self.varstore.SetAwaiter(self._await)
+
+    # Run 'awaitable' on the event loop and wait for the result (from any other thread)
+    def _await(self, awaitable):
+        try:
+            running = asyncio.get_running_loop()
+
+        except RuntimeError:
+            running = None
+
+        if running is self._loop or self._loop.is_closed():
+            if hasattr(awaitable, 'close'):
+                awaitable.close()
+
+            raise VarstoreException("Coroutine function called from the event loop thread")
+
+        return asyncio.run_coroutine_threadsafe(_awaited(awaitable), self._loop).result()
+
+    async def _run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+
+        if self._loop is None:
+            self._attach(loop)
+
+        return await loop.run_in_executor(self._executor, functools.partial(function, *args, **kwargs))
+
+    async def get(self, var, **kwargs):
+        return await self._run(self.varstore.Get, var, **kwargs)
+
+    async def set(self, var, value, **kwargs):
+        return await self._run(self.varstore.Set, var, value, **kwargs)
+
+    async def set_many(self, changes, **kwargs):
+        return await self._run(self.varstore.SetMany, changes, **kwargs)
+
+    async def apply(self, changes, **kwargs):
+        return await self._run(self.varstore.Apply, changes, **kwargs)
+
+    async def export(self, **kwargs):
+        return await self._run(self.varstore.Export, **kwargs)
+
+    async def load(self, filename=None, **kwargs):
+        return await self._run(self.varstore.Load, filename, **kwargs)
+
+    # Concurrent saves of the store to its own file are written once: callers arriving while
+    # a save is being written share the single save that follows it.
+    async def save(self, **kwargs):
+        if kwargs:
+            return await self._run(self.varstore.Save, **kwargs)
+
+        if self._next_save is None:
+            self._next_save = asyncio.ensure_future(self._coalescedSave())
+
+        return await asyncio.shield(self._next_save)
+
+    async def _coalescedSave(self):
+        # Changes made while a save is written may not be in it
+        if self._saving is not None:
+            await asyncio.wait([ self._saving ])
+
+        self._saving = self._next_save
+        self._next_save = None
+
+        try:
+            return await self._run(self.varstore.Save)
+
+        finally:
+            self._saving = None
+
+    async def flush(self):
+        return await self._run(self.varstore.Flush)
+
+    async def close(self):
+        if self._next_save is not None:
+            await asyncio.wait([ self._next_save ])
+
+        await self._run(self.varstore.Close)
+        self.varstore.SetAwaiter(None)
+
+async def _awaited(awaitable):
+    return await awaitable
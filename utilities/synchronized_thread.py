@@ -1,23 +1,371 @@
 # -*- coding: utf-8 -*-
-from threading import Thread, Lock, current_thread, Timer
+from threading import Thread, Lock, Condition, current_thread
+from collections import deque
 import queue
 import time
+import heapq
+import itertools
+import asyncio
+import multiprocessing
+from concurrent.futures import CancelledError
 # import traceback
 import syslog
 
+# Message priorities (lanes of a thread's queue, most urgent first)
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = range(3)
+
+# What a thread's queue does with a message that arrives when it is full
+OVERFLOW_BLOCK = 'block'              # Sender waits (for up to overflow_timeout, then the message is dropped)
+OVERFLOW_DROP_NEWEST = 'drop_newest'  # The arriving message is dropped
+OVERFLOW_DROP_OLDEST = 'drop_oldest'  # The oldest message of the same or a lower priority is dropped
+OVERFLOW_COALESCE = 'coalesce'        # A message with a key replaces the queued one with that key (at any
+                                      # time); when full other messages are dropped
+
+# Registered threads by name.  The dict is never changed once published: registering or
+# removing a thread builds a new one under _thread_objects_lock, so senders look names up
+# (and broadcast) without taking any lock.
 _thread_objects_lock = Lock()
 _thread_objects = {}
 
+def _register_thread(name, thread):
+    global _thread_objects
+
+    _thread_objects_lock.acquire()
+
+    try:
+        if name in _thread_objects:
+            return False
+
+        objects = dict(_thread_objects)
+        objects[name] = thread
+        _thread_objects = objects
+
+        return True
+
+    finally:
+        _thread_objects_lock.release()
+
+def _unregister_thread(name, thread):
+    global _thread_objects
+
+    _thread_objects_lock.acquire()
+
+    try:
+        if _thread_objects.get(name) is not thread:
+            return False
+
+        objects = dict(_thread_objects)
+        del objects[name]
+        _thread_objects = objects
+
+        return True
+
+    finally:
+        _thread_objects_lock.release()
+
+#
+# A reference to a named thread that senders can keep to skip the name lookup on each send.
+# If the thread it refers to has exited, the name is looked up again (e.g. for a thread
+# restarted under the same name).
+#
+class ThreadHandle():
+    def __init__(self, name):
+        self.name = name
+        self._thread = None
+
+    def __str__(self):
+        return self.name
+
+    def resolve(self):
+        thread = self._thread
+
+        if thread is None or not thread._registered:
+            thread = _thread_objects.get(self.name)
+            self._thread = thread
+
+        return thread
+
+    def send(self, message, reply=False, timeout=None, reply_token='reply', priority=PRIORITY_NORMAL, key=None, order=None):
+        return send_message(message, to=self, reply=reply, timeout=timeout, reply_token=reply_token, priority=priority, key=key, order=order)
+
+def get_thread_handle(name):
+    return ThreadHandle(name)
+
+# Thread for a name or ThreadHandle (None if there isn't one)
+def _lookup_thread(to):
+    if isinstance(to, ThreadHandle):
+        return to.resolve()
+
+    return _thread_objects.get(to)
+
+# Failure to deliver a request
+class ThreadMessageException(Exception):
+    pass
+
+# Locks of finished ReplyFutures kept for reuse: (signal, mutex) pairs with the signal held
+_reply_slots = []
+REPLY_SLOTS_MAX = 256
+
+PENDING, RUNNING, DONE, CANCELLED = range(4)
+
+#
+# Reply to a request().  The handler's results (or the exception raised by it) are taken
+# with result() / exception(); add_done_callback() registers functions called (with the future)
+# once it has completed.  Waiting uses locks from a pool rather than a queue per request: they
+# return to the pool once both the handler and the sender are done with the future (the
+# sender is once result() or exception() has returned or timed out).  The futures themselves
+# aren't reused; the locks of one whose result is never asked for are left to the garbage
+# collector.
+#
+class ReplyFuture():
+    __slots__ = ('_signal', '_mutex', '_state', '_value', '_error', '_callbacks', '_sender', '_handler', '_waiters')
+
+    def __init__(self):
+        try:
+            (self._signal, self._mutex) = _reply_slots.pop()
+
+        except IndexError:
+            self._signal = Lock()
+            self._signal.acquire()
+            self._mutex = Lock()
+
+        self._state = PENDING
+        self._value = None
+        self._error = None
+        self._callbacks = None
+
+        # Holders of the future: the slot is released when none are
+        self._sender = True
+        self._handler = True
+        self._waiters = 0
+
+    def done(self):
+        return self._state >= DONE
+
+    def cancelled(self):
+        return self._state == CANCELLED
+
+    # Cancel a request the handler hasn't started
+    def cancel(self):
+        if self._state >= DONE:
+            return self._state == CANCELLED
+
+        self._mutex.acquire()
+
+        if self._state != PENDING:
+            self._mutex.release()
+            return self._state == CANCELLED
+
+        self._state = CANCELLED
+        self._error = CancelledError()
+
+        return self._complete()
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+
+        if self._error is not None:
+            raise self._error
+
+        return self._value
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+
+        return self._error
+
+    def add_done_callback(self, function):
+        if self._state < DONE:
+            self._mutex.acquire()
+
+            if self._state < DONE:
+                if self._callbacks is None:
+                    self._callbacks = []
+
+                self._callbacks.append(function)
+                self._mutex.release()
+                return
+
+            self._mutex.release()
+
+        function(self)
+
+    def _wait(self, timeout):
+        mutex = self._mutex
+
+        if self._state < DONE and mutex is not None:
+            mutex.acquire()
+            waiting = self._state < DONE
+            if waiting:
+                self._waiters += 1
+            mutex.release()
+
+            if waiting:
+                # The signal is released when the future completes (and again by each waiter)
+                signalled = self._signal.acquire(timeout=-1 if timeout is None else timeout)
+                if signalled:
+                    self._signal.release()
+
+                self._release('_waiters')
+
+                if not signalled:
+                    # Waiting again holds the locks again
+                    self._release('_sender')
+                    raise TimeoutError("No reply within %s seconds" % timeout)
+
+        self._release('_sender')
+
+    # Called by the handling thread before it runs the request: False if cancelled
+    def _begin(self):
+        self._mutex.acquire()
+
+        if self._state == CANCELLED:
+            self._mutex.release()
+            self._release('_handler')
+            return False
+
+        self._state = RUNNING
+        self._mutex.release()
+
+        return True
+
+    # Called by the handling thread with its results or exception
+    def _finish(self, value, error=None):
+        self._mutex.acquire()
+
+        if self._state < DONE:
+            self._state = DONE
+            self._value = value
+            self._error = error
+            self._complete()
+
+        else:
+            self._mutex.release()
+
+        self._release('_handler')
+
+    # Wake the waiters and run the callbacks (entered holding the mutex)
+    def _complete(self):
+        callbacks = self._callbacks
+        self._callbacks = None
+
+        self._signal.release()
+        self._mutex.release()
+
+        for function in callbacks or ():
+            try:
+                function(self)
+
+            except Exception as e:
+                syslog.syslog("ReplyFuture callback exception '%s' (%s)" % (str(e), type(e)))
+
+        return True
+
+    def _release(self, holder):
+        mutex = self._mutex
+        if mutex is None:
+            return
+
+        mutex.acquire()
+
+        if holder == '_waiters':
+            self._waiters -= 1
+        else:
+            setattr(self, holder, False)
+
+        free = not (self._sender or self._handler or self._waiters) and self._signal is not None
+
+        if free:
+            slot = (self._signal, mutex)
+            self._signal = None
+            self._mutex = None
+
+        mutex.release()
+
+        if free and len(_reply_slots) < REPLY_SLOTS_MAX:
+            # Held again until the next future completes
+            slot[0].acquire()
+            _reply_slots.append(slot)
+
+#
+# Send <message> to thread <to> (a name or ThreadHandle) and return a ReplyFuture for the
+# value returned by its message() (or the exception raised by it).  Any number of requests
+# can be outstanding.  <order> is as for send_message().
+#
+def request(message, to, priority=PRIORITY_NORMAL, order=None):
+    future = ReplyFuture()
+
+    if not isinstance(message, (list, tuple)):
+        future._finish(None, ThreadMessageException("Invalid message format %s to %s" % (message, to)))
+
+    else:
+        thread = _lookup_thread(to)
+
+        if thread is None:
+            future._finish(None, ThreadMessageException("Thread '%s' not in _thread_objects" % to))
+
+        else:
+            packet = { 'data': message, 'from': current_thread().name, 'reply_to': future }
+            if order is not None:
+                packet['order'] = order
+
+            thread._queue.put(packet, priority=priority, order=order)
+
+    return future
+
+#
+# request() for asyncio code: waits for the reply without using an executor thread.  With
+# <timeout> (seconds) asyncio.TimeoutError is raised if there is no reply in time.  Cancelling
+# the awaiting task (or a timeout) cancels the request if the handler hasn't started it.
+#
+async def request_async(message, to, timeout=None, priority=PRIORITY_NORMAL, order=None):
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+    future = request(message, to, priority, order)
+
+    def transfer(future):
+        if not waiter.done():
+            try:
+                waiter.set_result(future.result())
+
+            except BaseException as e:
+                waiter.set_exception(e)
+
+        else:
+            # Nobody is waiting: just release the future
+            future.exception()
+
+    def done(future):
+        try:
+            loop.call_soon_threadsafe(transfer, future)
+
+        except RuntimeError:
+            # Loop closed
+            future.exception()
+
+    future.add_done_callback(done)
+
+    try:
+        return await asyncio.wait_for(waiter, timeout)
+
+    except (asyncio.CancelledError, asyncio.TimeoutError):
+        future.cancel()
+        raise
+
 #
 # Send a message to a thread:
 #  <message> is the contents (a dictionary)
-#  <to> is the destination thread name
-#  <reply> if True, tacks on a 'reply_to' dictionary item and send waits for <timeout> seconds before Empty exception
-#  if <reply> is a string, then the reply message will be delivered to the <reply> thread name with the <reply_token>
+#  <to> is the destination thread name (or a ThreadHandle)
+#  <reply> if True, send waits for <timeout> seconds for the results (see request()); a timeout or an exception
+#  raised by the receiver returns { 'error': <text> }
+#  if <reply> is a string (or ThreadHandle), then the reply message will be delivered to the <reply> thread name with the <reply_token>
 #  placed at the first element of a tuple, formed by [ <reply_token> <reply message> ]
 # <reply_token) is only used if <reply> is a string and is used to build the reply message to the <reply> thread.
+# <priority> is the PRIORITY_ lane of the receiver's queue the message is put in.
+# <key> identifies messages that replace one another in the queue of a thread with the OVERFLOW_COALESCE policy.
+# <order> sends messages with the same <order> to one worker of a SynchronizedThreadPool, so they are handled in turn.
 #
-def send_message(message, to=None, reply=False, timeout=None, reply_token='reply'):
+def send_message(message, to=None, reply=False, timeout=None, reply_token='reply', priority=PRIORITY_NORMAL, key=None, order=None):
     results = None
 
     # print ("send_message from '%s' to '%s' %s (reply %s timeout %s)" % (current_thread().name, to, message, reply, timeout))
@@ -29,39 +377,31 @@ def send_message(message, to=None, reply=False, timeout=None, reply_token='reply
 
         else:
             packet = { 'data': message, 'from': current_thread().name }
+            if order is not None:
+                packet['order'] = order
 
             if to == None:
                 # Send to all
-                _thread_objects_lock.acquire()
-
-                for name in _thread_objects:
-                    thread = _thread_objects[name]
-                    thread._queue.put(packet)
-
-                _thread_objects_lock.release()
+                for thread in _thread_objects.values():
+                    thread._queue.put(packet, priority=priority, key=key, order=order)
 
             else:
                 if reply == True:
-                    # Reply to local queue and block for results
-                    reply_queue = queue.Queue()
-                    packet['reply_to'] = reply_queue
-
-                elif isinstance(reply, str):
-                    # Reply back to another thread
-                    packet['reply_to'] = reply
-                    packet['reply_token'] = reply_token
+                    # Block for the results
+                    results = request(message, to, priority, order).result(timeout)
 
-                _thread_objects_lock.acquire()
-
-                if to in _thread_objects:
-                    _thread_objects[to]._queue.put(packet)
                 else:
-                    syslog.syslog("Thread '%s' not in _thread_objects" % to)
+                    if isinstance(reply, (str, ThreadHandle)):
+                        # Reply back to another thread
+                        packet['reply_to'] = reply
+                        packet['reply_token'] = reply_token
 
-                _thread_objects_lock.release()
+                    thread = _lookup_thread(to)
 
-                if reply == True:
-                    results = reply_queue.get(timeout=timeout)
+                    if thread is not None:
+                        thread._queue.put(packet, priority=priority, key=key, order=order)
+                    else:
+                        syslog.syslog("Thread '%s' not in _thread_objects" % to)
 
     except Exception as e:
         syslog.syslog("send_message exception '%s' (%s)" % (str(e), type(e)))
@@ -70,21 +410,525 @@ def send_message(message, to=None, reply=False, timeout=None, reply_token='reply
 
     return results
 
+#
+# Message queue of a SynchronizedThreadWithQueue: a FIFO lane per priority, taken most urgent
+# first, holding up to <max_queue> messages in all (0 for no limit).  Messages that can't be
+# queued under the <overflow> policy are dropped (and requests waiting on them fail).
+#
+class _Mailbox():
+    def __init__(self, name, max_queue=0, overflow=OVERFLOW_BLOCK, overflow_timeout=None, workers=0):
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST, OVERFLOW_COALESCE):
+            raise ValueError("Unknown overflow policy '%s'" % overflow)
+
+        self._name = name
+        self._max_queue = max_queue
+        self._overflow = overflow
+        self._overflow_timeout = overflow_timeout
+        self.workers = workers
+
+        # Lanes taken by any worker, and each worker's own (for messages with an order key)
+        self._lanes = [ deque() for priority in (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW) ]
+        self._own = [ [ deque() for priority in (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW) ] for worker in range(workers) ]
+        self._shared_size = 0
+        self._own_sizes = [ 0 ] * workers
+        self._size = 0
+        self._keys = {}
+
+        # Pending exit requests: { worker: [ packet, [ [ lane, messages ahead, owner ], ... ] ] }
+        # with the lanes most urgent first (owner is None for shared lanes)
+        self._exits = {}
+
+        # Conditions are only notified when someone waits on them (notify() itself isn't cheap):
+        # waiting workers are listed in _idle and taken off it when woken.
+        self.mutex = Lock()
+        self._wakeups = [ Condition(self.mutex) for worker in range(max(workers, 1)) ]
+        self._idle = []
+        self._not_full = Condition(self.mutex)
+        self._putters = 0
+
+        self._high_water = 0
+        self._dropped = 0
+        self._coalesced = 0
+        self._blocked = 0
+
+    # Queue <packet>: False if it was dropped.
+    # Messages with the same <order> are all taken by one worker (in turn); <worker> picks it.
+    def put(self, packet, block=True, timeout=None, priority=PRIORITY_NORMAL, key=None, order=None, worker=None):
+        dropped = None
+        priority = min(max(priority, PRIORITY_HIGH), PRIORITY_LOW)
+
+        if self.workers and order is not None and worker is None:
+            worker = hash(order) % self.workers
+
+        lanes = self._lanes if worker is None else self._own[worker]
+        lane = lanes[priority]
+
+        self.mutex.acquire()
+
+        try:
+            if key is not None and self._overflow == OVERFLOW_COALESCE:
+                queued = self._keys.get(key)
+
+                if queued is not None:
+                    # Takes the place of the queued message (keyed messages are queued as copies,
+                    # so this never changes a packet shared by a broadcast)
+                    dropped = dict(queued)
+                    queued.clear()
+                    queued.update(packet)
+                    queued['key'] = key
+                    self._coalesced += 1
+
+                    return True
+
+            if self._max_queue > 0 and self._size >= self._max_queue:
+                if self._overflow == OVERFLOW_BLOCK and block:
+                    self._blocked += 1
+
+                    if timeout is None:
+                        timeout = self._overflow_timeout
+
+                    deadline = None if timeout is None else time.monotonic() + timeout
+
+                    while self._size >= self._max_queue:
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if remaining is not None and remaining <= 0:
+                            break
+
+                        self._putters += 1
+                        self._not_full.wait(remaining)
+                        self._putters -= 1
+
+                elif self._overflow == OVERFLOW_DROP_OLDEST:
+                    # From the least urgent lane no more urgent than the message
+                    for victims in reversed(lanes):
+                        if victims:
+                            dropped = victims.popleft()
+                            self._taken(victims)
+                            self._removed(dropped, worker)
+                            self._dropped += 1
+                            break
+
+                        if victims is lane:
+                            break
+
+                if self._size >= self._max_queue:
+                    dropped = packet
+                    self._dropped += 1
+
+                    return False
+
+            if key is not None and self._overflow == OVERFLOW_COALESCE:
+                packet = dict(packet)
+                packet['key'] = key
+                self._keys[key] = packet
+
+            lane.append(packet)
+            self._size += 1
+
+            if self._size > self._high_water:
+                self._high_water = self._size
+
+            if worker is None:
+                self._shared_size += 1
+
+                if self._idle:
+                    self._wakeups[self._idle.pop()].notify()
+
+            else:
+                self._own_sizes[worker] += 1
+
+                if worker in self._idle:
+                    self._idle.remove(worker)
+                    self._wakeups[worker].notify()
+
+            return True
+
+        finally:
+            self.mutex.release()
+
+            if dropped is not None:
+                _drop(dropped, self._name)
+
+    def put_nowait(self, packet, **kwargs):
+        return self.put(packet, block=False, **kwargs)
+
+    # Have <worker> take <packet> once every message it could take now has been taken.  Until
+    # then it only takes those (most urgent first), so messages queued since can't hold the exit
+    # back.  The exit request is kept outside the lanes (and their limit).
+    def put_exit(self, packet, worker=0):
+        self.mutex.acquire()
+
+        try:
+            ahead = []
+
+            for priority in (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW):
+                if self._lanes[priority]:
+                    ahead.append([ self._lanes[priority], len(self._lanes[priority]), None ])
+
+                if self.workers and self._own[worker][priority]:
+                    ahead.append([ self._own[worker][priority], len(self._own[worker][priority]), worker ])
+
+            self._exits[worker] = [ packet, ahead ]
+
+            if worker in self._idle:
+                self._idle.remove(worker)
+                self._wakeups[worker].notify()
+
+        finally:
+            self.mutex.release()
+
+    # Next message for <worker> (the thread itself if not a pool)
+    def get(self, block=True, timeout=None, worker=0):
+        self.mutex.acquire()
+
+        try:
+            if not self._available(worker):
+                if not block:
+                    raise queue.Empty
+
+                deadline = None if timeout is None else time.monotonic() + timeout
+
+                while not self._available(worker):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise queue.Empty
+
+                    self._idle.append(worker)
+                    self._wakeups[worker].wait(remaining)
+
+                    # Not woken by a put
+                    if worker in self._idle:
+                        self._idle.remove(worker)
+
+            return self._pop(worker)
+
+        finally:
+            self.mutex.release()
+
+    def get_nowait(self, worker=0):
+        return self.get(block=False, worker=worker)
+
+    # Move up to <count> queued messages to <batch> under a single acquire of the lock,
+    # stopping at <stop> (which is taken, but not added).  True if <stop> was reached.
+    def take(self, batch, count, stop, worker=0):
+        self.mutex.acquire()
+
+        try:
+            while count > 0 and self._available(worker):
+                message = self._pop(worker)
+                count -= 1
+
+                if message is stop:
+                    return True
+
+                batch.append(message)
+
+            return False
+
+        finally:
+            self.mutex.release()
+
+    # Remove and return everything queued
+    def drain(self):
+        self.mutex.acquire()
+
+        try:
+            messages = []
+
+            for lanes in [ self._lanes ] + self._own:
+                for lane in lanes:
+                    messages.extend(lane)
+                    lane.clear()
+
+            self._keys.clear()
+            self._exits.clear()
+            self._size = self._shared_size = 0
+            self._own_sizes = [ 0 ] * self.workers
+
+            if self._putters:
+                self._not_full.notify_all()
+
+            return messages
+
+        finally:
+            self.mutex.release()
+
+    def qsize(self):
+        return self._size
+
+    def empty(self):
+        return self._size == 0
+
+    def full(self):
+        return 0 < self._max_queue <= self._size
+
+    def stats(self, reset=False):
+        self.mutex.acquire()
+
+        stats = {
+            'depth': self._size,
+            'lanes': [ len(lane) for lane in self._lanes ],
+            'max_queue': self._max_queue,
+            'overflow': self._overflow,
+            'high_water': self._high_water,
+            'dropped': self._dropped,
+            'coalesced': self._coalesced,
+            'blocked': self._blocked,
+        }
+
+        if self.workers:
+            stats['workers'] = list(self._own_sizes)
+
+        if reset:
+            self._high_water = self._size
+            self._dropped = 0
+            self._coalesced = 0
+            self._blocked = 0
+
+        self.mutex.release()
+
+        return stats
+
+    def _available(self, worker):
+        return self._shared_size or (self.workers and self._own_sizes[worker]) or self._exiting(worker)
+
+    # True if <worker>'s exit request is due: the messages queued ahead of it have been taken
+    def _exiting(self, worker):
+        request = self._exits.get(worker)
+
+        return request is not None and not request[1]
+
+    # Next message for <worker>, most urgent first (called holding the lock).  Within a priority
+    # shared messages come before the worker's own.  With an exit request pending only the
+    # messages queued ahead of it are taken, and then the request.
+    def _pop(self, worker):
+        if self._exits and worker in self._exits:
+            ahead = self._exits[worker][1]
+
+            if not ahead:
+                return self._exits.pop(worker)[0]
+
+            (lane, count, owner) = ahead[0]
+            message = lane.popleft()
+            self._taken(lane)
+            self._removed(message, owner)
+
+            return message
+
+        own = self._own[worker] if self.workers else None
+
+        for priority in (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW):
+            if self._lanes[priority]:
+                lane = self._lanes[priority]
+                message = lane.popleft()
+                self._taken(lane)
+                self._removed(message, None)
+
+                return message
+
+            if own is not None and own[priority]:
+                lane = own[priority]
+                message = lane.popleft()
+                self._taken(lane)
+                self._removed(message, worker)
+
+                return message
+
+    # Count a message taken from the head of <lane> against the exit requests waiting on it
+    def _taken(self, lane):
+        if self._exits:
+            for (worker, (packet, ahead)) in self._exits.items():
+                for entry in ahead:
+                    if entry[0] is lane:
+                        entry[1] -= 1
+
+                        if entry[1] == 0:
+                            ahead.remove(entry)
+
+                            # Due now: wake the worker if it waits
+                            if not ahead and worker in self._idle:
+                                self._idle.remove(worker)
+                                self._wakeups[worker].notify()
+
+                        break
+
+    # Account for <message> taken from the shared lanes (or <worker>'s)
+    def _removed(self, message, worker):
+        self._size -= 1
+
+        if worker is None:
+            self._shared_size -= 1
+        else:
+            self._own_sizes[worker] -= 1
+
+        if isinstance(message, dict) and 'key' in message and self._keys.get(message['key']) is message:
+            del self._keys[message['key']]
+
+        if self._putters:
+            self._not_full.notify()
+
+# Fail the request of a message that has been dropped (or replaced)
+def _drop(message, name):
+    reply_to = message.get('reply_to')
+
+    if isinstance(reply_to, ReplyFuture):
+        reply_to._finish(None, ThreadMessageException("Message to '%s' dropped" % name))
+
+# A timer armed by SynchronizedThreadWithQueue.set_timer()
+class _Timer():
+    __slots__ = ('owner', 'name', 'value', 'period', 'cancelled')
+
+    def __init__(self, owner, name, value, period):
+        self.owner = owner
+        self.name = name
+        self.value = value
+        self.period = period
+        self.cancelled = False
+
+#
+# Process wide timer scheduler: one thread delivers the timers of all threads, kept in a heap
+# ordered by (monotonic clock) expiry.  Arming is O(log n); cancelling marks the timer, which is
+# dropped when it reaches the top of the heap or when cancelled timers make up most of it.
+# The owners' _timers tables are only changed under the scheduler's lock.  Due timers are
+# taken off the heap under the lock and delivered after it is released, through the owner's
+# put(); one killed while it is being delivered may still arrive, as it would had it fired
+# just before.
+#
+class _TimerScheduler():
+    # Cancelled timers tolerated in the heap before it is rebuilt
+    COMPACT_MIN = 64
+
+    def __init__(self):
+        self._lock = Condition()
+        self._heap = []
+        self._sequence = itertools.count()
+        self._cancelled = 0
+        self._thread = None
+
+    def schedule(self, owner, name, delay, value, periodic):
+        self._lock.acquire()
+
+        try:
+            self._cancel(owner, name)
+
+            timer = _Timer(owner, name, value, delay if periodic else None)
+            owner._timers[name] = timer
+
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._sequence), timer))
+
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="timer-scheduler", daemon=True)
+                self._thread.start()
+
+            elif self._heap[0][2] is timer:
+                # New earliest expiry
+                self._lock.notify()
+
+        finally:
+            self._lock.release()
+
+    def cancel(self, owner, name):
+        self._lock.acquire()
+
+        try:
+            self._cancel(owner, name)
+
+        finally:
+            self._lock.release()
+
+    def cancel_all(self, owner):
+        self._lock.acquire()
+
+        try:
+            for name in list(owner._timers):
+                self._cancel(owner, name)
+
+        finally:
+            self._lock.release()
+
+    def _cancel(self, owner, name):
+        timer = owner._timers.pop(name, None)
+
+        if timer is not None:
+            timer.cancelled = True
+            self._cancelled += 1
+
+            if self._cancelled > self.COMPACT_MIN and self._cancelled > len(self._heap) // 2:
+                self._heap = [ entry for entry in self._heap if not entry[2].cancelled ]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def _run(self):
+        self._lock.acquire()
+
+        while True:
+            heap = self._heap
+            now = time.monotonic()
+            due = []
+
+            while heap and heap[0][0] <= now:
+                (expires, sequence, timer) = heapq.heappop(heap)
+
+                if timer.cancelled:
+                    self._cancelled -= 1
+                    continue
+
+                if timer.period is None:
+                    del timer.owner._timers[timer.name]
+
+                else:
+                    # Next period from the last expiry (so periods don't drift), unless it has
+                    # been missed altogether
+                    expires += timer.period
+                    heapq.heappush(heap, (expires if expires > now else now + timer.period, next(self._sequence), timer))
+
+                due.append(timer)
+
+            if due:
+                self._lock.release()
+
+                try:
+                    for timer in due:
+                        if not timer.cancelled:
+                            timer.owner._timer_fired(timer.name, timer.value)
+
+                finally:
+                    self._lock.acquire()
+
+                # Timers may have been armed meanwhile
+                continue
+
+            self._lock.wait(heap[0][0] - now if heap else None)
+
+_timer_scheduler = _TimerScheduler()
+
 # Interface for synchronized thread with command queue
+#
+# With <batch_size> above 1 each wakeup drains up to <batch_size> queued messages and hands them
+# to message_batch() at once.  <batch_latency> (seconds) is how long to wait for more messages
+# to fill a batch once the first has arrived; without it only those already queued are taken.
+#
+# <max_queue> limits the messages queued (0 for no limit); <overflow> (OVERFLOW_) is what happens
+# to messages arriving when it is full, <overflow_timeout> how long OVERFLOW_BLOCK waits.
 class SynchronizedThreadWithQueue(Thread):
     # Internal object used to send termination request
     class _ExitObject():
         pass
 
-    def __init__(self, name, parent=None, app=None, queue_blocking=True, queue_timeout=None, max_queue=0):
+    # Threads serving the queue (see SynchronizedThreadPool)
+    _workers = 0
+
+    def __init__(self, name, parent=None, app=None, queue_blocking=True, queue_timeout=None, max_queue=0, batch_size=1, batch_latency=None, overflow=OVERFLOW_BLOCK, overflow_timeout=None):
         super(SynchronizedThreadWithQueue, self).__init__(name=name)
 
         self._running = True
-        self._queue = queue.Queue(max_queue)
+        self._queue = _Mailbox(name, max_queue, overflow, overflow_timeout, self._workers)
         self._parent = parent
         self._app = app
         self._queue_blocking = queue_blocking
         self._queue_timeout = queue_timeout
+        self._batch_size = batch_size
+        self._batch_latency = batch_latency
 
         self._ready_signal = Lock()
         self._ready_signal.acquire()
@@ -97,15 +941,10 @@ class SynchronizedThreadWithQueue(Thread):
         # print("%s constructor, parent '%s'" % (self.name, parent.name if parent else "None"))
 
         # Add thread to global thread objects for message passing
-        _thread_objects_lock.acquire()
+        self._registered = _register_thread(name, self)
 
-        if name in _thread_objects:
+        if not self._registered:
             syslog.syslog("%s: !!!! already in _thread_objects" % name)
-        else:
-            # print("Adding '%s' to _thread_objects" % name)
-            _thread_objects[name] = self
-
-        _thread_objects_lock.release()
 
     def get_app(self):
         return self._app
@@ -122,16 +961,25 @@ class SynchronizedThreadWithQueue(Thread):
         syslog.syslog("Release %s to run" % self.name)
         self._sync_signal.release()
 
-    # Put message in local queue
-    def put(self, message):
-        self._queue.put({'data': message})
+    # Put message in local queue.  With <block> False a full OVERFLOW_BLOCK queue drops the
+    # message rather than waiting.  False if it was dropped.
+    def put(self, message, priority=PRIORITY_NORMAL, key=None, order=None, block=True):
+        return self._queue.put({'data': message}, block=block, priority=priority, key=key, order=order)
+
+    # Depth, lane depths, high water mark and counts of dropped, coalesced and blocked messages
+    def queue_stats(self, reset=False):
+        return self._queue.stats(reset)
 
     def stop(self, join=True):
         syslog.syslog("Stopping %s thread" % self.name)
-        self._queue.put(self._exit_object)
+        self._request_exit()
         if join:
             self.join()
 
+    # Exit once everything already queued has been handled
+    def _request_exit(self):
+        self._queue.put_exit(self._exit_object)
+
     # No access to 'varstore' is valid before the threads are intiailized.
     # The calls to add_varstore_schema must occur before the main thread creates the varstore.
     def add_varstore_schema(self, schema):
@@ -152,102 +1000,437 @@ class SynchronizedThreadWithQueue(Thread):
     def message(self, message, from_thread):
         syslog.syslog("No message handler in %s for %s from %s" % (self._name, message, from_thread))
 
+    # Called with the [ message, from_thread ] pairs taken in one wakeup when batching.  Returns
+    # the results, one for each message as returned by message().
+    def message_batch(self, messages):
+        return [ self.message(message, from_thread) for (message, from_thread) in messages ]
+
+    # Called by the timer scheduler (which mustn't block)
     def _timer_fired(self, name, value):
         # print("_timer_fired in '%s' name '%s' with '%s'" % (self.name, name, value))
         # Send local message to self.
-        self.put([ name, value ])
-        del(self._timers[name])
-
-    def set_timer(self, name, time, value=None):
-        # Remove any extant by this name
-        self.kill_timer(name)
+        if not self.put([ name, value ], block=False):
+            syslog.syslog("%s: queue full, timer '%s' dropped" % (self.name, name))
 
+    # Deliver [ <name>, <value> ] to this thread after <time> seconds (and every <time> seconds
+    # if <periodic>), replacing any timer of the same name.
+    def set_timer(self, name, time, value=None, periodic=False):
         # print("set_timer in '%s' name '%s' for %s with '%s'" % (self.name, name, time, value))
-
-        # Construct timer element with parameters passed from caller
-        self._timers[name] = Timer(time, self._timer_fired, kwargs={'name':name, 'value':value})
-
-        # Start the timer
-        self._timers[name].start()
+        _timer_scheduler.schedule(self, name, time, value, periodic)
 
     def kill_timer(self, name):
         # print("Killing timer '%s'" % name)
-        # If timer is extant in table, kill it
-        if name in self._timers:
-            self._timers[name].cancel()
-            del(self._timers[name])
+        _timer_scheduler.cancel(self, name)
 
-    def run(self):
-        syslog.syslog("%s initializing" % self.name)
+    # Deliver the results of a message to its 'reply_to'
+    def _reply(self, message, results):
+        if 'reply_to' in message:
+            reply_to = message['reply_to']
+            if isinstance(reply_to, ReplyFuture):
+                reply_to._finish(results)
 
-        self.initialize()
+            elif isinstance(reply_to, queue.Queue):
+                # Put into the the sender's reply queue
+                reply_to.put(results)
 
-        self._ready_signal.release()
-        self._sync_signal.acquire()
+            elif isinstance(reply_to, (str, ThreadHandle)):
+                # Send reply to input queue of another thread
+                thread = _lookup_thread(reply_to)
 
+                if thread is not None:
+                    # Send as if directed to this thread.  This allows a 'response' to a command to be delivered
+                    # asynchronously as if it was another command.
+                    thread._queue.put({ 'data': [ message['reply_token'], results ], 'from': self._name })
 
-        syslog.syslog("%s: blocking %s timeout %s" % (self.name, self._queue_blocking, self._queue_timeout))
+                else:
+                    syslog.syslog("Thread '%s' not in _thread_objects" % reply_to)
 
-        self.started()
+        elif results != None:
+            syslog.syslog("%s: Results from %s is %s" % (self.name, message, results))
+
+    # False for a request that has been cancelled
+    def _begin(self, message):
+        reply_to = message.get('reply_to')
+
+        return not isinstance(reply_to, ReplyFuture) or reply_to._begin()
+
+    # Pass an exception raised handling <messages> to their requests: False if there were none
+    # (the exception is then the thread's)
+    def _fail(self, messages, error):
+        failed = False
 
-        while self._running:
+        for message in messages:
+            reply_to = message.get('reply_to')
 
+            if isinstance(reply_to, ReplyFuture):
+                reply_to._finish(None, error)
+                failed = True
+
+        return failed
+
+    # Handle one message
+    def _dispatch(self, message):
+        if self._begin(message):
             try:
-                message = self._queue.get(block=self._queue_blocking, timeout=self._queue_timeout)
+                # print("SynchronizedThreadWithQueue(%s) processing %s" % (self.name, message))
+                # message contains a 'data' and optional 'reply_to' queue.
+                results = self.message(message['data'], message['from'] if 'from' in message else None)
+
+            except Exception as e:
+                if not self._fail([ message ], e):
+                    raise
+
+            else:
+                self._reply(message, results)
+
+    # Take up to batch_size messages, starting with <first>, and pass them to message_batch().
+    # Taking stops at an exit request (messages behind it are left in the queue as they would be
+    # without batching).  Returns False if there was one.
+    def _run_batch(self, first, worker=0):
+        batch = [ first ]
+        running = not self._queue.take(batch, self._batch_size - 1, self._exit_object, worker)
+
+        if self._batch_latency is not None:
+            deadline = time.monotonic() + self._batch_latency
+
+            # Wait for more until the batch is full or the budget is spent
+            while running and len(batch) < self._batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                try:
+                    message = self._queue.get(timeout=remaining, worker=worker)
+
+                except queue.Empty:
+                    break
 
                 if message == self._exit_object:
-                    self._running = False
+                    running = False
+                    break
 
-                else:
-                    # print("SynchronizedThreadWithQueue(%s) processing %s" % (self.name, message))
-                    # message contains a 'data' and optional 'reply_to' queue.
-                    results = self.message(message['data'], message['from'] if 'from' in message else None)
+                batch.append(message)
+                running = not self._queue.take(batch, self._batch_size - len(batch), self._exit_object, worker)
+
+        self._handle_batch(batch)
+
+        return running
+
+    # Handle a batch of messages (taken by _run_batch())
+    def _handle_batch(self, batch):
+        # Without a message_batch() of its own each message is handled alone, so an exception
+        # only fails its own request
+        if type(self).message_batch is SynchronizedThreadWithQueue.message_batch:
+            for message in batch:
+                self._dispatch(message)
+
+            return
+
+        batch = [ message for message in batch if self._begin(message) ]
+        if not batch:
+            return
+
+        # An exception raised by message_batch() fails all the requests of the batch
+        try:
+            results = self.message_batch([ [ message['data'], message['from'] if 'from' in message else None ] for message in batch ])
+
+        except Exception as e:
+            if not self._fail(batch, e):
+                raise
+
+            return
+
+        results = [] if results is None else list(results)
+
+        for (message, result) in zip(batch, results):
+            self._reply(message, result)
+
+        # One result is owed to each message: those left without one fail rather than wait forever
+        if len(results) != len(batch):
+            error = ThreadMessageException("%s: message_batch() returned %d results for %d messages" % (self.name, len(results), len(batch)))
 
-                    if 'reply_to' in message:
-                        reply_to = message['reply_to']
-                        if isinstance(reply_to, queue.Queue):
-                            # Put into the the sender's reply queue
-                            reply_to.put(results)
+            if not self._fail(batch[len(results):], error):
+                syslog.syslog(str(error))
 
-                        elif isinstance(reply_to, str):
-                            # Send reply to input queue of another thread
-                            _thread_objects_lock.acquire()
+    # Handle messages for <worker> until an exit request
+    def _serve(self, worker=0):
+        running = True
 
-                            if reply_to in _thread_objects:
-                                # Send as if directed to this thread.  This allows a 'response' to a command to be delivered
-                                # asynchronously as if it was another command.
-                                _thread_objects[reply_to]._queue.put({ 'data': [ message['reply_token'], results ], 'from': self._name })
+        while running:
 
-                            else:
-                                syslog.syslog("Thread '%s' not in _thread_objects" % reply_to)
+            try:
+                message = self._queue.get(block=self._queue_blocking, timeout=self._queue_timeout, worker=worker)
+
+                if message == self._exit_object:
+                    running = False
 
-                            _thread_objects_lock.release()
+                elif self._batch_size > 1:
+                    running = self._run_batch(message, worker)
 
-                    elif results != None:
-                        syslog.syslog("%s: Results from %s is %s" % (self.name, message, results))
+                else:
+                    self._dispatch(message)
 
             except queue.Empty:
                 # Turn timeout into empty
                 self.message(None, None)
 
+    def run(self):
+        syslog.syslog("%s initializing" % self.name)
+
+        self.initialize()
+
+        self._ready_signal.release()
+        self._sync_signal.acquire()
+
+
+        syslog.syslog("%s: blocking %s timeout %s" % (self.name, self._queue_blocking, self._queue_timeout))
+
+        self.started()
+
+        self._serve()
+        self._running = False
 
         self.shutdown()
 
         # Remove timers
-        for timer in [ x for x in self._timers] :
-            # print("delete timer %s" % timer)
-            self._timers[timer].cancel()
-            del(self._timers[timer])
+        _timer_scheduler.cancel_all(self)
 
         # Remove thread from global _thread_objects
         syslog.syslog("Removing thread %s from thread_objects" % self.name)
-        _thread_objects_lock.acquire()
-        if self.name in _thread_objects:
-            del(_thread_objects[self.name])
+        if _unregister_thread(self.name, self):
+            self._registered = False
 
         else:
-            syslog.syslog("%s: !!! %s not in _thread_objects" % self.name)
-        _thread_objects_lock.release()
+            syslog.syslog("%s: !!! not in _thread_objects" % self.name)
+
+        # Requests that will never be handled
+        self._fail([ message for message in self._queue.drain() if message != self._exit_object ], ThreadMessageException("Thread '%s' exited" % self.name))
 
         syslog.syslog("%s exiting" % self.name)
 
+#
+# A SynchronizedThreadWithQueue whose queue is served by <workers> threads (this one and
+# workers - 1 more, all with the pool's name), so message() (and message_batch()) may be
+# called by several at once.  Messages sent with an 'order' are all handled by the same worker,
+# in the order they were sent; others go to whichever worker is free.  initialize(), started()
+# and shutdown() are called once, by this thread, before the workers start and after they have
+# all finished.  With a queue_timeout each idle worker calls message(None, None).
+#
+class SynchronizedThreadPool(SynchronizedThreadWithQueue):
+    def __init__(self, name, workers=2, **kwargs):
+        self._workers = max(workers, 1)
+
+        super(SynchronizedThreadPool, self).__init__(name, **kwargs)
+
+    def get_workers(self):
+        return self._workers
+
+    # One exit request for each worker
+    def _request_exit(self):
+        for worker in range(self._workers):
+            self._queue.put_exit(self._exit_object, worker)
+
+    def _serve(self, worker=0):
+        workers = [ Thread(target=super(SynchronizedThreadPool, self)._serve, args=(w,), name=self.name) for w in range(1, self._workers) ]
+
+        for thread in workers:
+            thread.start()
+
+        super(SynchronizedThreadPool, self)._serve(0)
+
+        for thread in workers:
+            thread.join()
+
+
+
+#
+# Message handling of a SynchronizedProcessWithQueue, run in its child process(es).  Derive
+# from it in a module the child can import (processes are started with 'spawn'); the handler
+# is pickled to each child.  message() returns the reply, or raises the exception the sender
+# gets; both are pickled back.
+#
+class ProcessHandler():
+    def initialize(self):
+        pass
+
+    def message(self, message, from_thread):
+        return None
+
+    def shutdown(self):
+        pass
+
+# Handler loop of a child process: envelopes are ( id, message, from_thread ) and replies
+# ( id, results, exception ).  None asks it to exit.
+def _process_main(connection, handler):
+    handler.initialize()
+
+    while True:
+        envelope = connection.recv()
+        if envelope is None:
+            break
+
+        (id, message, from_thread) = envelope
+
+        try:
+            reply = (id, handler.message(message, from_thread), None)
+
+        except Exception as e:
+            reply = (id, None, e)
+
+        try:
+            connection.send(reply)
+
+        except Exception as e:
+            # Results or exception that can't be pickled
+            connection.send((id, None, ThreadMessageException("%s: %s" % (type(e).__name__, e))))
+
+    handler.shutdown()
+    connection.close()
+
+#
+# A SynchronizedThreadWithQueue whose messages are handled by <handler> (a ProcessHandler) in
+# <processes> child processes, so CPU bound handlers aren't held up by the GIL.  It registers
+# its name like any other thread: send_message(), request() and broadcasts reach it, and the
+# replies are routed back as for a thread.  Messages (and replies) must be picklable.
+#
+# This thread forwards the messages: those with an 'order' go to one process chosen by it (so
+# they are handled in turn), others to the process with the fewest outstanding.  The processes
+# start when the thread starts running and are stopped, after their outstanding messages, when
+# it is stopped.
+#
+class SynchronizedProcessWithQueue(SynchronizedThreadWithQueue):
+    def __init__(self, name, handler, processes=1, **kwargs):
+        super(SynchronizedProcessWithQueue, self).__init__(name, **kwargs)
+
+        self._handler = handler
+        self._process_count = max(processes, 1)
+        self._processes = []
+        self._connections = []
+        self._readers = []
+
+        # Messages forwarded and replied to by each process, and those still running
+        self._sent = [ 0 ] * self._process_count
+        self._done = [ 0 ] * self._process_count
+        self._alive = [ True ] * self._process_count
+        self._turn = itertools.count()
+
+        # Forwarded messages awaiting replies: id -> ( process, message ).  Shared by this thread
+        # and the reply readers.
+        self._ids = itertools.count()
+        self._pending = {}
+        self._pending_lock = Lock()
+
+    def get_processes(self):
+        return self._process_count
+
+    def _serve(self, worker=0):
+        self._start_processes()
+
+        try:
+            super(SynchronizedProcessWithQueue, self)._serve(worker)
+
+        finally:
+            self._stop_processes()
+
+    def _start_processes(self):
+        context = multiprocessing.get_context('spawn')
+
+        for index in range(self._process_count):
+            (connection, child) = context.Pipe()
+
+            process = context.Process(target=_process_main, args=(child, self._handler), name="%s-%d" % (self.name, index), daemon=True)
+            process.start()
+            child.close()
+
+            reader = Thread(target=self._read_replies, args=(index, connection), name=self.name, daemon=True)
+            reader.start()
+
+            self._processes.append(process)
+            self._connections.append(connection)
+            self._readers.append(reader)
+
+    # Ask the processes to exit once they have handled what they have been sent
+    def _stop_processes(self):
+        for connection in self._connections:
+            try:
+                connection.send(None)
+
+            except OSError:
+                pass
+
+        for process in self._processes:
+            process.join()
+
+        for reader in self._readers:
+            reader.join()
+
+        for connection in self._connections:
+            connection.close()
+
+    # Forward a message to a process
+    def _dispatch(self, message):
+        if not self._begin(message):
+            return
+
+        if 'order' in message:
+            index = hash(message['order']) % self._process_count
+
+        else:
+            # Ties are taken in turn
+            start = next(self._turn)
+            candidates = [ (start + i) % self._process_count for i in range(self._process_count) ]
+            index = min([ i for i in candidates if self._alive[i] ] or candidates, key=lambda i: self._sent[i] - self._done[i])
+
+        id = next(self._ids)
+
+        self._pending_lock.acquire()
+        self._pending[id] = (index, message)
+        self._pending_lock.release()
+
+        try:
+            self._connections[index].send((id, message['data'], message['from'] if 'from' in message else None))
+            self._sent[index] += 1
+
+        except Exception as e:
+            # Can't be pickled, or the process has gone (its reader may have failed it already)
+            self._pending_lock.acquire()
+            pending = self._pending.pop(id, None)
+            self._pending_lock.release()
+
+            if pending is None:
+                return
+
+            if not self._fail([ message ], ThreadMessageException("%s: %s" % (type(e).__name__, e))):
+                syslog.syslog("%s: message %s not forwarded: %s" % (self.name, message['data'], e))
+
+    def _read_replies(self, index, connection):
+        try:
+            while True:
+                (id, results, error) = connection.recv()
+
+                self._pending_lock.acquire()
+                (process, message) = self._pending.pop(id)
+                self._pending_lock.release()
+
+                self._done[index] += 1
+
+                if error is None:
+                    self._reply(message, results)
+
+                elif not self._fail([ message ], error):
+                    syslog.syslog("%s: exception '%s' (%s) handling %s" % (self.name, str(error), type(error), message['data']))
+
+        except (EOFError, OSError):
+            pass
+
+        self._alive[index] = False
+
+        # Whatever this process hadn't replied to won't be
+        self._pending_lock.acquire()
+        lost = [ (id, message) for (id, (process, message)) in self._pending.items() if process == index ]
+        for (id, message) in lost:
+            del self._pending[id]
+        self._pending_lock.release()
+
+        for (id, message) in lost:
+            self._fail([ message ], ThreadMessageException("Process %d of '%s' exited" % (index, self.name)))
@@ -0,0 +1,343 @@
+#
+# SynchronizedThreadWithQueue benchmarks
+#
+# python synchronized_thread_bench.py [--threads 1,4,16] [--senders 1,4,16] [--workers 1,2,4,8] [--messages 20000] [--only send,...]
+#
+# Each result is printed as <benchmark> <us per message> <messages per second>.
+#
+
+import os
+import sys
+import time
+import argparse
+import asyncio
+import threading
+from threading import Thread
+from aoutils.synchronized_thread import SynchronizedThreadWithQueue, SynchronizedThreadPool, SynchronizedProcessWithQueue, ProcessHandler, ThreadMessageException, send_message, get_thread_handle, request, request_async
+from aoutils.synchronized_thread import OVERFLOW_BLOCK, OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST, OVERFLOW_COALESCE, PRIORITY_HIGH
+
+# Counts the messages it is sent
+class _Receiver(SynchronizedThreadWithQueue):
+    def __init__(self, name, **kwargs):
+        super(_Receiver, self).__init__(name, **kwargs)
+        self.received = 0
+
+    def message(self, message, from_thread):
+        self.received += 1
+
+        # Synchronization request: all earlier messages have been handled
+        if message[0] == 'sync':
+            return self.received
+
+# CPU bound work for the thread / process comparison
+def _spin(n):
+    total = 0
+    for i in range(n):
+        total += i * i
+    return total
+
+# Handler run in the child processes (at module level so they can import it)
+class _Spin(ProcessHandler):
+    def message(self, message, from_thread):
+        return _spin(message[1])
+
+def _report(name, seconds):
+    print("%-56s %12.2f us %14.0f /s" % (name, seconds * 1e6, 1 / seconds if seconds else 0))
+    sys.stdout.flush()
+
+def _start(threads):
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.wait_ready()
+        thread.signal_sync()
+
+def _stop(threads):
+    for thread in threads:
+        thread.stop()
+
+# 'senders' threads each send 'messages' messages round robin to 'count' receivers; the
+# time runs until the receivers have handled them all.
+def _throughput(count, senders, messages, handles, **options):
+    receivers = [ _Receiver("bench-receiver-%d" % r, **options) for r in range(count) ]
+    _start(receivers)
+
+    if handles:
+        targets = [ get_thread_handle(receiver.name) for receiver in receivers ]
+    else:
+        targets = [ receiver.name for receiver in receivers ]
+
+    per_sender = messages // senders
+
+    def sender(offset):
+        for i in range(per_sender):
+            send_message([ 'count', i ], to=targets[(offset + i) % count])
+
+    threads = [ Thread(target=sender, args=(s,)) for s in range(senders) ]
+
+    start = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    for target in targets:
+        send_message([ 'sync' ], to=target, reply=True)
+
+    elapsed = time.perf_counter() - start
+
+    _stop(receivers)
+
+    return elapsed / (per_sender * senders)
+
+def bench_send(args):
+    for count in args.threads:
+        for senders in args.senders:
+            for (label, handles) in [ ('by name', False), ('handle', True) ]:
+                _report("Send %d receivers %d senders (%s)" % (count, senders, label), _throughput(count, senders, args.messages, handles))
+
+def bench_batch(args):
+    for senders in args.senders:
+        for (label, options) in [ ('unbatched', {}), ('batch 64', { 'batch_size': 64 }), ('batch 64, 1 ms', { 'batch_size': 64, 'batch_latency': 0.001 }) ]:
+            _report("Send 1 receiver %d senders (%s)" % (senders, label), _throughput(1, senders, args.messages, True, **options))
+
+def bench_broadcast(args):
+    for count in args.threads:
+        receivers = [ _Receiver("bench-receiver-%d" % r) for r in range(count) ]
+        _start(receivers)
+
+        messages = max(1, args.messages // count)
+        start = time.perf_counter()
+
+        for i in range(messages):
+            send_message([ 'count', i ])
+
+        for receiver in receivers:
+            send_message([ 'sync' ], to=receiver.name, reply=True)
+
+        elapsed = time.perf_counter() - start
+
+        _stop(receivers)
+
+        _report("Broadcast to %d receivers (per delivery)" % count, elapsed / (messages * count))
+
+def bench_reply(args):
+    receiver = _Receiver("bench-receiver")
+    _start([ receiver ])
+
+    handle = get_thread_handle(receiver.name)
+    messages = max(1, args.messages // 10)
+
+    for (label, target) in [ ('by name', receiver.name), ('handle', handle) ]:
+        start = time.perf_counter()
+
+        for i in range(messages):
+            send_message([ 'sync' ], to=target, reply=True)
+
+        _report("Send with reply (%s)" % label, (time.perf_counter() - start) / messages)
+
+    start = time.perf_counter()
+    for i in range(messages):
+        request([ 'sync' ], handle).result()
+    _report("request().result()", (time.perf_counter() - start) / messages)
+
+    # Many requests in flight from one sender
+    batches = max(1, messages // 100)
+    start = time.perf_counter()
+    for i in range(batches):
+        for future in [ request([ 'sync' ], handle) for j in range(100) ]:
+            future.result()
+    _report("request(), 100 in flight", (time.perf_counter() - start) / (batches * 100))
+
+    async def requests(in_flight, batches):
+        for i in range(batches):
+            await asyncio.gather(*[ request_async([ 'sync' ], handle) for j in range(in_flight) ])
+
+    for in_flight in (1, 100):
+        batches = max(1, messages // in_flight)
+        start = time.perf_counter()
+        asyncio.run(requests(in_flight, batches))
+        _report("request_async(), %d in flight" % in_flight, (time.perf_counter() - start) / (batches * in_flight))
+
+    _stop([ receiver ])
+
+def bench_timers(args):
+    receiver = _Receiver("bench-receiver")
+    _start([ receiver ])
+
+    count = max(1, args.messages // 10)
+    names = [ 'watchdog-%d' % i for i in range(100) ]
+    threads = threading.active_count()
+
+    # Re-arming watchdogs that never expire
+    start = time.perf_counter()
+    for i in range(count):
+        receiver.set_timer(names[i % len(names)], 60)
+    _report("Re-arm timer (100 pending)", (time.perf_counter() - start) / count)
+
+    print("%-56s %12d" % ("Threads added by 100 pending timers", threading.active_count() - threads))
+
+    start = time.perf_counter()
+    for name in names:
+        receiver.kill_timer(name)
+    _report("Kill timer", (time.perf_counter() - start) / len(names))
+
+    # Expiring timers: time until all have been handled
+    received = receiver.received
+    start = time.perf_counter()
+    for i in range(count):
+        receiver.set_timer('expire-%d' % i, 0)
+
+    while receiver.received < received + count:
+        time.sleep(0.001)
+
+    _report("Arm + deliver expiring timer", (time.perf_counter() - start) / count)
+
+    # Periodic timer lateness
+    late = []
+    receiver.set_timer('tick', 0.01, periodic=True)
+    expected = time.perf_counter() + 0.01
+
+    def lateness(message, from_thread):
+        nonlocal expected
+        late.append(time.perf_counter() - expected)
+        expected += 0.01
+
+    receiver.message = lateness
+    time.sleep(0.5)
+    receiver.kill_timer('tick')
+
+    print("%-56s %12.2f ms" % ("Periodic 10 ms timer: mean lateness", sum(late) / len(late) * 1e3))
+    print("%-56s %12.2f ms" % ("Periodic 10 ms timer: max lateness", max(late) * 1e3))
+
+    _stop([ receiver ])
+
+# A sender feeding a consumer that can't keep up, with each overflow policy: how long the
+# sender is held up, what was dropped and how long an urgent message waits behind the rest
+def bench_overflow(args):
+    class Slow(_Receiver):
+        def message(self, message, from_thread):
+            if message[0] == 'urgent':
+                return time.perf_counter()
+
+            time.sleep(0.0002)
+            return super(Slow, self).message(message, from_thread)
+
+    messages = max(1, args.messages // 10)
+
+    for (label, options) in [ ('block, 10 ms', { 'overflow': OVERFLOW_BLOCK, 'overflow_timeout': 0.01 }), ('drop newest', { 'overflow': OVERFLOW_DROP_NEWEST }),
+                              ('drop oldest', { 'overflow': OVERFLOW_DROP_OLDEST }), ('coalesce', { 'overflow': OVERFLOW_COALESCE }) ]:
+        receiver = Slow("bench-slow", max_queue=100, **options)
+        _start([ receiver ])
+
+        start = time.perf_counter()
+        for i in range(messages):
+            send_message([ 'count', i ], to=receiver.name, key=i % 10)
+        _report("Send to a slow consumer (%s)" % label, (time.perf_counter() - start) / messages)
+
+        sent = time.perf_counter()
+        try:
+            handled = request([ 'urgent' ], receiver.name, priority=PRIORITY_HIGH).result()
+            print("%-56s %12.2f us" % ("Urgent message latency (%s)" % label, (handled - sent) * 1e6))
+
+        except ThreadMessageException:
+            print("%-56s %12s" % ("Urgent message latency (%s)" % label, "dropped"))
+
+        stats = receiver.queue_stats()
+        print("%-56s high water %d, dropped %d, coalesced %d" % ("Queue (%s)" % label, stats['high_water'], stats['dropped'], stats['coalesced']))
+
+        _stop([ receiver ])
+
+# Requests to a pool whose handler blocks (as for I/O) for 1 ms, with and without order keys
+def bench_pool(args):
+    class Blocking(SynchronizedThreadPool):
+        def message(self, message, from_thread):
+            time.sleep(0.001)
+
+    messages = max(1, args.messages // 20)
+
+    for workers in args.workers:
+        for (label, orders) in [ ('unordered', None), ('16 order keys', 16) ]:
+            pool = Blocking("bench-pool", workers=workers)
+            _start([ pool ])
+
+            start = time.perf_counter()
+            futures = [ request([ 'io', i ], pool.name, order=None if orders is None else i % orders) for i in range(messages) ]
+            for future in futures:
+                future.result()
+            _report("Pool of %d, 1 ms handler (%s)" % (workers, label), (time.perf_counter() - start) / messages)
+
+            _stop([ pool ])
+
+# CPU bound requests (about 1 ms each) to a thread, a pool of threads and pools of processes
+def bench_processes(args):
+    class Single(SynchronizedThreadWithQueue):
+        def message(self, message, from_thread):
+            return _spin(message[1])
+
+    class Pool(SynchronizedThreadPool):
+        def message(self, message, from_thread):
+            return _spin(message[1])
+
+    # Work per message: about 1 ms
+    start = time.perf_counter()
+    _spin(100000)
+    work = int(100000 * 0.001 / (time.perf_counter() - start))
+
+    messages = max(1, args.messages // 20)
+    print("%-56s %12d" % ("CPUs", os.cpu_count()))
+
+    actors = [ ('thread', lambda: Single("bench-cpu")) ]
+    actors += [ ('pool of %d threads' % workers, lambda workers=workers: Pool("bench-cpu", workers=workers)) for workers in args.workers if workers > 1 ]
+    actors += [ ('%d processes' % workers, lambda workers=workers: SynchronizedProcessWithQueue("bench-cpu", _Spin(), processes=workers)) for workers in args.workers ]
+
+    for (label, create) in actors:
+        actor = create()
+        _start([ actor ])
+
+        # Wait until all the processes are running (requests are spread over them)
+        for future in [ request([ 'spin', 1 ], actor.name) for i in range(4 * max(args.workers)) ]:
+            future.result()
+
+        start = time.perf_counter()
+        futures = [ request([ 'spin', work ], actor.name) for i in range(messages) ]
+        for future in futures:
+            future.result()
+        _report("1 ms CPU bound requests (%s)" % label, (time.perf_counter() - start) / messages)
+
+        _stop([ actor ])
+
+BENCHMARKS = {
+    'send': bench_send,
+    'batch': bench_batch,
+    'broadcast': bench_broadcast,
+    'reply': bench_reply,
+    'timers': bench_timers,
+    'overflow': bench_overflow,
+    'pool': bench_pool,
+    'processes': bench_processes,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SynchronizedThreadWithQueue benchmarks")
+    parser.add_argument("--threads", default="1,4,16", help="comma separated receiving thread counts")
+    parser.add_argument("--senders", default="1,4,16", help="comma separated sending thread counts")
+    parser.add_argument("--workers", default="1,2,4,8", help="comma separated pool sizes")
+    parser.add_argument("--messages", default=20000, type=int, help="messages per measurement")
+    parser.add_argument("--only", default=None, help="comma separated benchmarks: %s" % ", ".join(BENCHMARKS))
+    args = parser.parse_args(argv)
+
+    args.threads = [ int(count) for count in args.threads.split(',') ]
+    args.senders = [ int(count) for count in args.senders.split(',') ]
+    args.workers = [ int(count) for count in args.workers.split(',') ]
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+
+    for name in names:
+        print("== %s" % name)
+        BENCHMARKS[name](args)
+
+if __name__ == "__main__":
+    main()
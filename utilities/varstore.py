@@ -3,8 +3,27 @@
 #
 
 import os
-from threading import Lock
+import sys
+import time
+import atexit
+import weakref
+import itertools
+from threading import Lock, Condition, Thread, get_ident
 import json
+import pickle
+import io
+import mmap
+import struct
+import ast
+import inspect
+import functools
+from bisect import bisect_left
+from fnmatch import fnmatchcase
+import builtins
+import syslog
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
 from copy import deepcopy
 from aoutils.utils import default_kwargs, splitq
 
@@ -27,6 +46,26 @@ from aoutils.utils import default_kwargs, splitq
 DEFAULT_PROTECTION = 1
 NO_PROTECTION = 0
 
+# Limit on the number of distinct var names remembered by the path cache.
+PATH_CACHE_SIZE = 4096
+
+# Cell attribute holding the compiled validator.  Attributes starting with '_' are
+# internal and not reported by GetAttributes.
+VALIDATOR = '_validator'
+
+# Cell attribute holding the memoized result of a callable 'value' (cells with a 'ttl')
+CACHE = '_cache'
+
+# Threads refreshing stale callable results in the background
+REFRESH_WORKERS = 2
+
+# Number of most used vars reported by Stats()
+STATS_HOT_VARS = 20
+
+# Operations timed by Varstore(instrument=True), and those counted by var
+INSTRUMENTED = ('Get', 'Set', 'SetMany', 'Apply', 'Export', 'GetAttributes', 'Query', 'Delete', 'Save', 'Load', 'Flush', 'Propagate', 'AddSchema', 'AddVarstore')
+INSTRUMENTED_VARS = ('Get', 'Set', 'GetAttributes', 'Delete')
+
 class VarstoreException(Exception):
     def __init__(self, msg):
         super(VarstoreException, self).__init__(msg)
@@ -43,171 +82,2217 @@ class VarstoreExceptionFile(VarstoreException):
     def __str__(self):
         return "%s: '%s'" % (self._msg, self._filename)
 
-class VarstoreExceptionUndefinedVar(VarstoreException):
-    def __init__(self, varname):
-        super(VarstoreExceptionUndefinedVar, self).__init__("Undefined var")
-        self._varname = varname
+class VarstoreExceptionUndefinedVar(VarstoreException):
+    def __init__(self, varname):
+        super(VarstoreExceptionUndefinedVar, self).__init__("Undefined var")
+        self._varname = varname
+
+    def __str__(self):
+        return "%s: '%s'" % (self._msg, self._varname)
+
+class VarstoreExceptionProtectedVar(VarstoreException):
+    def __init__(self, varname, extra=None):
+        super(VarstoreExceptionProtectedVar, self).__init__("Protected var")
+        self._varname = varname
+
+    def __str__(self):
+        return "%s: '%s'" % (self._msg, self._varname)
+
+class VarstoreExceptionAccessError(VarstoreException):
+    def __init__(self, varname, extra=None):
+        super(VarstoreExceptionAccessError, self).__init__("Access error")
+        self._varname = varname
+        self._extra = extra
+
+    def __str__(self):
+        if self._extra:
+            return "%s: '%s' (%s)" % (self._msg, self._varname, self._extra)
+        else:
+            return "%s: '%s'" % (self._msg, self._varname)
+
+class VarstoreExceptionOption(VarstoreException):
+    def __init__(self, varname, value):
+        super(VarstoreExceptionOption, self).__init__("%s not an option" % value)
+        self._varname = varname
+
+    def __str__(self):
+        return "%s: '%s'" % (self._msg, self._varname)
+
+
+class VarstoreExceptionRange(VarstoreException):
+    def __init__(self, varname, value, range):
+        super(VarstoreExceptionRange, self).__init__("%s not in range [%s .. %s]" % (value, range[0], range[1]))
+        self._varname = varname
+
+    def __str__(self):
+        return "%s: '%s'" % (self._varname, self._msg)
+
+class VarstoreExceptionType(VarstoreException):
+    def __init__(self, varname, value, type):
+        super(VarstoreExceptionType, self).__init__("%s not a valid %s" % (value, type))
+        self._varname = varname
+
+    def __str__(self):
+        return "%s: '%s'" % (self._varname, self._msg)
+
+# Checks and converts values written to a cell.  Built once from the cell's 'type',
+# 'readonly', 'options' and 'range' attributes.
+class _CellValidator():
+    __slots__ = ('_type', '_convert', '_readonly', '_options', '_range')
+
+    def __init__(self, cell):
+        self._type = cell['type'] if 'type' in cell else None
+        self._convert = None
+        self._readonly = 'readonly' in cell and bool(cell['readonly'])
+        self._options = None
+        self._range = None
+
+        if self._type is not None:
+            convert = getattr(builtins, self._type, None)
+            if isinstance(convert, type):
+                self._convert = convert
+
+        if 'options' in cell:
+            try:
+                self._options = frozenset(cell['options'])
+
+            except TypeError:
+                # Unhashable options
+                self._options = tuple(cell['options'])
+
+        if 'range' in cell:
+            self._range = (cell['range'][0], cell['range'][1])
+
+    # Return the value to be stored for 'value' or throw the appropriate exception
+    def __call__(self, var, value, readonly_check=True, fix_range=False):
+        if self._type is not None:
+            value = self._coerce(var, value)
+
+        # Prohibit changing read-only vars
+        if readonly_check and self._readonly:
+            raise VarstoreExceptionAccessError(var, extra='is read-only')
+
+        if self._options is not None and not self._isOption(value):
+            raise VarstoreExceptionOption(var, value)
+
+        if self._range is not None:
+            (low, high) = self._range
+
+            try:
+                outside = value < low or value > high
+
+            except TypeError:
+                # Can't be compared with the range (e.g. text for a numeric range), nor clamped
+                raise VarstoreExceptionRange(var, value, self._range)
+
+            if outside:
+                if not fix_range:
+                    raise VarstoreExceptionRange(var, value, self._range)
+
+                # Don't throw a range error - just clamp the value within range
+                value = low if value < low else high
+
+        return value
+
+    def _isOption(self, value):
+        try:
+            return value in self._options
+
+        except TypeError:
+            # Unhashable value: compared with each option
+            return any(value == option for option in self._options)
+
+    def _coerce(self, var, value):
+        if self._convert is None:
+            raise VarstoreExceptionType(var, value, self._type)
+
+        try:
+            # Text is read as a Python literal ("0x10", "True", "1.5") before conversion
+            if isinstance(value, str) and self._convert is not str:
+                value = ast.literal_eval(value.strip())
+
+            return self._convert(value)
+
+        except (ValueError, TypeError, SyntaxError):
+            raise VarstoreExceptionType(var, value, self._type)
+
+# Shared by all cells without any checks
+_NO_CHECKS = _CellValidator({})
+
+# Return the validator for a cell's attributes
+def _compile_cell(cell):
+    if 'type' in cell or 'readonly' in cell or 'options' in cell or 'range' in cell:
+        return _CellValidator(cell)
+
+    return _NO_CHECKS
+
+# Attributes (everything but the value) of compact cells.  Shared by all cells built with
+# the same attributes, so never changed once built.
+class _CellMeta():
+    __slots__ = ('attributes', 'validator')
+
+    def __init__(self, attributes):
+        self.attributes = attributes
+        self.validator = _compile_cell(attributes)
+
+# Memoized result of a callable 'value' for a cell with a 'ttl' (seconds).  With
+# 'stale_while_revalidate' an expired result is returned while it is refreshed in the
+# background.
+class _CallableCache():
+    __slots__ = ('_ttl', '_stale', '_lock', '_value', '_expires', '_generation', '_refreshing', 'hits', 'misses', 'stale', 'refreshes')
+
+    def __init__(self, cell):
+        self._ttl = cell['ttl']
+        self._stale = 'stale_while_revalidate' in cell and bool(cell['stale_while_revalidate'])
+        self._lock = Lock()
+        self._value = None
+        self._expires = None
+        self._generation = 0
+        self._refreshing = False
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.refreshes = 0
+
+    # Return the value, calling 'function' when there is no usable result.  'executor' is
+    # called to get the pool for background refreshes.
+    def get(self, function, var, executor):
+        self._lock.acquire()
+
+        if self._expires is not None:
+            if time.monotonic() < self._expires:
+                self.hits += 1
+                value = self._value
+                self._lock.release()
+                return value
+
+            if self._stale:
+                self.stale += 1
+                value = self._value
+                refresh = not self._refreshing
+                self._refreshing = True
+                generation = self._generation
+                self._lock.release()
+
+                if refresh:
+                    executor().submit(self._refresh, function, var, generation)
+
+                return value
+
+        self.misses += 1
+        generation = self._generation
+        self._lock.release()
+
+        value = function("get", var)
+        self._update(value, generation)
+
+        return value
+
+    def _refresh(self, function, var, generation):
+        try:
+            value = function("get", var)
+            self._update(value, generation, refreshed=True)
+
+        except Exception as e:
+            syslog.syslog("Varstore refresh of '%s' failed: %s" % (var, e))
+
+        finally:
+            self._lock.acquire()
+            self._refreshing = False
+            self._lock.release()
+
+    # Keep 'value' unless the cache was invalidated since it was requested
+    def _update(self, value, generation, refreshed=False):
+        self._lock.acquire()
+
+        if generation == self._generation:
+            self._value = value
+            self._expires = time.monotonic() + self._ttl
+
+            if refreshed:
+                self.refreshes += 1
+
+        self._lock.release()
+
+    def invalidate(self):
+        self._lock.acquire()
+        self._value = None
+        self._expires = None
+        self._generation += 1
+        self._lock.release()
+
+    def stats(self):
+        return { 'hits': self.hits, 'misses': self.misses, 'stale': self.stale, 'refreshes': self.refreshes }
+
+# Compact form of a cell (Varstore(compact=True)): the value, shared attributes and any
+# internal ('_') per-cell state.  Behaves as the cell dict it was built from.
+class _Cell():
+    __slots__ = ('value', 'meta', 'state')
+
+    def __init__(self, meta, value, state=None):
+        self.value = value
+        self.meta = meta
+        self.state = state
+
+    def __getitem__(self, key):
+        if key == 'value':
+            return self.value
+
+        if key in self.meta.attributes:
+            return self.meta.attributes[key]
+
+        if key == VALIDATOR:
+            return self.meta.validator
+
+        if self.state is not None and key in self.state:
+            return self.state[key]
+
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'value':
+            self.value = value
+
+        elif key == VALIDATOR:
+            # Derived from the (shared) attributes
+            self.meta.validator = value
+
+        elif key.startswith('_'):
+            if self.state is None:
+                self.state = {}
+
+            self.state[key] = value
+
+        else:
+            # Stop sharing the attributes
+            attributes = dict(self.meta.attributes)
+            attributes[key] = value
+            self.meta = _CellMeta(attributes)
+
+    def __delitem__(self, key):
+        if key in self.meta.attributes:
+            attributes = dict(self.meta.attributes)
+            del attributes[key]
+            self.meta = _CellMeta(attributes)
+
+        elif self.state is not None and key in self.state:
+            del self.state[key]
+
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key == 'value' or key in self.meta.attributes or key == VALIDATOR or (self.state is not None and key in self.state)
+
+    def __iter__(self):
+        yield 'value'
+
+        for key in self.meta.attributes:
+            yield key
+
+        yield VALIDATOR
+
+        if self.state is not None:
+            for key in self.state:
+                yield key
+
+    def __len__(self):
+        return 2 + len(self.meta.attributes) + (len(self.state) if self.state is not None else 0)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [ (key, self[key]) for key in self ]
+
+    def copy(self):
+        return _Cell(self.meta, self.value, dict(self.state) if self.state is not None else None)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+# True if the var names 'names' match the pattern elements 'elements': globs for single
+# names or '**' for any number of them
+def _match_path(elements, names):
+    if not elements:
+        return not names
+
+    if elements[0] == '**':
+        return any(_match_path(elements[1:], names[i:]) for i in range(len(names) + 1))
+
+    return len(names) > 0 and fnmatchcase(names[0], elements[0]) and _match_path(elements[1:], names[1:])
+
+# True if 'cell' has the attributes named by list 'attributes' or the values of dict 'attributes'
+def _match_attributes(cell, attributes):
+    if isinstance(attributes, dict):
+        return all(name in cell and cell[name] == attributes[name] for name in attributes)
+
+    return all(name in cell for name in attributes)
+
+# Values that are their own copy
+_IMMUTABLE = (str, int, float, bool, type(None))
+
+# Hashable form of an attribute value (for sharing cell attributes)
+def _freeze(value):
+    if value.__class__ in _IMMUTABLE:
+        return value
+
+    if isinstance(value, (list, tuple)):
+        return (type(value),) + tuple(_freeze(v) for v in value)
+
+    if isinstance(value, dict):
+        return (dict,) + tuple(sorted((k, _freeze(v)) for (k, v) in value.items()))
+
+    return value
+
+# Atomically replace 'filename' with 'data': write a temp file, fsync and rename over.
+# Returns the size of the file written.
+def _write_file(filename, data):
+    dirname = os.path.dirname(filename)
+
+    # Try to create subdirs
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname, exist_ok=True)
+
+    tempname = "%s.%d.%d.tmp" % (filename, os.getpid(), get_ident())
+    fd = os.open(tempname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+
+    try:
+        with os.fdopen(fd, "wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            size = os.fstat(f.fileno()).st_size
+
+        os.replace(tempname, filename)
+
+        return size
+
+    except:
+        os.unlink(tempname)
+        raise
+
+#
+# Storage backends.
+#
+# A backend turns the saved values of a store into a file and back again:
+#   Read(filename)               -> list of (var, values) records, merged in order by Load.
+#                                   'var' is None for the whole store.
+#   Encode(values)               -> serialized form of the complete saved values.
+#   Write(filename, encoded)     -> replace the file contents with an Encode()d store.
+#                                   Returns the number of bytes written.
+#   Append(filename, var, value) -> record a single change.  Returns False if the backend
+#                                   wants a full Write instead, otherwise the number of
+#                                   bytes written.
+# Optionally:
+#   Sections(filename)           -> { top-level var: loader } where loader() returns the
+#                                   values of that var.  Load then defers merging each table
+#                                   until it is first used.
+#
+
+# The plain JSON snapshot: the whole store is rewritten on every save.
+class VarstoreStorage():
+    def Read(self, filename):
+        with open(filename, "r") as f:
+            return [ (None, json.load(f)) ]
+
+    def Encode(self, values):
+        return json.dumps(values, indent=3, sort_keys=True) + "\n"
+
+    def Write(self, filename, encoded):
+        return _write_file(filename, encoded)
+
+    def Append(self, filename, var, value):
+        return False
+
+# Decodes the pickled values of binary snapshots: plain values only, no classes are loaded
+class _ValuesUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError("%s.%s not allowed in a binary varstore file" % (module, name))
+
+def _unpickle_values(data):
+    return _ValuesUnpickler(io.BytesIO(data)).load()
+
+# A compact binary snapshot: 'VSB', a format version, the length of the index, the index
+# ({ top-level var: (offset, length) }) and the encoded values of each top-level var.
+# The file is memory mapped and each section is decoded only when asked for.
+# Version '2' is pickle protocol 4, readable by any Python 3.4 or later.  Files of any other
+# version are refused.
+class VarstoreBinaryStorage(VarstoreStorage):
+    MAGIC = b'VSB'
+    VERSION = b'2'
+    PROTOCOL = 4
+
+    # Decoder of each version
+    DECODERS = {
+        b'2': _unpickle_values,
+    }
+
+    def Read(self, filename):
+        sections = self.Sections(filename)
+        return [ (None, { var: sections[var]() for var in sections }) ]
+
+    def Encode(self, values):
+        index = {}
+        sections = []
+        offset = 0
+
+        for var in values:
+            section = pickle.dumps(values[var], protocol=self.PROTOCOL)
+            index[var] = (offset, len(section))
+            sections.append(section)
+            offset += len(section)
+
+        header = pickle.dumps(index, protocol=self.PROTOCOL)
+
+        return self.MAGIC + self.VERSION + struct.pack("<I", len(header)) + header + b"".join(sections)
+
+    def Sections(self, filename):
+        with open(filename, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if data[:3] != self.MAGIC:
+            raise ValueError("not a binary varstore file")
+
+        decode = self.DECODERS.get(data[3:4])
+        if decode is None:
+            raise ValueError("unknown binary varstore version %r" % data[3:4])
+
+        (length,) = struct.unpack_from("<I", data, 4)
+        index = decode(data[8:8 + length])
+        base = 8 + length
+
+        return { var: self._loader(decode, data, base + offset, size) for (var, (offset, size)) in index.items() }
+
+    def _loader(self, decode, data, offset, size):
+        return lambda: decode(data[offset:offset + size])
+
+# A JSON snapshot plus an append-only journal ('<filename>.journal') of changes made since.
+# Each journal line is a JSON [ var, value ] record.  Once the journal grows past
+# 'max_entries' records or 'max_size' bytes, the next change is saved as a fresh snapshot
+# and the journal is started over.
+#
+# Each record is fsynced ('sync') so a change is on disk once Set returns.  sync=False
+# saves the fsync of every change, but the last changes before a power failure or OS crash
+# may be lost (never the snapshot, nor records before them).
+#
+# Every snapshot gets the next generation number ('@journal' in the snapshot) and the
+# journal started after it opens with a { "generation": n } line.  A journal of another
+# generation than the snapshot (left by a crash between writing a snapshot and removing the
+# old journal) is already in the snapshot and is not replayed.  Files written before
+# generations were kept are generation 0.
+class VarstoreJournalStorage(VarstoreStorage):
+    GENERATION = '@journal'
+
+    def __init__(self, max_entries=1000, max_size=1024 * 1024, sync=True):
+        self._max_entries = max_entries
+        self._max_size = max_size
+        self._sync = sync
+        self._entries = {}
+        self._generations = {}
+
+    def _journal(self, filename):
+        return filename + ".journal"
+
+    def Read(self, filename):
+        journal = self._journal(filename)
+        have_journal = os.access(journal, os.F_OK)
+        have_snapshot = not have_journal or os.access(filename, os.F_OK)
+
+        records = []
+        generation = 0
+
+        # A missing snapshot is fine as long as there is a journal to replay
+        if have_snapshot:
+            records = super(VarstoreJournalStorage, self).Read(filename)
+            generation = records[0][1].pop(self.GENERATION, 0)
+
+        if have_journal:
+            with open(journal, "rb") as f:
+                lines = f.read().splitlines(True)
+
+            if have_snapshot and self._header(lines) != generation:
+                # Left over from before the snapshot was written
+                os.unlink(journal)
+                lines = []
+
+            entries = 0
+            length = 0
+            for index, line in enumerate(lines):
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete record")
+
+                    if line.strip() and not (index == 0 and line.startswith(b"{")):
+                        (var, value) = json.loads(line.decode("utf-8"))
+                        records.append((var, value))
+                        entries += 1
+
+                except ValueError:
+                    # Only the last record can be torn by a crash during append
+                    if index < len(lines) - 1:
+                        raise
+
+                    # Cut it off so further appends start on a clean line
+                    with open(journal, "r+b") as f:
+                        f.truncate(length)
+
+                    break
+
+                length += len(line)
+
+            if not have_snapshot:
+                generation = self._header(lines)
+
+            self._entries[filename] = entries
+
+        self._generations[filename] = generation
+
+        return records
+
+    # Generation of the journal 'lines' (0 if it has none)
+    def _header(self, lines):
+        if lines and lines[0].startswith(b"{") and lines[0].endswith(b"\n"):
+            return json.loads(lines[0].decode("utf-8"))["generation"]
+
+        return 0
+
+    # The values are encoded by Write, with the generation of the snapshot
+    def Encode(self, values):
+        return values
+
+    def Write(self, filename, encoded):
+        journal = self._journal(filename)
+
+        # Unless Read, differ from the generation of any journal there is
+        generation = self._generations.get(filename)
+        if generation is None:
+            generation = 0
+            if os.access(journal, os.F_OK):
+                with open(journal, "rb") as f:
+                    generation = self._header([ f.readline() ])
+
+        generation += 1
+
+        values = dict(encoded)
+        values[self.GENERATION] = generation
+        size = super(VarstoreJournalStorage, self).Write(filename, super(VarstoreJournalStorage, self).Encode(values))
+
+        # The snapshot now holds everything in the journal
+        if os.access(journal, os.F_OK):
+            os.unlink(journal)
+
+        self._entries[filename] = 0
+        self._generations[filename] = generation
+
+        return size
+
+    def Append(self, filename, var, value):
+        journal = self._journal(filename)
+
+        if filename not in self._entries:
+            # Unknown journal state - start from a clean snapshot
+            return False
+
+        if self._entries[filename] >= self._max_entries:
+            return False
+
+        if os.access(journal, os.F_OK) and os.path.getsize(journal) >= self._max_size:
+            return False
+
+        record = (json.dumps([ var, value ], sort_keys=True) + "\n").encode("utf-8")
+
+        if not os.access(journal, os.F_OK):
+            record = (json.dumps({ "generation": self._generations[filename] }) + "\n").encode("utf-8") + record
+
+        with open(journal, "ab") as f:
+            f.write(record)
+            if self._sync:
+                f.flush()
+                os.fsync(f.fileno())
+
+        self._entries[filename] += 1
+
+        return len(record)
+
+# Each table 'depth' levels down (and the other values of each table above that) in its own
+# JSON file under the directory 'filename': '<dir>/<var>/<var>.json' for the tables and
+# '<dir>/<var>/@.json' for the other values.  A shard is ( <var names>, <other values> ).
+# Varstore writes just the shards changed since the last save with WriteShards() and the
+# files are read by 'workers' threads in parallel.
+#
+# '<dir>/@manifest' lists the shard files written, so other files in the directory are
+# neither read nor removed.  A directory without one (written before manifests were kept)
+# has every .json file in it taken as a shard, as it was then.
+class VarstoreShardedStorage(VarstoreStorage):
+    REST = '@.json'
+    MANIFEST = '@manifest'
+
+    def __init__(self, depth=1, workers=4):
+        self._depth = depth
+        self._workers = workers
+
+    def Read(self, filename):
+        names = self._manifest(filename)
+
+        if names is None:
+            names = self._found(filename)
+
+            if not names:
+                raise FileNotFoundError(filename)
+
+        files = [ self._path(filename, name) for name in sorted(names) ]
+
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            contents = list(executor.map(self._readFile, files))
+
+        values = {}
+
+        for (path, data) in zip(files, contents):
+            # Listed, but removed before the manifest was rewritten
+            if data is None:
+                continue
+
+            table = values
+            for name in self._shardOfFile(filename, path)[0]:
+                table = table.setdefault(name, {})
+
+            table.update(data)
+
+        return [ (None, values) ]
+
+    def _readFile(self, path):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+
+        except FileNotFoundError:
+            return None
+
+    # Names (relative paths, '/' separated) of the shard files listed in the directory
+    # 'filename', None if it has no manifest
+    def _manifest(self, filename):
+        try:
+            with open(os.path.join(filename, self.MANIFEST), "r") as f:
+                return set(json.load(f))
+
+        except FileNotFoundError:
+            return None
+
+    # Names of the .json files in the directory 'filename'
+    def _found(self, filename):
+        names = set()
+        for (dirpath, dirnames, filenames) in os.walk(filename):
+            names.update(self._name(filename, os.path.join(dirpath, name)) for name in filenames if name.endswith('.json'))
+
+        return names
+
+    def _writeManifest(self, filename, names):
+        return _write_file(os.path.join(filename, self.MANIFEST), json.dumps(sorted(names), indent=3) + "\n")
+
+    def _name(self, filename, path):
+        return os.path.relpath(path, filename).replace(os.sep, '/')
+
+    def _path(self, filename, name):
+        return os.path.join(filename, *name.split('/'))
+
+    # Split into { shard: values }
+    def Encode(self, values):
+        shards = {}
+        self._split(values, (), shards)
+        return shards
+
+    def _split(self, values, names, shards):
+        if len(names) == self._depth:
+            shards[(names, False)] = values
+
+        else:
+            shards[(names, True)] = { var: values[var] for var in values if not isinstance(values[var], dict) }
+
+            for var in values:
+                if isinstance(values[var], dict):
+                    self._split(values[var], names + (var,), shards)
+
+    # Write all shards and remove the files of any others listed in the manifest
+    def Write(self, filename, encoded):
+        return self._writeShards(filename, encoded, stale=True)
+
+    # Write { shard: values } (None removes the shard).  Returns the number of bytes written.
+    def WriteShards(self, filename, shards):
+        return self._writeShards(filename, shards)
+
+    # <stale> also removes the listed files of shards not in <shards>.  New files are listed
+    # before they are written and removed ones unlisted after, so the manifest always lists
+    # every shard file there is.
+    def _writeShards(self, filename, shards, stale=False):
+        names = self._manifest(filename)
+        listed = names is not None
+
+        if not listed:
+            names = self._found(filename)
+
+        paths = { shard: self._shardFile(filename, shard) for shard in shards }
+
+        written = set(self._name(filename, paths[shard]) for shard in shards if shards[shard] is not None)
+        removed = set(self._name(filename, paths[shard]) for shard in shards if shards[shard] is None)
+
+        if stale:
+            removed |= names - written
+
+        size = 0
+
+        if not listed or not written <= names:
+            names |= written
+            size += self._writeManifest(filename, names)
+
+        jobs = [ (paths[shard], shards[shard]) for shard in shards if shards[shard] is not None ] + [ (self._path(filename, name), None) for name in removed ]
+
+        if jobs:
+            with ThreadPoolExecutor(max_workers=self._workers) as executor:
+                for result in [ executor.submit(self._writeShard, path, values) for (path, values) in jobs ]:
+                    size += result.result()
+
+        if removed & names:
+            size += self._writeManifest(filename, names - removed)
+
+        return size
+
+    def _writeShard(self, path, values):
+        if values is not None:
+            return _write_file(path, json.dumps(values, indent=3, sort_keys=True) + "\n")
+
+        if os.access(path, os.F_OK):
+            os.unlink(path)
+
+        return 0
+
+    # The shard holding the var with names 'names'
+    def ShardOf(self, names):
+        if len(names) > self._depth:
+            return (tuple(names[:self._depth]), False)
+
+        return (tuple(names[:-1]), True)
+
+    def _shardFile(self, filename, shard):
+        (names, rest) = shard
+        parts = [ quote(name, safe='').replace('.', '%2E') for name in names ]
+
+        if rest:
+            return os.path.join(filename, *parts, self.REST)
+
+        return os.path.join(filename, *parts[:-1], parts[-1] + '.json')
+
+    def _shardOfFile(self, filename, path):
+        parts = os.path.relpath(path, filename).split(os.sep)
+
+        if parts[-1] == self.REST:
+            return (tuple(unquote(part) for part in parts[:-1]), True)
+
+        return (tuple(unquote(part) for part in parts[:-1]) + (unquote(parts[-1][:-5]),), False)
+
+# Collects changes made with Set() and applies them with a single Varstore.SetMany() when
+# the 'with' block completes without an exception.
+class VarstoreTransaction():
+    def __init__(self, varstore, **kwargs):
+        self._varstore = varstore
+        self._kwargs = kwargs
+        self._changes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self._changes:
+            self._varstore.SetMany(self._changes, **self._kwargs)
+
+        return False
+
+    def Set(self, var, value):
+        self._changes[var] = value
+
+    # Pending value if set in this transaction, otherwise the stored value
+    def Get(self, var, **kwargs):
+        if var in self._changes:
+            return self._changes[var]
+
+        return self._varstore.Get(var, **kwargs)
+
+# A Subscribe()d callback.  Notifications are queued per subscriber and delivered in order
+# by at most one pool thread at a time.
+class _Subscriber():
+    __slots__ = ('prefix', 'callback', '_pending', '_lock', '_scheduled')
+
+    def __init__(self, prefix, callback):
+        self.prefix = prefix
+        self.callback = callback
+        self._pending = deque()
+        self._lock = Lock()
+        self._scheduled = False
+
+    def notify(self, executor, path, value):
+        self._lock.acquire()
+        self._pending.append((path, value))
+        schedule = not self._scheduled
+        self._scheduled = True
+        self._lock.release()
+
+        if schedule:
+            executor.submit(self._deliver)
+
+    def _deliver(self):
+        while True:
+            self._lock.acquire()
+            if not self._pending:
+                self._scheduled = False
+                self._lock.release()
+                break
+
+            (path, value) = self._pending.popleft()
+            self._lock.release()
+
+            try:
+                self.callback(path, value)
+
+            except Exception as e:
+                syslog.syslog("Varstore subscriber %s for '%s' failed: %s" % (self.callback, self.prefix, e))
+
+# A dict that can't be changed: the results shared through the export cache.  Copies are
+# plain dicts.
+class _ReadOnlyDict(dict):
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Varstore export results are shared and read-only (change a copy)")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+# Count, total, maximum and power of two buckets ('<= n us': count) of durations
+class _Histogram():
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = {}
+
+    def add(self, value, scale=1e6):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+        bound = 1 << int(value * scale).bit_length()
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+
+    def report(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0,
+            'max': self.max,
+            'buckets': dict(sorted(self.buckets.items())),
+        }
+
+# Measurements of Varstore(instrument=True)
+class _VarstoreStats():
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.latency = {}
+        self.lock_wait = {}
+        self.callables = {}
+        self.save_bytes = _Histogram()
+        self.vars = {}
+
+    def _histogram(self, table, key):
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = _Histogram()
+
+        return histogram
+
+    def operation(self, op, seconds, var=None):
+        self._lock.acquire()
+        self._histogram(self.latency, op).add(seconds)
+        if var is not None:
+            if op not in self.vars:
+                self.vars[op] = Counter()
+            self.vars[op][var] += 1
+        self._lock.release()
+
+    def waited(self, name, seconds):
+        self._lock.acquire()
+        self._histogram(self.lock_wait, name).add(seconds)
+        self._lock.release()
+
+    def called(self, name, seconds):
+        self._lock.acquire()
+        self._histogram(self.callables, name).add(seconds)
+        self._lock.release()
+
+    def saved(self, size):
+        self._lock.acquire()
+        self.save_bytes.add(size, scale=1)
+        self._lock.release()
+
+    def report(self, reset=False):
+        self._lock.acquire()
+
+        try:
+            report = {
+                'operations': { op: h.report() for (op, h) in self.latency.items() },
+                'lock_wait': { name: h.report() for (name, h) in self.lock_wait.items() },
+                'callables': { name: h.report() for (name, h) in self.callables.items() },
+                'save_bytes': self.save_bytes.report(),
+                'hot_vars': { op: counter.most_common(STATS_HOT_VARS) for (op, counter) in self.vars.items() },
+            }
+
+            if reset:
+                self.reset()
+
+            return report
+
+        finally:
+            self._lock.release()
+
+# A lock recording how long each acquire waited
+class _InstrumentedLock():
+    def __init__(self, lock, stats, name):
+        self._lock = lock
+        self._stats = stats
+        self._name = name
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        self._stats.waited(self._name, time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+class Varstore():
+    def __init__(self, schema=None, filename=None, propagate=None, path_cache=True, write_behind=None, storage=None, snapshots=False, delta_propagate=False, notify_workers=4, compact=False, export_cache=False, instrument=False):
+        self._lock = Lock()
+        self._filename = filename
+        self._propagate = propagate
+        self._loaded = False
+
+        # Delta propagation: the propagate callable is called as propagate(values, full) with
+        # either { 'path': value, ... } of the vars changed since the last propagate (full=False)
+        # or the complete value tree (full=True) on the first propagate and after structural
+        # changes.
+        self._delta_propagate = delta_propagate
+        self._changes_lock = Lock()
+        self._propagate_changes = {}
+        self._propagate_full = True
+
+        # Subscriptions: normalized var name ('' for all) -> tuple of _Subscriber.  The index is
+        # replaced (never changed) so notification needs no lock.  Snapshot mode writers hold
+        # their notifications until the change is published.
+        self._subscribers = {}
+        self._subscribe_lock = Lock()
+        self._notify_workers = notify_workers
+        self._notify_executor = None
+        self._notes = []
+
+        # Export cache: Export() and GetAttributes() results for tables are kept and reused
+        # while the structure epoch is unchanged and so is the table: in snapshot mode the
+        # same (never changed) table object, otherwise the same generation of the table (bumped
+        # by any change below it).  Cached results are shared between callers, so they are
+        # read-only dicts.
+        self._export_cache = export_cache
+        self._generation_counter = itertools.count(1)
+        self._generations = {}
+        self._epoch = 0
+        self._exports = {}
+
+        # Path index for Query(): ( <sorted var paths>, { path: <split var names> } ).  Built
+        # on first use and kept up to date by AddSchema, AddVarstore and Delete.  The generation
+        # counts the changes made to it: an index built meanwhile is thrown away.
+        self._index = None
+        self._index_lock = Lock()
+        self._index_generation = 0
+
+        # A subtree was replaced by the writer: the index is dropped once the change is made
+        self._restructured = False
+
+        # Sharded storage: names of the vars changed since the last save (None when all shards
+        # are to be written)
+        self._sharded = hasattr(storage, 'WriteShards')
+        self._shard_changes = None
+
+        # Runs awaitables returned by user-supplied functions (see SetAwaiter)
+        self._awaiter = None
+
+        # Background refreshes of cached callable values ('stale_while_revalidate')
+        self._refresh_lock = Lock()
+        self._refresh_executor = None
+        self._storage = storage if storage is not None else VarstoreStorage()
+
+        # Top-level tables whose loaded values are not merged yet: var -> loader
+        self._lazy = {}
+        self._lazy_lock = Lock()
+
+        # The store is published as ( <store>, <resolved paths>, <version> ) so a reader picks
+        # up a store and the path cache that belongs to it with a single reference.
+        #
+        # Snapshot mode: a published store is never modified.  Writers (serialized by _lock)
+        # change private copies of the cells they touch and publish a new version, so readers
+        # take no lock and always see a consistent store.
+        self._snapshots = snapshots
+
+        # Compact mode: cells are _Cell objects with interned names and shared attributes
+        # instead of copies of the schema dicts.
+        self._compact = compact
+        self._metas = {}
+
+        if compact:
+            store = self._compactSchema(schema)
+        else:
+            store = self._compileSchema(deepcopy(schema))
+
+        self._snapshot = (store, {}, 0)
+        self._replaced = None
+        self._owned = None
+        self._writer = None
+
+        # Path cache: 'var' -> split var list and 'var' -> (saved, location, protection, table).
+        # The resolved locations are only valid while the store structure is unchanged.
+        self._path_cache = path_cache
+        self._split_paths = {}
+
+        # Write-behind: when 'write_behind' is a debounce time (seconds), Save only marks
+        # the store dirty and a background flusher writes it once the burst has settled.
+        self._write_behind = write_behind
+        self._save_lock = Lock()
+
+        # Serializes writing the file (and journal) with capturing the values written.
+        # Snapshots are captured without the store lock, so only file writers need to wait.
+        self._persist_lock = self._save_lock if snapshots else self._lock
+        self._save_signal = Condition(Lock())
+        self._save_pending = None
+        self._save_error = None
+        self._closing = False
+        self._flusher = None
+
+        # Instrumentation: operation latencies, lock waits, save sizes and callable times
+        # (read with Stats())
+        self._stats = None
+
+        if instrument:
+            self._stats = _VarstoreStats()
+            self._lock = _InstrumentedLock(self._lock, self._stats, 'store')
+            self._save_lock = _InstrumentedLock(self._save_lock, self._stats, 'save')
+            self._persist_lock = self._save_lock if snapshots else self._lock
+
+            for op in INSTRUMENTED:
+                setattr(self, op, self._timed(op, getattr(self, op)))
+
+        if write_behind is not None:
+            self._flusher = Thread(target=self._flusherRun, name="varstore-flusher", daemon=True)
+            self._flusher.start()
+            atexit.register(_flush_at_exit, weakref.ref(self))
+
+    @property
+    def _store(self):
+        return self._snapshot[0]
+
+    # Number of changes published (snapshot mode) or structure changes (otherwise)
+    def Version(self):
+        return self._snapshot[2]
+
+    def AddSchema(self, schema):
+        if isinstance(schema, dict):
+            self._beginWrite()
+
+            try:
+                store = self._writableTable(self._store)
+
+                # Replaced tables start from the schema defaults
+                for key in schema:
+                    self._lazy.pop(key, None)
+
+                if self._compact:
+                    store.update(self._compactSchema(schema))
+
+                else:
+                    for key in schema:
+                        store[key] = deepcopy(schema[key])
+
+                    self._compileSchema(store, schema)
+
+                self._commit(store, structure=True)
+                self._reindex(schema, store)
+
+            finally:
+                self._endWrite()
+
+    # Attach a compiled validator to each cell of 'table' (or of the 'table' cells named by 'keys')
+    def _compileSchema(self, table, keys=None):
+        if isinstance(table, dict):
+            for var in (keys if keys is not None else table):
+                cell = table[var]
+
+                if isinstance(cell, dict):
+                    cell[VALIDATOR] = _compile_cell(cell)
+
+                    if 'ttl' in cell:
+                        cell[CACHE] = _CallableCache(cell)
+
+                    if 'value' in cell and isinstance(cell['value'], dict):
+                        self._compileSchema(cell['value'])
+
+        return table
+
+    # Build the compact form of a schema table.  'templates' maps schema cells already seen
+    # (the same template used more than once) to their attributes.
+    def _compactSchema(self, table, templates=None):
+        if not isinstance(table, dict):
+            return deepcopy(table)
+
+        if templates is None:
+            templates = {}
+
+        compact = {}
+
+        for var in table:
+            cell = table[var]
+            name = sys.intern(var) if isinstance(var, str) else var
+
+            if isinstance(cell, dict) and 'value' in cell:
+                value = cell['value']
+
+                if isinstance(value, dict):
+                    value = self._compactSchema(value, templates)
+
+                elif value.__class__ not in _IMMUTABLE and not callable(value):
+                    value = deepcopy(value)
+
+                meta = templates.get(id(cell))
+                if meta is None:
+                    meta = templates[id(cell)] = self._cellMeta(cell)
+
+                compact[name] = _Cell(meta, value, { CACHE: _CallableCache(cell) } if 'ttl' in cell else None)
+
+            else:
+                compact[name] = deepcopy(cell)
+
+        return compact
+
+    # Shared attributes for a schema cell
+    def _cellMeta(self, cell):
+        attributes = { sys.intern(k): cell[k] for k in cell if k != 'value' and k != VALIDATOR }
+
+        try:
+            key = frozenset((k, _freeze(v)) for (k, v) in attributes.items())
+            meta = self._metas.get(key)
+
+        except TypeError:
+            # Unhashable attribute - not shared
+            key = None
+            meta = None
+
+        if meta is None:
+            meta = _CellMeta(deepcopy(attributes))
+
+            if key is not None:
+                self._metas[key] = meta
+
+        return meta
+
+    # Forget all resolved var locations (store structure has changed)
+    def _invalidatePaths(self):
+        if self._export_cache:
+            self._newEpoch()
+
+        if self._sharded:
+            self._shard_changes = None
+
+        if self._snapshots:
+            # Writer in progress - the published path cache is dropped by _commit
+            self._replaced = None
+
+        else:
+            (store, resolved, version) = self._snapshot
+            self._snapshot = (store, {}, version + 1)
+
+    # Start a change to the store.  In snapshot mode this serializes writers.
+    def _beginWrite(self, lock=False):
+        if self._snapshots or lock:
+            self._lock.acquire()
+
+        if self._snapshots:
+            # Cells copied out of the published store, and the private copies made so far
+            self._replaced = set()
+            self._owned = set()
+            self._writer = get_ident()
+
+    def _endWrite(self, lock=False):
+        if self._snapshots:
+            self._replaced = None
+            self._owned = None
+            self._notes = []
+            self._writer = None
+
+        if self._restructured:
+            self._restructured = False
+            self._dropIndex()
+
+        if self._snapshots or lock:
+            self._lock.release()
+
+    # Return a version of 'table' that may be changed by the writer: in snapshot mode a copy,
+    # with private copies of the cells (and nested tables) named by 'changes'.
+    def _writableTable(self, table, changes=None):
+        if self._snapshots and isinstance(table, dict):
+            if id(table) not in self._owned:
+                table = dict(table)
+                self._owned.add(id(table))
+
+            if changes is not None:
+                for var in changes:
+                    if var in table:
+                        cell = self._writableCell(table, var)
+
+                        if isinstance(changes[var], dict):
+                            cell['value'] = self._writableTable(cell['value'], changes[var])
+
+        return table
+
+    # Replace table[var] with a private copy of the cell (snapshot mode writers only)
+    def _writableCell(self, table, var):
+        cell = table[var]
+
+        if id(cell) not in self._owned:
+            if self._replaced is not None:
+                self._replaced.add(id(cell))
+
+            cell = cell.copy()
+            table[var] = cell
+            self._owned.add(id(cell))
+
+        return cell
+
+    # Locate a var for changing.  Returns (saved, store, table, location), where 'table'
+    # contains the 'location' cell and 'store' is the root to _commit when done.
+    # 'store' continues a write already in progress on that (writable) store.
+    @default_kwargs(protection=DEFAULT_PROTECTION, store=None)
+    def _writablePath(self, var, **kwargs):
+        store = kwargs.pop('store')
+        if store is None:
+            store = self._store
+
+        (saved, var_location, table) = self._findVar(var, store, container=True, **kwargs)
+
+        if not self._snapshots:
+            return (saved, store, table, var_location)
+
+        # Copy the cells down the path.  Tables produced by callables aren't part of the store.
+        var_list = self._splitVar(var)
+        store = table = self._writableTable(store)
+        owned = True
+
+        for v in var_list[:-1]:
+            var_location = self._writableCell(table, v) if owned else table[v]
+            value = var_location['value']
+
+            if callable(value):
+                table = self._call(value, 'get', v)
+                owned = False
+
+            elif owned:
+                table = var_location['value'] = self._writableTable(value)
+
+            else:
+                table = value
+
+        var_location = self._writableCell(table, var_list[-1]) if owned else table[var_list[-1]]
+
+        return (saved, store, table, var_location)
+
+    # Make the changes visible: publish the new snapshot or note structural changes.
+    def _commit(self, store, structure=False):
+        if self._snapshots:
+            (old_store, resolved, version) = self._snapshot
+
+            # Keep the resolved paths whose cells were not copied
+            if structure or self._replaced is None:
+                resolved = {}
+
+            else:
+                replaced = self._replaced
+                resolved = { var: r for (var, r) in list(resolved.items()) if id(r[1]) not in replaced }
+
+            self._snapshot = (store, resolved, version + 1)
+
+            # Now visible to readers
+            (notes, self._notes) = (self._notes, [])
+            for (path, value) in notes:
+                self._published(path, value)
+
+        elif structure:
+            self._invalidatePaths()
+
+        if structure and self._snapshots and self._export_cache:
+            self._newEpoch()
+
+        if structure and self._sharded:
+            self._shard_changes = None
+
+        if structure and self._delta_propagate:
+            self._changes_lock.acquire()
+            self._propagate_full = True
+            self._changes_lock.release()
+
+        if structure and self._subscribers:
+            self._notifyStructure()
+
+    # 'storage' reads the file with another backend (e.g. a JSON file into a binary store)
+    @default_kwargs(propagate=True, storage=None)
+    def Load(self, filename = None, **kwargs):
+        if not self._loaded:
+            storage = kwargs['storage'] if kwargs['storage'] is not None else self._storage
+
+            self._beginWrite(lock=True)
+
+            try:
+                if filename is None:
+                    filename = self._filename
+
+                try:
+                    if hasattr(storage, 'Sections'):
+                        # Tables are merged on first use; anything else right now
+                        sections = storage.Sections(filename)
+                        records = []
+
+                        for var in sections:
+                            if var in self._store and isinstance(self._store[var]['value'], dict):
+                                self._lazy[var] = sections[var]
+                            else:
+                                records.append((None, { var: sections[var]() }))
+
+                    else:
+                        records = storage.Read(filename)
+
+                except Exception as e:
+                    raise VarstoreExceptionFile("Unable to read file", filename)
+
+                store = self._store
+
+                for (var, values) in records:
+                    if var is not None:
+                        values = self._nestVar(var, values)
+
+                    store = self._writableTable(store, values)
+                    self._mergeVarstore(store, values, protection=NO_PROTECTION)
+
+                self._commit(store)
+
+                # The shards match the file now
+                if self._sharded and storage is self._storage and filename == self._filename:
+                    self._shard_changes = set()
+
+                if kwargs['propagate']:
+                    self.Propagate()
+
+            except:
+                raise VarstoreExceptionFile("Unable to open file", filename)
+
+            finally:
+                self._endWrite(lock=True)
+
+            self._loaded = True
+
+    # 'storage' writes the file with another backend (e.g. a JSON copy for editing)
+    @default_kwargs(filename=None, propagate=True, callables=False, ignore_protected=True, not_saved=False, storage=None)
+    def Save(self, **kwargs):
+        filename = kwargs['filename'] if 'filename' in kwargs else None
+        storage = kwargs['storage'] if kwargs['storage'] is not None else self._storage
+
+        if self._lazy:
+            self._materializeAll()
+
+        if self._write_behind is not None and filename is None and kwargs['storage'] is None:
+            # Leave the write to the flusher; all saves within the debounce window become one.
+            self._save_signal.acquire()
+            self._save_pending = kwargs
+            self._save_signal.notify()
+            self._save_signal.release()
+
+            if kwargs['propagate']:
+                self._persist_lock.acquire()
+                try:
+                    self.Propagate()
+                finally:
+                    self._persist_lock.release()
+
+            return
+
+        self._persist_lock.acquire()
+
+        try:
+            if filename is None:
+                filename = self._filename
+
+            if filename:
+                # print("varstore Save on '%s'" % filename)
+                self._writeStore(storage, filename, self._encodeStore(storage, filename, kwargs))
+
+            # Propagate store if requested
+            if kwargs['propagate']:
+                self.Propagate()
+
+        except Exception as e:
+            raise VarstoreExceptionFile(str(e), filename)
+
+        finally:
+            self._persist_lock.release()
+
+    # Encode the store for writing to 'filename'.  Returns ( <shards>, <encoded> ) where
+    # <shards> is True when only the shards changed since the last save are in <encoded>.
+    def _encodeStore(self, storage, filename, kwargs):
+        changes = None
+
+        if self._sharded and storage is self._storage and filename == self._filename:
+            self._changes_lock.acquire()
+            (changes, self._shard_changes) = (self._shard_changes, set())
+            self._changes_lock.release()
+
+        if changes is None:
+            return (False, storage.Encode(self._valuesOf(self._store, **kwargs)))
+
+        shards = set(storage.ShardOf(names) for names in changes)
+
+        return (True, { shard: self._shardValues(shard, **kwargs) for shard in shards })
+
+    def _writeStore(self, storage, filename, data):
+        (shards, encoded) = data
+
+        try:
+            if shards:
+                size = storage.WriteShards(filename, encoded)
+            else:
+                size = storage.Write(filename, encoded)
+
+        except:
+            # Unknown which shards were written
+            if self._sharded:
+                self._shard_changes = None
+
+            raise
+
+        self._savedBytes(size)
+
+    # Count 'size' bytes written by the storage (None from backends that don't say)
+    def _savedBytes(self, size):
+        if self._stats is not None and size is not None and size is not True:
+            self._stats.saved(size)
+
+    # Saved values of a shard: the values of the table with var names 'names' or with 'rest'
+    # its values that aren't tables.  None if the table isn't saved.
+    @default_kwargs(callables=True, protection=DEFAULT_PROTECTION, ignore_protected=True, not_saved=True)
+    def _shardValues(self, shard, **kwargs):
+        (names, rest) = shard
+        table = self._store
+
+        for name in names:
+            cell = table.get(name) if isinstance(table, dict) else None
+
+            if cell is None or not isinstance(cell['value'], dict) or (not kwargs['not_saved'] and 'not_saved' in cell):
+                return None
+
+            protection = DEFAULT_PROTECTION if 'protection' not in cell else cell['protection']
+            if protection < kwargs['protection']:
+                if not kwargs['ignore_protected']:
+                    raise VarstoreExceptionProtectedVar(self._joinVar(None, name))
+
+                return None
+
+            table = cell['value']
+
+        if rest:
+            table = { var: table[var] for var in table if not isinstance(table[var]['value'], dict) }
+
+        return self._valuesOf(table, **kwargs)
+
+    # Write any pending write-behind save now.  Returns True if anything was written.
+    # A failed background write is retried here, and reported if there was nothing to retry.
+    def Flush(self):
+        (error, self._save_error) = (self._save_error, None)
+
+        flushed = self._flushPending()
+
+        if error is not None and not flushed:
+            raise error
+
+        return flushed
+
+    # Flush pending changes and stop the write-behind flusher
+    def Close(self):
+        if self._flusher is not None:
+            self._save_signal.acquire()
+            self._closing = True
+            self._save_signal.notify()
+            self._save_signal.release()
+
+            self._flusher.join()
+            self._flusher = None
+
+        self.Flush()
+
+        # Deliver outstanding notifications.  Subscriptions stay: a later change starts a new pool.
+        self._subscribe_lock.acquire()
+        (executor, self._notify_executor) = (self._notify_executor, None)
+        self._subscribe_lock.release()
+
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+        if self._refresh_executor is not None:
+            self._refresh_executor.shutdown(wait=True)
+            self._refresh_executor = None
+
+    def _flushPending(self):
+        self._save_lock.acquire()
+
+        try:
+            self._save_signal.acquire()
+            kwargs = self._save_pending
+            self._save_pending = None
+            self._save_signal.release()
+
+            if kwargs is None or not self._filename:
+                return False
+
+            try:
+                if self._lazy:
+                    self._materializeAll()
+
+                # Encode under the store lock (a snapshot needs none), but do the file I/O without it.
+                if self._snapshots:
+                    data = self._encodeStore(self._storage, self._filename, kwargs)
+
+                else:
+                    self._lock.acquire()
+                    try:
+                        data = self._encodeStore(self._storage, self._filename, kwargs)
+                    finally:
+                        self._lock.release()
+
+                self._writeStore(self._storage, self._filename, data)
+
+            except Exception as e:
+                # Still dirty: the next Flush, Close or flusher pass tries again (unless a newer
+                # save has taken its place)
+                self._save_signal.acquire()
+                if self._save_pending is None:
+                    self._save_pending = kwargs
+                self._save_signal.release()
+
+                raise VarstoreExceptionFile(str(e), self._filename)
+
+            return True
+
+        finally:
+            self._save_lock.release()
+
+    def _flusherRun(self):
+        self._save_signal.acquire()
+
+        while not self._closing:
+            if self._save_pending is None:
+                self._save_signal.wait()
+
+            else:
+                # Let the burst settle before writing
+                deadline = time.monotonic() + self._write_behind
+                remaining = self._write_behind
+                while remaining > 0 and not self._closing:
+                    self._save_signal.wait(remaining)
+                    remaining = deadline - time.monotonic()
+
+                self._save_signal.release()
+
+                try:
+                    self._flushPending()
+
+                    # A retry made it: nothing left to report
+                    self._save_error = None
+
+                except VarstoreException as e:
+                    # Reported on the next Flush() if that can't write either
+                    self._save_error = e
+
+                self._save_signal.acquire()
+
+        self._save_signal.release()
+
+    # Export all (including callables) to caller.
+    @default_kwargs(protection=DEFAULT_PROTECTION, callables=False)
+    def Export(self, **kwargs):
+        if self._lazy:
+            self._materializeAll()
+
+        if self._snapshots:
+            return self._exportOf(self._store, **kwargs)
+
+        self._lock.acquire()
+        varstore_data = self._exportOf(self._store, **kwargs)
+        self._lock.release()
+        return varstore_data
+
+    def _exportOf(self, store, **kwargs):
+        if self._export_cache:
+            return self._exportTable(store, None, **kwargs)[0]
+
+        return self._valuesOf(store, **kwargs)
+
+    # Values of 'table' (the table of var 'path', None for the store) as _valuesOf, reusing
+    # the results for tables unchanged since they were built.  Tables with callables
+    # included are always rebuilt.  Returns (values, cacheable).
+    @default_kwargs(callables=True, protection=DEFAULT_PROTECTION, ignore_protected=True, not_saved=True)
+    def _exportTable(self, table, path, **kwargs):
+        key = ('values', path, kwargs['protection'], kwargs['callables'], kwargs['not_saved'], kwargs['ignore_protected'])
+        stamp = self._exportStamp(table, path)
+
+        cached = self._cachedExport(key, stamp)
+        if cached is not None:
+            return (cached, True)
+
+        results = {}
+        cacheable = True
+
+        for var in table:
+            var_location = table[var]
+            value = var_location['value']
+
+            if (kwargs['callables'] or not callable(value)) and (kwargs['not_saved'] or 'not_saved' not in var_location):
+                value_protection = DEFAULT_PROTECTION if 'protection' not in var_location else var_location['protection']
+                if value_protection < kwargs['protection']:
+                    if not kwargs['ignore_protected']:
+                        raise VarstoreExceptionProtectedVar(var)
+
+                elif callable(value):
+                    results[var] = self._valuesOf(self._get_var_value(var_location, var, **kwargs), **kwargs)
+                    cacheable = False
+
+                elif isinstance(value, dict):
+                    (results[var], table_cacheable) = self._exportTable(value, self._joinVar(path, var), **kwargs)
+                    cacheable = cacheable and table_cacheable
+
+                else:
+                    results[var] = value
+
+        if cacheable:
+            results = _ReadOnlyDict(results)
+            self._exports[key] = (stamp, results)
+
+        return (results, cacheable)
+
+    # What a result built now from 'table' (of var 'path') is valid for.  Taken before building,
+    # so a change made meanwhile leaves a result that is never matched.
+    def _exportStamp(self, table, path):
+        if self._snapshots:
+            # Published tables are never changed: a result is as valid as the table it was built from
+            return (self._epoch, table)
+
+        return (self._epoch, self._generations.get(path, 0))
+
+    # The cached result for 'key' if it was built with the same stamp
+    def _cachedExport(self, key, stamp):
+        entry = self._exports.get(key)
+
+        if entry is not None and entry[0][0] == stamp[0] and (entry[0][1] is stamp[1] or (not self._snapshots and entry[0][1] == stamp[1])):
+            return entry[1]
+
+        return None
+
+    # Attributes of cell 'location' (of var 'path') as _get_attributes, reusing the results
+    # for tables unchanged since they were built
+    def _attributesOf(self, location, path):
+        if not isinstance(location['value'], dict):
+            return self._get_attributes(location)
+
+        key = ('attributes', path)
+        stamp = self._exportStamp(location['value'], path)
+
+        cached = self._cachedExport(key, stamp)
+        if cached is not None:
+            return cached
+
+        attributes = {}
+
+        for attribute in location:
+            if attribute == 'value':
+                table = location['value']
+                attributes['fields'] = { var: self._attributesOf(table[var], self._joinVar(path, var)) for var in table }
+
+            elif not callable(location[attribute]) and not attribute.startswith('_'):
+                attributes[attribute] = location[attribute]
+
+        attributes = _ReadOnlyDict(attributes)
+        self._exports[key] = (stamp, attributes)
+
+        return attributes
+
+    # A new generation for 'path' and each table above it (export cache)
+    def _bumpGenerations(self, path):
+        generation = next(self._generation_counter)
+        generations = self._generations
+
+        generations[None] = generation
+
+        if '"' in path:
+            prefix = None
+            for v in self._splitVar(path):
+                prefix = self._joinVar(prefix, v)
+                generations[prefix] = generation
+
+        else:
+            # No quoted names: the tables above are the parts before each '.'
+            end = path.find('.')
+            while end >= 0:
+                generations[path[:end]] = generation
+                end = path.find('.', end + 1)
+
+            generations[path] = generation
+
+    # Store structure changed: no cached export is valid
+    def _newEpoch(self):
+        self._epoch = next(self._generation_counter)
+        self._exports = {}
+
+    def Propagate(self, full=False):
+        if self._propagate is not None:
+            if self._lazy:
+                self._materializeAll()
+
+            if self._delta_propagate:
+                self._changes_lock.acquire()
+                changes = self._propagate_changes
+                self._propagate_changes = {}
+                full = full or self._propagate_full
+                self._propagate_full = False
+                self._changes_lock.release()
+
+                if full:
+                    self._call(self._propagate, self._valuesOf(self._store, protection=NO_PROTECTION), True)
+
+                elif changes:
+                    self._call(self._propagate, changes, False)
+
+            else:
+                # Propagate all values
+                self._call(self._propagate, self._valuesOf(self._store, protection=NO_PROTECTION))
+
+    # Merge the deferred loaded values of top-level table 'var' (if any).  'var' stays deferred
+    # until the merge is done, so other readers of it wait here for the merged values.
+    # In snapshot mode the merged table is published as a new snapshot, made as a writer (the
+    # lock order is always store lock, then _lazy_lock).  Writers merge the tables they change
+    # before starting; only hooks run by a writer get a merge in place.
+    def _materialize(self, var):
+        if var not in self._lazy:
+            return
+
+        publish = self._snapshots and self._writer != get_ident()
+
+        if publish:
+            self._beginWrite()
+
+        self._lazy_lock.acquire()
+
+        try:
+            loader = self._lazy.get(var)
+
+            if loader is not None:
+                try:
+                    values = { var: loader() }
+
+                except Exception as e:
+                    raise VarstoreExceptionFile("Unable to read section '%s'" % var, self._filename)
+
+                if publish:
+                    store = self._writableTable(self._store, values)
+                    self._mergeVarstore(store, values, protection=NO_PROTECTION, quiet=True)
+                    self._commit(store)
+
+                else:
+                    self._mergeVarstore(self._store, values, protection=NO_PROTECTION, quiet=True)
+
+                    # Tables changed in place
+                    if self._export_cache and self._snapshots:
+                        self._newEpoch()
+
+                self._lazy.pop(var, None)
+
+                if self._export_cache and not self._snapshots:
+                    self._bumpGenerations(var)
+
+        finally:
+            self._lazy_lock.release()
+
+            if publish:
+                self._endWrite()
+
+    # Merge the deferred tables holding 'vars' (before writing to them)
+    def _materializeVars(self, vars):
+        if self._lazy:
+            for var in vars:
+                self._materialize(self._splitVar(var)[0])
+
+    def _materializeAll(self):
+        for var in list(self._lazy):
+            self._materialize(var)
+
+    # Record a changed value for the next (delta) propagate and for subscribers
+    def _noteChange(self, path, value):
+        if self._snapshots:
+            # Held until the change is published (and dropped by a write that fails)
+            if self._subscribers or self._sharded or self._delta_propagate:
+                self._notes.append((path, value))
+
+        else:
+            self._published(path, value)
+
+    # A changed value is visible to readers
+    def _published(self, path, value):
+        if self._delta_propagate:
+            self._changes_lock.acquire()
+            self._propagate_changes[path] = value
+            self._changes_lock.release()
+
+        if self._export_cache and not self._snapshots:
+            self._bumpGenerations(path)
+
+        if self._sharded:
+            self._changes_lock.acquire()
+            if self._shard_changes is not None:
+                self._shard_changes.add(tuple(self._splitVar(path)) if '"' in path else tuple(path.split('.')))
+            self._changes_lock.release()
+
+        if self._subscribers:
+            self._notify(path, value)
+
+    # Call 'callback(path, value)' from the notification pool after each change to 'var' or
+    # (when 'var' is a table) any var below it.  None or '' subscribes to every change, and
+    # to 'callback(None, None)' when the structure changes (AddSchema, AddVarstore, Delete):
+    # vars added, replaced or removed aren't reported one by one.
+    # Returns a handle for Unsubscribe.
+    def Subscribe(self, var, callback):
+        prefix = self._normalizeVar(var) if var else ''
+        subscriber = _Subscriber(prefix, callback)
+
+        self._subscribe_lock.acquire()
+
+        try:
+            subscribers = dict(self._subscribers)
+            subscribers[prefix] = subscribers.get(prefix, ()) + (subscriber,)
+            self._subscribers = subscribers
+
+        finally:
+            self._subscribe_lock.release()
+
+        return subscriber
+
+    def Unsubscribe(self, subscriber):
+        self._subscribe_lock.acquire()
+
+        try:
+            subscribers = dict(self._subscribers)
+            remaining = tuple(s for s in subscribers.get(subscriber.prefix, ()) if s is not subscriber)
+
+            if remaining:
+                subscribers[subscriber.prefix] = remaining
+            elif subscriber.prefix in subscribers:
+                del subscribers[subscriber.prefix]
+
+            self._subscribers = subscribers
+
+        finally:
+            self._subscribe_lock.release()
+
+    # Queue notifications for subscribers of 'path' and each table above it
+    def _notify(self, path, value):
+        subscribers = self._subscribers
+        executor = self._notifier()
+
+        if '' in subscribers:
+            for subscriber in subscribers['']:
+                subscriber.notify(executor, path, value)
+
+        prefix = None
+        for v in self._splitVar(path):
+            prefix = self._joinVar(prefix, v)
+
+            if prefix in subscribers:
+                for subscriber in subscribers[prefix]:
+                    subscriber.notify(executor, path, value)
+
+    # Tell the subscribers to every change that the structure has changed
+    def _notifyStructure(self):
+        subscribers = self._subscribers
+
+        if '' in subscribers:
+            executor = self._notifier()
+
+            for subscriber in subscribers['']:
+                subscriber.notify(executor, None, None)
+
+    # The notification pool, started on first use (and again after a Close)
+    def _notifier(self):
+        executor = self._notify_executor
+
+        if executor is None:
+            self._subscribe_lock.acquire()
+
+            if self._notify_executor is None:
+                self._notify_executor = ThreadPoolExecutor(max_workers=self._notify_workers, thread_name_prefix="varstore-notify")
+
+            executor = self._notify_executor
+            self._subscribe_lock.release()
+
+        return executor
+
+    # Canonical form of a var name (as produced for change notifications)
+    def _normalizeVar(self, var):
+        prefix = None
+        for v in self._splitVar(var):
+            prefix = self._joinVar(prefix, v)
+
+        return prefix
+
+    # Var name of 'var' within 'prefix' (quoted if it contains the delimiter)
+    def _joinVar(self, prefix, var):
+        if '.' in var:
+            var = '"%s"' % var
+
+        return var if prefix is None else prefix + '.' + var
+
+    @default_kwargs(protection=DEFAULT_PROTECTION)
+    def Get(self, var, **kwargs):
+        (saved, var_location) = self._findVar(var, self._store, **kwargs)
+
+        # Get the (resolved callable) value
+        value =  self._get_var_value(var_location, var, **kwargs)
+
+        # Resolve any dict items
+        return self._valuesOf(value, **kwargs)
+
+    @default_kwargs(propagate=False, protection=DEFAULT_PROTECTION, readonly_check=True)
+    def Set(self, var, value, **kwargs):
+        if isinstance(value, dict):
+            # Do this with an Apply
+            self.Apply(value, var=var, **kwargs)
+
+        else:
+            self._materializeVars([ var ])
+            self._beginWrite()
+
+            try:
+                # Locate the var body (the cell containing the 'value' and attributes and return
+                # the aggregate 'saved'.
+                (saved, store, table, var_location) = self._writablePath(var, **kwargs)
+
+                # print ("Set: saved %s var_location %s" % (saved, var_location))
+                # print ("     value %s" % value)
+
+                updated = self._set_var_value(var_location, var, value, **kwargs)
+                if updated:
+                    self._commit(store)
+
+            finally:
+                self._endWrite()
+
+            if updated and saved:
+                self._saveChange([ var ], **kwargs)
 
-    def __str__(self):
-        return "%s: '%s'" % (self._msg, self._varname)
+    # Persist a change to the vars 'paths': appended by backends that keep a journal, otherwise
+    # a full Save.  The record holds the stored values that Save would write, so vars that aren't
+    # saved (or are protected from 'protection') are left out, and nothing is written if that
+    # leaves none.
+    @default_kwargs(filename=None, propagate=True, protection=DEFAULT_PROTECTION)
+    def _saveChange(self, paths, **kwargs):
+        appended = False
 
-class VarstoreExceptionProtectedVar(VarstoreException):
-    def __init__(self, varname, extra=None):
-        super(VarstoreExceptionProtectedVar, self).__init__("Protected var")
-        self._varname = varname
+        if self._write_behind is None and kwargs['filename'] is None and self._filename:
+            self._persist_lock.acquire()
 
-    def __str__(self):
-        return "%s: '%s'" % (self._msg, self._varname)
+            try:
+                # Read under the persist lock, so the last record written has the latest values
+                tree = self._savedTree(paths, kwargs['protection'])
 
-class VarstoreExceptionAccessError(VarstoreException):
-    def __init__(self, varname, extra=None):
-        super(VarstoreExceptionAccessError, self).__init__("Access error")
-        self._varname = varname
-        self._extra = extra
+                if not tree:
+                    appended = True
 
-    def __str__(self):
-        if self._extra:
-            return "%s: '%s' (%s)" % (self._msg, self._varname, self._extra)
-        else:
-            return "%s: '%s'" % (self._msg, self._varname)
+                elif len(paths) == 1:
+                    # A single var as [ var, value ]
+                    value = tree
+                    for v in self._splitVar(paths[0]):
+                        value = value[v]
 
-class VarstoreExceptionOption(VarstoreException):
-    def __init__(self, varname, value):
-        super(VarstoreExceptionOption, self).__init__("%s not an option" % value)
-        self._varname = varname
+                    appended = self._storage.Append(self._filename, paths[0], value)
 
-    def __str__(self):
-        return "%s: '%s'" % (self._msg, self._varname)
+                else:
+                    appended = self._storage.Append(self._filename, None, tree)
 
+                if appended:
+                    self._savedBytes(appended)
 
-class VarstoreExceptionRange(VarstoreException):
-    def __init__(self, varname, value, range):
-        super(VarstoreExceptionRange, self).__init__("%s not in range [%s .. %s]" % (value, range[0], range[1]))
-        self._varname = varname
+                if appended and kwargs['propagate']:
+                    self.Propagate()
 
-    def __str__(self):
-        return "%s: '%s'" % (self._varname, self._msg)
+            except Exception as e:
+                raise VarstoreExceptionFile(str(e), self._filename)
 
-class Varstore():
-    def __init__(self, schema=None, filename=None, propagate=None):
-        self._lock = Lock()
-        self._store = deepcopy(schema)
-        self._filename = filename
-        self._propagate = propagate
-        self._loaded = False
+            finally:
+                self._persist_lock.release()
 
-    def AddSchema(self, schema):
-        if isinstance(schema, dict):
-            for key in schema:
-                self._store[key] = deepcopy(schema[key])
+        if not appended:
+            self.Save(**kwargs)
 
-    @default_kwargs(propagate=True)
-    def Load(self, filename = None, **kwargs):
-        if not self._loaded:
-            self._lock.acquire()
+    # The saved values of the vars 'paths' as a merge tree.  Vars below a table that isn't
+    # saved, is protected or is produced by a callable are left out, as Save leaves them out.
+    def _savedTree(self, paths, protection=DEFAULT_PROTECTION):
+        tree = {}
 
-            try:
-                if filename is None:
-                    filename = self._filename
+        for path in paths:
+            table = self._store
 
-                try:
-                    f = open(filename, "r")
-                    store = json.load(f)
-                    self._mergeVarstore(self._store, store, protection=NO_PROTECTION)
+            for name in self._splitVar(path):
+                cell = table.get(name) if isinstance(table, dict) else None
 
-                except Exception as e:
-                    raise VarstoreExceptionFile("Unable to read file", filename)
+                if cell is None or 'not_saved' in cell or callable(cell['value']):
+                    break
 
-                finally:
-                    f.close()
+                if 'protection' in cell and cell['protection'] < protection:
+                    break
 
-                if kwargs['propagate']:
-                    self.Propagate()
+                table = cell['value']
 
-            except:
-                raise VarstoreExceptionFile("Unable to open file", filename)
+            else:
+                self._mergeTree(tree, self._nestVar(path, self._valuesOf(table, callables=False, not_saved=False)))
 
-            finally:
-                self._lock.release()
+        return tree
 
-            self._loaded = True
+    # Turn 'a.b.c' and value into { 'a': { 'b': { 'c': value } } }
+    def _nestVar(self, var, value):
+        for v in reversed(self._splitVar(var)):
+            value = { v: value }
 
-    @default_kwargs(filename=None, propagate=True, callables=False, ignore_protected=True, not_saved=False)
-    def Save(self, **kwargs):
-        filename = kwargs['filename'] if 'filename' in kwargs else None
+        return value
 
-        self._lock.acquire()
+    # Set several vars at once from { var: value, ... } (dict values are applied as with Set).
+    # Every value is checked before anything is changed, so a bad value leaves the store as it
+    # was.  The changes are made under one lock acquisition and followed by at most one save
+    # (and propagate).
+    @default_kwargs(propagate=False, protection=DEFAULT_PROTECTION, readonly_check=True)
+    def SetMany(self, changes, **kwargs):
+        updated = False
+        saved = False
+
+        self._materializeVars(changes)
+        self._beginWrite(lock=True)
 
         try:
-            # print("Save: callables %s" % kwargs['callables'])
-            # Create the truncated varstore value
-            varstore_data = self._valuesOf(self._store, **kwargs)
+            store = self._store
 
-            if filename is None:
-                filename = self._filename
+            # Check all values first
+            for var in changes:
+                (var_saved, var_location) = self._findVar(var, store, **kwargs)
+                self._checkValue(var_location, var, changes[var], **kwargs)
+                saved = saved or var_saved
 
-            if filename:
-                # print("varstore Save on '%s'" % filename)
-                if not os.access(filename, os.F_OK):
-                    # Try to create subdirs
-                    dirname = os.path.dirname(filename)
-                    if dirname:
-                        if not os.path.isdir(dirname):
-                            os.makedirs(dirname)
+            # Then make the changes, undoing them if a callable or publish hook fails
+            undo = []
 
-                f = open(filename, "w")
-                f.write(json.dumps(varstore_data, indent=3, sort_keys=True) + "\n")
-                f.close()
+            try:
+                for var in changes:
+                    value = changes[var]
+                    (var_saved, store, table, var_location) = self._writablePath(var, store=store, **kwargs)
 
-            # Propagate store if requested
-            if kwargs['propagate']:
-                self.Propagate()
+                    if isinstance(value, dict):
+                        var_location['value'] = self._writableTable(var_location['value'], value)
+                        self._mergeVarstore(var_location['value'], value, undo=undo, prefix=var, **kwargs)
 
-        except Exception as e:
-            raise VarstoreExceptionFile(str(e), filename)
+                    else:
+                        self._set_var_value(var_location, var, value, undo=undo, **kwargs)
 
-        finally:
-            self._lock.release()
+            except:
+                for (var_location, value, path) in reversed(undo):
+                    var_location['value'] = value
+                    self._noteChange(path, value)
 
-    # Export all (including callables) to caller.
-    @default_kwargs(protection=DEFAULT_PROTECTION, callables=False)
-    def Export(self, **kwargs):
-        self._lock.acquire()
-        varstore_data = self._valuesOf(self._store, **kwargs)
-        self._lock.release()
-        return varstore_data
+                raise
 
-    def Propagate(self):
-        if self._propagate is not None:
-            # Propagate all values
-            self._propagate(self._valuesOf(self._store, protection=NO_PROTECTION))
+            if undo:
+                self._commit(store)
+                updated = True
 
-    @default_kwargs(protection=DEFAULT_PROTECTION)
-    def Get(self, var, **kwargs):
-        (saved, var_location) = self._findVar(var, self._store, **kwargs)
+        finally:
+            self._endWrite(lock=True)
 
-        # Get the (resolved callable) value
-        value =  self._get_var_value(var_location, var, **kwargs)
+        if updated and saved:
+            self._saveChange([ path for (var_location, value, path) in undo ], **kwargs)
 
-        # Resolve any dict items
-        return self._valuesOf(value, **kwargs)
+    # Context manager collecting Set()s for a single SetMany
+    def Transaction(self, **kwargs):
+        return VarstoreTransaction(self, **kwargs)
 
-    @default_kwargs(propagate=False, protection=DEFAULT_PROTECTION, readonly_check=True)
-    def Set(self, var, value, **kwargs):
-        # Locate the var body (the cell containing the 'value' and attributes and return
-        # the aggregate 'saved'.
-        (saved, var_location) = self._findVar(var, self._store, **kwargs)
+    # Check a value (or merge tree) against a var location without changing anything.
+    @default_kwargs(readonly_check=True, fix_range=False)
+    def _checkValue(self, var_location, var, value, **kwargs):
+        if isinstance(value, dict):
+            # As _mergeVarstore will do
+            table = var_location['value']
+            for v in value:
+                if isinstance(table, dict) and v in table:
+                    self._checkValue(table[v], self._joinVar(var, v), value[v], readonly_check=kwargs['readonly_check'], fix_range=True)
 
-        # print ("Set: saved %s var_location %s" % (saved, var_location))
-        # print ("     value %s" % value)
+        else:
+            validator = var_location.get(VALIDATOR)
+            if validator is None:
+                validator = var_location[VALIDATOR] = _compile_cell(var_location)
 
-        if isinstance(value, dict):
-            # Do this with an Apply
-            self.Apply(value, var=var, **kwargs)
+            validator(var, value, kwargs['readonly_check'], kwargs['fix_range'])
 
-        elif self._set_var_value(var_location, var, value, **kwargs):
-            if saved:
-                self.Save(**kwargs)
+    # Merge nested dict 'src' into 'dest'
+    def _mergeTree(self, dest, src):
+        for var in src:
+            if isinstance(src[var], dict) and isinstance(dest.get(var), dict):
+                self._mergeTree(dest[var], src[var])
+            else:
+                dest[var] = src[var]
 
 
     # Change the applicable value cell.  Return True if changes were made.
@@ -220,39 +2305,48 @@ class Varstore():
 
         readonly_check = kwargs['readonly_check'] if 'readonly_check' in kwargs else False
 
-        if 'type' in var_location:
-            value = eval("%s(%s)" % (var_location['type'], value))
-
-        # Prohibit changing read-only vars
-        if readonly_check and 'readonly' in var_location and var_location['readonly']:
-            # print("var %s readonly at %s" % (var, var_location))
-            raise VarstoreExceptionAccessError(var, extra='is read-only')
-
-        elif 'options' in var_location and value not in var_location['options']:
-            raise VarstoreExceptionOption(var, value)
+        # Cells from callable tables (or added after the fact) are compiled on first use
+        validator = var_location.get(VALIDATOR)
+        if validator is None:
+            validator = var_location[VALIDATOR] = _compile_cell(var_location)
 
-        elif 'range' in var_location and (value < var_location['range'][0] or value > var_location['range'][1]):
-            if fix_range:
-                # Don't throw a range error - just clamp the value within range
-                if value < var_location['range'][0]:
-                    value = var_location['range'][0]
-                elif value > var_location['range'][1]:
-                    value = var_location['range'][1]
-            else:
-                raise VarstoreExceptionRange(var, value, var_location['range'])
+        # Errors name the full path when merging (Set passes it as 'var')
+        value = validator(kwargs.get('path', var), value, readonly_check, kwargs['fix_range'])
 
         # If callable, just do the function call if we are allowed ('merge' bypasses this)
         if callable(var_location["value"]):
             if 'write_to_callables' in kwargs and kwargs['write_to_callables']:
-                var_location["value"]("set", var, value)
+                self._call(var_location["value"], "set", var, value)
+
+                # Next get sees the new value
+                cache = var_location.get(CACHE)
+                if cache is not None:
+                    cache.invalidate()
 
         # If value has changed, set var and indicate save needed
         elif var_location["value"] != value:
+            # Replacing a subtree changes the structure below this var
+            if isinstance(var_location["value"], dict) or isinstance(value, dict):
+                self._invalidatePaths()
+                self._restructured = True
+
+            path = kwargs['path'] if 'path' in kwargs else var
+
+            # Remember the previous value for a transaction rollback
+            if 'undo' in kwargs:
+                kwargs['undo'].append((var_location, var_location["value"], path))
+
             var_location["value"] = value
 
+            if 'changeset' in kwargs:
+                kwargs['changeset'][path] = value
+
+            if 'quiet' not in kwargs:
+                self._noteChange(path, value)
+
             # If there is a need to do something after setting.
             if 'publish' in var_location and callable(var_location['publish']):
-                var_location['publish'](value, var)
+                self._call(var_location['publish'], value, var)
                 
             updated = True
 
@@ -262,7 +2356,14 @@ class Varstore():
     def GetAttributes(self, var, **kwargs):
         if var != None:
             (saved, var_location) = self._findVar(var, self._store, **kwargs)
-            attributes = self._get_attributes(var_location)
+
+            if self._export_cache:
+                attributes = self._attributesOf(var_location, self._normalizeVar(var))
+            else:
+                attributes = self._get_attributes(var_location)
+
+        elif self._export_cache:
+            attributes = self._attributesOf({'value': self._store}, None)
 
         else:
             attributes = self._get_attributes({'value': self._store})
@@ -283,63 +2384,156 @@ class Varstore():
 
                     attributes['fields'] = fields
 
-            # Omit callables
-            elif not callable(location[attribute]):
+            # Omit callables and internal attributes
+            elif not callable(location[attribute]) and not attribute.startswith('_'):
                 attributes[attribute] = location[attribute]
 
         return attributes
 
-    @default_kwargs(protectioin=DEFAULT_PROTECTION)
+    @default_kwargs(protection=DEFAULT_PROTECTION)
     def Delete(self, var, **kwargs):
-        (saved, var_location) = self._findVar(var, self._store, **kwargs)
-        if var_location != None:
-            del var_location
-            if saved:
-                self.Save()
+        self._materializeVars([ var ])
+        self._beginWrite()
+
+        try:
+            (saved, store, table, var_location) = self._writablePath(var, **kwargs)
+
+            # Remove the cell from the containing table
+            del table[self._splitVar(var)[-1]]
+            self._commit(store, structure=True)
+            self._reindex([ self._normalizeVar(var) ])
+
+        finally:
+            self._endWrite()
+
+        if saved:
+            self.Save()
 
     # Merge the src store tree with the dest tree.
-    @default_kwargs(protection=DEFAULT_PROTECTION, readonly_check=False)
+    # 'prefix' is the var name of 'dest' (None for the store root).
+    @default_kwargs(protection=DEFAULT_PROTECTION, readonly_check=False, prefix=None)
     def _mergeVarstore(self, dest, src, **kwargs):
         # print("_mergeVarstore %s\n----- into %s\n" % (src, dest))
+        prefix = kwargs.pop('prefix')
+
         for var in src:
             # print("Merging var '%s'" % var)
             if var in dest:
                 src_value = src[var]
+                path = self._joinVar(prefix, var)
+
                 if isinstance(src_value, dict):
-                    self._mergeVarstore(dest[var]['value'], src_value, **kwargs)
+                    self._mergeVarstore(dest[var]['value'], src_value, prefix=path, **kwargs)
 
                 else:
                     # set var value - ignore changed at this point
-                    self._set_var_value(dest[var], var, src_value, write_to_callables=False, fix_range=True, **kwargs)
+                    self._set_var_value(dest[var], var, src_value, write_to_callables=False, fix_range=True, path=path, **kwargs)
 
             else:
                 # Unused var - ignore
                 pass
 
-    # Apply a set of changes to the store
+    # Apply a set of changes to the store.  Only the values that differ from the stored ones
+    # are merged and saved.  Returns { 'path': value, ... } of the values changed.
     @default_kwargs(protection=DEFAULT_PROTECTION)
     def Apply(self, changes, **kwargs):
+        changeset = {}
 
+        # Deferred tables are merged before the write starts
         if 'var' in kwargs:
-            # A var specification allows starting at a particular root of varstore structure
-            var = kwargs['var']
-            del(kwargs['var'])
-            (saved, var_location) = self._findVar(var, self._store, **kwargs)
+            self._materializeVars([ kwargs['var'] ])
 
-            var_location = var_location['value']
-            # print("Apply var '%s'\n------- with %s\n------ at var_location %s" % (var, changes, var_location))
+        elif self._lazy:
+            for v in changes:
+                self._materialize(v)
 
-        else:
-            var_location = self._store
-            saved = True
+        self._beginWrite()
 
-        self._mergeVarstore(var_location, changes, **kwargs)
-        if saved:
-            self.Save()
+        try:
+            if 'var' in kwargs:
+                # A var specification allows starting at a particular root of varstore structure
+                var = kwargs['var']
+                del(kwargs['var'])
+                (saved, var_location) = self._findVar(var, self._store, **kwargs)
+                changes = self._changedValues(var_location['value'], changes, self._normalizeVar(var))
+
+            else:
+                var = None
+                changes = self._changedValues(self._store, changes, None)
+                saved = True
+
+            if changes:
+                if var is not None:
+                    (saved, store, table, var_location) = self._writablePath(var, **kwargs)
+
+                    var_location['value'] = self._writableTable(var_location['value'], changes)
+                    var_location = var_location['value']
+                    # print("Apply var '%s'\n------- with %s\n------ at var_location %s" % (var, changes, var_location))
+
+                else:
+                    store = var_location = self._writableTable(self._store, changes)
+
+                self._mergeVarstore(var_location, changes, prefix=var, changeset=changeset, **kwargs)
+                self._commit(store)
+
+        finally:
+            self._endWrite()
+
+        if saved and changeset:
+            self._saveChange(list(changeset))
+
+        return changeset
+
+    # The part of merge tree 'changes' that differs from the values of 'table' (the table of
+    # var 'prefix').  Unchanged tables are compared whole with their cached export, if kept.
+    def _changedValues(self, table, changes, prefix):
+        if not isinstance(table, dict):
+            return changes
+
+        if self._export_cache:
+            cached = self._cachedExport(('values', prefix, NO_PROTECTION, False, True, True), self._exportStamp(table, prefix))
+
+            if cached is not None and changes == cached:
+                return {}
+
+        changed = {}
+
+        for var in changes:
+            if var in table:
+                value = table[var]['value']
+                new_value = changes[var]
+
+                if isinstance(new_value, dict) and isinstance(value, dict):
+                    new_value = self._changedValues(value, new_value, self._joinVar(prefix, var))
+                    if new_value:
+                        changed[var] = new_value
+
+                # Merges don't write to callables
+                elif not callable(value) and value != new_value:
+                    changed[var] = new_value
+
+        # Compared whole next time
+        if self._export_cache and not changed:
+            self._exportTable(table, prefix, protection=NO_PROTECTION, callables=False)
+
+        return changed
 
     # Add a top-level varstore patch to the varstore space
     def AddVarstore(self, varstore):
-        self._store.update(varstore)
+        self._beginWrite()
+
+        try:
+            store = self._writableTable(self._store)
+            store.update(varstore)
+
+            for key in varstore:
+                self._lazy.pop(key, None)
+            self._compileSchema(varstore)
+            self._commit(store, structure=True)
+            self._reindex(varstore, store)
+
+        finally:
+            self._endWrite()
 
     @default_kwargs(callables=True, protection=DEFAULT_PROTECTION, ignore_protected=True, not_saved=True)
     def _valuesOf(self, value, **kwargs):
@@ -372,16 +2566,38 @@ class Varstore():
     # Drill down and return the var cell containing the requested value
     # Returns (saved, location) where 'saved' is True if the var subtree
     # is written to backing storage.  False otherwise.
-    @default_kwargs(protection=DEFAULT_PROTECTION)
+    # With container=True returns (saved, location, table) where 'table' holds 'location'.
+    @default_kwargs(protection=DEFAULT_PROTECTION, container=False)
     def _findVar(self, var, varstore, **kwargs):
         # print("_findVar: var %s\n----- varstore %s\n----- kwargs %s\n" % (var, varstore, kwargs))
 
+        # Loaded values of the top-level table not merged yet (in snapshot mode they are
+        # published in a new store)
+        if self._lazy:
+            published = varstore is self._store
+            self._materialize(self._splitVar(var)[0])
+
+            if published:
+                varstore = self._store
+
+        # Use the previously resolved location if the structure hasn't changed since.
+        (store, resolved_paths, version) = self._snapshot
+        cached = varstore is store and self._path_cache
+        if cached:
+            resolved = resolved_paths.get(var)
+            if resolved is not None:
+                (saved, var_location, value_protection, table) = resolved
+                if value_protection < kwargs['protection']:
+                    raise VarstoreExceptionProtectedVar(var)
+
+                return (saved, var_location, table) if kwargs['container'] else (saved, var_location)
+
         var_location = varstore
         saved = True
         orig_var = var
 
         # Split the var into it's path and resolve any callables as we descend
-        var_list = splitq(var, delim='.')
+        var_list = self._splitVar(var)
 
         # print("var '%s' split to %s" % (var, var_list))
         for v in var_list[:-1]:
@@ -389,16 +2605,19 @@ class Varstore():
                 if 'not_saved' in var_location[v]:
                     saved = False
 
-                last_var_location = var_location
                 var_location = var_location[v]['value']
 
                 if callable(var_location):
-                    var_location = var_location('get', v)
+                    var_location = self._call(var_location, 'get', v)
+
+                    # Location is produced on demand - don't remember it
+                    cached = False
 
             else:
                 raise VarstoreExceptionUndefinedVar(orig_var)
 
         if isinstance(var_location, dict) and var_list[-1] in var_location:
+            table = var_location
             var_location = var_location[var_list[-1]]
 
         else:
@@ -407,10 +2626,162 @@ class Varstore():
         # print("_findVar returning '%s' as %s" % (var, var_location))
 
         value_protection = DEFAULT_PROTECTION if 'protection' not in var_location else var_location['protection']
+
+        if cached:
+            resolved_paths[orig_var] = (saved, var_location, value_protection, table)
+
         if value_protection < kwargs['protection']:
             raise VarstoreExceptionProtectedVar(orig_var)
 
-        return (saved, var_location)
+        return (saved, var_location, table) if kwargs['container'] else (saved, var_location)
+
+    # True if the value of 'var' is (or holds values) produced by callables.  Such values change
+    # without a change being reported to subscribers.
+    def IsVolatile(self, var):
+        if self._lazy:
+            self._materialize(self._splitVar(var)[0])
+
+        value = self._store
+
+        for v in self._splitVar(var):
+            if not isinstance(value, dict) or v not in value:
+                raise VarstoreExceptionUndefinedVar(var)
+
+            value = value[v]['value']
+
+            if callable(value):
+                return True
+
+        return self._hasCallables(value)
+
+    def _hasCallables(self, table):
+        return isinstance(table, dict) and any(callable(cell['value']) or self._hasCallables(cell['value']) for cell in table.values())
+
+    # Values of the vars matching 'pattern': { 'path': value, ... }.  Each dotted element of
+    # the pattern is a glob and '**' matches any number of elements ('a.**' is 'a' and all
+    # below it).  'attributes' selects vars by attribute: a list of attributes they must have
+    # or a dict of the values they must have.  Protected vars are left out.
+    @default_kwargs(protection=DEFAULT_PROTECTION, attributes=None)
+    def Query(self, pattern='**', **kwargs):
+        attributes = kwargs.pop('attributes')
+        (paths, names) = self._pathIndex()
+        elements = self._splitVar(pattern)
+        store = self._store
+
+        # Only the vars below the literal start of the pattern are looked at
+        prefix = None
+        for element in elements:
+            if '*' in element or '?' in element or '[' in element:
+                break
+
+            prefix = self._joinVar(prefix, element)
+
+        if prefix is not None:
+            candidates = [ prefix ] + paths[bisect_left(paths, prefix + '.'):bisect_left(paths, prefix + '/')]
+        else:
+            candidates = paths
+
+        results = {}
+
+        for path in candidates:
+            if path in names and _match_path(elements, names[path]):
+                try:
+                    (saved, var_location) = self._findVar(path, store, **kwargs)
+
+                except (VarstoreExceptionProtectedVar, VarstoreExceptionUndefinedVar):
+                    continue
+
+                if attributes is None or _match_attributes(var_location, attributes):
+                    results[path] = self._valuesOf(self._get_var_value(var_location, path, **kwargs), **kwargs)
+
+        return results
+
+    # The index is built without holding up writers.  One that changed the vars while it was
+    # being built (and found no index to update) makes it be built again.
+    def _pathIndex(self):
+        index = self._index
+
+        while index is None:
+            self._index_lock.acquire()
+            generation = self._index_generation
+            self._index_lock.release()
+
+            names = {}
+            self._indexTable(self._store, None, (), names)
+
+            self._index_lock.acquire()
+
+            try:
+                if self._index is None and self._index_generation == generation:
+                    self._index = (sorted(names), names)
+
+                index = self._index
+
+            finally:
+                self._index_lock.release()
+
+        return index
+
+    # Add the paths of the vars in 'table' (the table of var 'prefix', split as 'elements')
+    # to 'names'.  Tables produced by callables aren't indexed.
+    def _indexTable(self, table, prefix, elements, names):
+        for var in table:
+            cell = table[var]
+            path = self._joinVar(prefix, var)
+            names[path] = elements + (var,)
+
+            if isinstance(cell, (dict, _Cell)) and isinstance(cell.get('value'), dict):
+                self._indexTable(cell['value'], path, names[path], names)
+
+    # Update the path index after the vars 'paths' were replaced (by the top-level vars of
+    # 'store') or deleted
+    def _reindex(self, paths, store=None):
+        self._index_lock.acquire()
+
+        try:
+            self._index_generation += 1
+
+            if self._index is not None:
+                (old_paths, names) = self._index
+                names = dict(names)
+
+                for var in paths:
+                    path = self._joinVar(None, var) if store is not None else var
+
+                    names.pop(path, None)
+                    for p in old_paths[bisect_left(old_paths, path + '.'):bisect_left(old_paths, path + '/')]:
+                        names.pop(p, None)
+
+                    if store is not None and var in store:
+                        self._indexTable({ var: store[var] }, None, (), names)
+
+                self._index = (sorted(names), names)
+
+        finally:
+            self._index_lock.release()
+
+    # Drop the path index after the structure of the store changed (rebuilt by the next Query)
+    def _dropIndex(self):
+        self._index_lock.acquire()
+        self._index = None
+        self._index_generation += 1
+        self._index_lock.release()
+
+    # Split a dotted var name into its path elements (remembered for reuse)
+    def _splitVar(self, var):
+        var_list = self._split_paths.get(var)
+
+        if var_list is None:
+            var_list = splitq(var, delim='.')
+
+            if self._path_cache:
+                if len(self._split_paths) >= PATH_CACHE_SIZE:
+                    self._split_paths = {}
+                    self._snapshot[1].clear()
+
+                self._split_paths[var] = var_list
+
+        return var_list
 
     @default_kwargs(protection=DEFAULT_PROTECTION)
     def _get_var_value(self, var_location, var, **kwargs):
@@ -418,8 +2789,125 @@ class Varstore():
         value = var_location['value']
 
         if callable(value):
-            # Call user-supplied function to get the value
-            value = value("get", var)
+            if 'ttl' in var_location:
+                # Cells from callable tables (or added after the fact) get their cache on first use
+                cache = var_location.get(CACHE)
+                if cache is None:
+                    cache = var_location[CACHE] = _CallableCache(var_location)
+
+                if self._awaiter is not None or self._stats is not None:
+                    value = functools.partial(self._call, value)
+
+                value = cache.get(value, var, self._refresher)
+
+            else:
+                # Call user-supplied function to get the value
+                value = self._call(value, "get", var)
 
         return value
 
+    # Have 'awaiter' run the awaitables returned by user-supplied functions (coroutine
+    # functions): awaiter(awaitable) returns the result.  None stops it.
+    def SetAwaiter(self, awaiter):
+        self._awaiter = awaiter
+
+    # Call a user-supplied function.  Coroutine functions are run by the awaiter, if any.
+    def _call(self, function, *args):
+        if self._stats is not None:
+            start = time.perf_counter()
+
+        result = function(*args)
+
+        if self._awaiter is not None and inspect.isawaitable(result):
+            result = self._awaiter(result)
+
+        if self._stats is not None:
+            # Callable values by var, other hooks by name
+            if len(args) > 1 and args[0] in ('get', 'set'):
+                name = args[1]
+            else:
+                name = getattr(function, '__qualname__', repr(function))
+
+            self._stats.called(name, time.perf_counter() - start)
+
+        return result
+
+    # 'method' recording its calls and latency (Varstore(instrument=True))
+    def _timed(self, op, method):
+        stats = self._stats
+        by_var = op in INSTRUMENTED_VARS
+
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+
+            try:
+                return method(*args, **kwargs)
+
+            finally:
+                stats.operation(op, time.perf_counter() - start, args[0] if by_var and args else None)
+
+        return timed
+
+    # Measurements since the last Stats(reset=True) (None unless Varstore(instrument=True)):
+    #  'operations'  { op: latency histogram } for each public operation
+    #  'lock_wait'   { 'store' | 'save': wait histogram } for the store and save locks
+    #  'callables'   { var or function name: time histogram } for user-supplied functions
+    #  'save_bytes'  histogram of the bytes the storage wrote for each save (snapshot, shards
+    #                or journal record)
+    #  'hot_vars'    { op: [ (var, count), ... ] } for the most used vars
+    # Histograms report 'count', 'total', 'mean' and 'max' (seconds; bytes for 'save_bytes')
+    # and 'buckets': { n: count } of the values under n (microseconds or bytes) and at
+    # least n / 2.
+    def Stats(self, reset=False):
+        if self._stats is None:
+            return None
+
+        return self._stats.report(reset)
+
+    def _refresher(self):
+        self._refresh_lock.acquire()
+
+        if self._refresh_executor is None:
+            self._refresh_executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix="varstore-refresh")
+
+        self._refresh_lock.release()
+
+        return self._refresh_executor
+
+    # Cache counters ('hits', 'misses', 'stale', 'refreshes') of the cached callable 'var' or,
+    # with no var, { 'path': counters, ... } for every cached callable in the store.
+    @default_kwargs(protection=DEFAULT_PROTECTION)
+    def CacheStats(self, var=None, **kwargs):
+        if var is not None:
+            (saved, var_location) = self._findVar(var, self._store, **kwargs)
+            cache = var_location.get(CACHE)
+
+            return cache.stats() if cache is not None else None
+
+        if self._lazy:
+            self._materializeAll()
+
+        stats = {}
+        self._cacheStats(self._store, None, stats)
+
+        return stats
+
+    def _cacheStats(self, table, prefix, stats):
+        for var in table:
+            cell = table[var]
+            path = self._joinVar(prefix, var)
+
+            if isinstance(cell, dict) or isinstance(cell, _Cell):
+                cache = cell.get(CACHE)
+                if cache is not None:
+                    stats[path] = cache.stats()
+
+                if 'value' in cell and isinstance(cell['value'], dict):
+                    self._cacheStats(cell['value'], path, stats)
+
+# Make sure write-behind changes reach the disk at interpreter exit
+def _flush_at_exit(ref):
+    varstore = ref()
+    if varstore is not None:
+        varstore.Close()
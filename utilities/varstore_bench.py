@@ -0,0 +1,248 @@
+#
+# Varstore benchmarks
+#
+# python varstore_bench.py [--sizes 1000,10000,100000] [--only get_set,save_load,...]
+#
+# Each result is printed as <benchmark> <us per operation> <operations per second> (or the
+# measured quantity for the memory and stress benchmarks).
+#
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+from threading import Thread
+from aoutils.varstore import Varstore, VarstoreStorage, VarstoreBinaryStorage, VarstoreJournalStorage, VarstoreShardedStorage
+
+# Vars per table of the generated schemas
+TABLE_SIZE = 100
+
+# Nesting of the 'deep' vars
+DEEP_LEVELS = 8
+
+# Time an operation for at least this long (seconds)
+MIN_TIME = 0.2
+
+def _report(name, seconds):
+    print("%-56s %12.2f us %14.0f /s" % (name, seconds * 1e6, 1 / seconds if seconds else 0))
+    sys.stdout.flush()
+
+def _value(name, value, units):
+    print("%-56s %12s %s" % (name, value, units))
+    sys.stdout.flush()
+
+# Seconds per call of 'function' (called repeatedly for at least MIN_TIME)
+def _timeit(function, count=None):
+    calls = 0
+    start = time.perf_counter()
+
+    while True:
+        for i in range(count or 100):
+            function()
+
+        calls += count or 100
+        elapsed = time.perf_counter() - start
+
+        if count is not None or elapsed >= MIN_TIME:
+            return elapsed / calls
+
+# 'size' int vars in tables of TABLE_SIZE, plus a chain of DEEP_LEVELS tables ending in 'leaf'
+def _schema(size, callable_value=None):
+    schema = {}
+
+    for t in range(max(1, size // TABLE_SIZE)):
+        schema['t%d' % t] = { 'desc': 'table %d' % t, 'value': { 'v%d' % v: { 'desc': 'var %d' % v, 'type': 'int', 'value': v } for v in range(TABLE_SIZE) } }
+
+    deep = { 'leaf': { 'value': 0 } }
+    for level in reversed(range(DEEP_LEVELS)):
+        deep = { 'd%d' % level: { 'value': deep } }
+
+    schema.update(deep)
+
+    if callable_value is not None:
+        schema['t0']['value'].update({ 'c%d' % c: { 'value': callable_value } for c in range(TABLE_SIZE) })
+
+    return schema
+
+def _values(size, offset=0):
+    return { 't%d' % t: { 'v%d' % v: v + offset for v in range(TABLE_SIZE) } for t in range(max(1, size // TABLE_SIZE)) }
+
+DEEP_VAR = '.'.join([ 'd%d' % level for level in range(DEEP_LEVELS) ] + [ 'leaf' ])
+
+def bench_get_set(sizes):
+    size = sizes[0]
+
+    for (label, options) in [ ('default', {}), ('no path cache', { 'path_cache': False }), ('snapshots', { 'snapshots': True }), ('compact', { 'compact': True }) ]:
+        vs = Varstore(_schema(size), **options)
+        counter = iter(range(1 << 30))
+
+        _report("Get shallow (%s)" % label, _timeit(lambda: vs.Get('t0.v1')))
+        _report("Get deep (%s)" % label, _timeit(lambda: vs.Get(DEEP_VAR)))
+        _report("Set shallow (%s)" % label, _timeit(lambda: vs.Set('t0.v1', next(counter) & 0xffff)))
+        _report("Set deep (%s)" % label, _timeit(lambda: vs.Set(DEEP_VAR, next(counter))))
+
+def bench_apply(sizes):
+    for size in sizes:
+        for (label, options) in [ ('', {}), (', export cache', { 'export_cache': True }), (', snapshots', { 'snapshots': True }) ]:
+            vs = Varstore(_schema(size), **options)
+            changes = [ _values(size, 1), _values(size, 2) ]
+            counter = iter(range(1 << 30))
+
+            _report("Apply %d changed vars%s" % (size, label), _timeit(lambda: vs.Apply(changes[next(counter) & 1]), count=3))
+
+            unchanged = _values(size, 2)
+            vs.Apply(unchanged)
+            _report("Apply %d unchanged vars%s" % (size, label), _timeit(lambda: vs.Apply(unchanged), count=10))
+
+def bench_save_load(sizes):
+    directory = tempfile.mkdtemp(prefix="varstore-bench-")
+
+    try:
+        for size in sizes:
+            schema = _schema(size)
+
+            for (label, storage) in [ ('json', VarstoreStorage), ('binary', VarstoreBinaryStorage), ('journal', VarstoreJournalStorage), ('sharded', VarstoreShardedStorage) ]:
+                filename = os.path.join(directory, "%s-%d" % (label, size))
+                vs = Varstore(schema, filename=filename, storage=storage())
+                vs.Apply(_values(size, 1))
+
+                _report("Save %d vars (%s)" % (size, label), _timeit(lambda: vs.Save(propagate=False), count=3))
+
+                counter = iter(range(1 << 30))
+                _report("Set + save %d vars (%s)" % (size, label), _timeit(lambda: vs.Set('t0.v1', next(counter) & 0xffff), count=20))
+
+                def load():
+                    loaded = Varstore(schema, filename=filename, storage=storage())
+                    loaded.Load(propagate=False)
+                    loaded.Get('t0.v1')
+
+                _report("Load + first Get %d vars (%s)" % (size, label), _timeit(load, count=3))
+
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def bench_export(sizes):
+    def value(op, var, value=None):
+        return 1
+
+    for size in sizes:
+        for (label, options) in [ ('', {}), (', export cache', { 'export_cache': True }) ]:
+            vs = Varstore(_schema(size, value), **options)
+
+            _report("Export %d vars%s" % (size, label), _timeit(lambda: vs.Export(), count=5))
+            _report("Export %d vars with callables%s" % (size, label), _timeit(lambda: vs.Export(callables=True), count=5))
+            _report("GetAttributes %d vars%s" % (size, label), _timeit(lambda: vs.GetAttributes(None), count=5))
+
+def bench_callables(sizes):
+    def slow(op, var, value=None):
+        time.sleep(0.0001)
+        return 1
+
+    schema = { 'plain': { 'value': slow }, 'cached': { 'value': slow, 'ttl': 60 }, 'stale': { 'value': slow, 'ttl': 0, 'stale_while_revalidate': True } }
+    vs = Varstore(schema)
+
+    for var in schema:
+        _report("Get callable (%s)" % var, _timeit(lambda: vs.Get(var)))
+
+    vs.Close()
+
+def bench_write_behind(sizes):
+    directory = tempfile.mkdtemp(prefix="varstore-bench-")
+
+    try:
+        size = sizes[0]
+
+        for (label, options) in [ ('sync', {}), ('journal', { 'storage': VarstoreJournalStorage() }), ('write-behind', { 'write_behind': 0.05 }) ]:
+            vs = Varstore(_schema(size), filename=os.path.join(directory, label), **options)
+            vs.Save()
+            counter = iter(range(1 << 30))
+
+            _report("Set %d vars (%s)" % (size, label), _timeit(lambda: vs.Set('t0.v1', next(counter) & 0xffff), count=50))
+            vs.Close()
+
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# Readers of a pair of vars always written together, while writers change them
+def bench_snapshots(sizes, duration=1.0):
+    schema = _schema(sizes[0])
+    schema['pair'] = { 'value': { 'x': { 'value': 0 }, 'y': { 'value': 0 } } }
+
+    for (label, options) in [ ('default', {}), ('snapshots', { 'snapshots': True }) ]:
+        vs = Varstore(schema, **options)
+        running = [ True ]
+        reads = [ 0, 0 ]
+        latency = [ 0 ]
+
+        def writer():
+            i = 0
+            while running[0]:
+                i += 1
+                vs.SetMany({ 'pair.x': i, 'pair.y': i })
+
+        def reader():
+            while running[0]:
+                start = time.perf_counter()
+                pair = vs.Get('pair')
+                latency[0] = max(latency[0], time.perf_counter() - start)
+                reads[0] += 1
+
+                if pair['x'] != pair['y']:
+                    reads[1] += 1
+
+        threads = [ Thread(target=writer) for i in range(2) ] + [ Thread(target=reader) for i in range(2) ]
+        for thread in threads:
+            thread.start()
+
+        time.sleep(duration)
+        running[0] = False
+
+        for thread in threads:
+            thread.join()
+
+        _value("Reads under writers (%s)" % label, reads[0], "reads")
+        _value("Torn reads (%s)" % label, reads[1], "reads")
+        _value("Max read latency (%s)" % label, "%.1f" % (latency[0] * 1e6), "us")
+
+def bench_memory(sizes):
+    for size in sizes:
+        schema = _schema(size)
+
+        for (label, options) in [ ('dict cells', {}), ('compact', { 'compact': True }) ]:
+            tracemalloc.start()
+            vs = Varstore(schema, **options)
+            (current, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            _value("Store of %d vars (%s)" % (size, label), "%.1f" % (current / 1e6), "MB")
+            del vs
+
+BENCHMARKS = {
+    'get_set': bench_get_set,
+    'apply': bench_apply,
+    'save_load': bench_save_load,
+    'export': bench_export,
+    'callables': bench_callables,
+    'write_behind': bench_write_behind,
+    'snapshots': bench_snapshots,
+    'memory': bench_memory,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Varstore benchmarks")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated store sizes (vars)")
+    parser.add_argument("--only", default=None, help="comma separated benchmarks: %s" % ", ".join(BENCHMARKS))
+    args = parser.parse_args(argv)
+
+    sizes = [ int(size) for size in args.sizes.split(',') ]
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+
+    for name in names:
+        print("== %s" % name)
+        BENCHMARKS[name](sizes)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,433 @@
+#
+# Varstore server and client
+#
+# A VarstoreServer owns a Varstore and serves it over a Unix domain socket to VarstoreClients
+# (typically in forked worker processes).  Requests, replies and pushed changes are newline
+# delimited JSON:
+#
+#   request:  { "id": <n>, "op": "<Varstore method>", "args": [ ... ], "kwargs": { ... } }
+#   reply:    { "id": <n>, "result": <value> }
+#             { "id": <n>, "result": <value>, "volatile": true } (Get of values from callables)
+#             { "id": <n>, "error": { "type": "<exception class>", "state": { ... } } }
+#   push:     { "changed": "<var>" } or { "reset": true }
+#
+# Clients keep the results of Get() until the server pushes a change to the var, a var below
+# it or a table above it, or a reset after a change to the structure of the store.  Volatile
+# results are never kept: callables change their values without any change being pushed.
+#
+
+import os
+import json
+import socket
+import socketserver
+import itertools
+import syslog
+from threading import Lock, Event, Thread
+from copy import deepcopy
+import aoutils.varstore
+from aoutils.varstore import VarstoreException
+from aoutils.utils import splitq
+
+# Varstore methods served to clients, with the keyword arguments clients may pass.  Others
+# (protection, readonly_check, filename, storage, ...) are the server's to choose.
+OPERATIONS = {
+    'Get': (),
+    'Set': ('propagate',),
+    'SetMany': ('propagate',),
+    'Apply': ('var',),
+    'Export': ('callables', 'not_saved'),
+    'GetAttributes': (),
+    'Query': ('attributes',),
+    'Delete': (),
+    'Save': ('propagate',),
+    'Version': (),
+}
+
+# Values that are their own copy
+_IMMUTABLE = (str, int, float, bool, type(None))
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.owner._serve(self)
+
+# A client connection: replies and pushed changes are written by different threads
+class _Connection():
+    def __init__(self, wfile):
+        self._wfile = wfile
+        self._lock = Lock()
+        self.subscription = None
+
+    def send(self, message):
+        data = (json.dumps(message, default=str) + "\n").encode("utf-8")
+
+        self._lock.acquire()
+
+        try:
+            self._wfile.write(data)
+            self._wfile.flush()
+
+        finally:
+            self._lock.release()
+
+    # Subscribe()d to the Varstore: path is None after a change to the structure
+    def changed(self, path, value):
+        try:
+            self.send({ 'changed': path } if path is not None else { 'reset': True })
+
+        except (OSError, ValueError):
+            # Client has gone - the connection is cleaned up by its handler
+            pass
+
+class VarstoreServer():
+    def __init__(self, varstore, path):
+        self.varstore = varstore
+        self._path = path
+        self._server = None
+        self._thread = None
+        self._connections = set()
+        self._connections_lock = Lock()
+
+    def Start(self):
+        # Socket left by a previous run
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+        self._server = _UnixServer(self._path, _Handler)
+        self._server.owner = self
+
+        self._thread = Thread(target=self._server.serve_forever, name="varstore-server", daemon=True)
+        self._thread.start()
+
+    def Close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+            self._thread = None
+
+            if os.path.exists(self._path):
+                os.unlink(self._path)
+
+    # Tell all clients to drop their cached values (structural changes to the Varstore do this)
+    def Invalidate(self):
+        self._connections_lock.acquire()
+        connections = list(self._connections)
+        self._connections_lock.release()
+
+        for connection in connections:
+            if connection.subscription is not None:
+                try:
+                    connection.send({ 'reset': True })
+
+                except (OSError, ValueError):
+                    pass
+
+    def _serve(self, handler):
+        connection = _Connection(handler.wfile)
+
+        self._connections_lock.acquire()
+        self._connections.add(connection)
+        self._connections_lock.release()
+
+        try:
+            for line in handler.rfile:
+                request = json.loads(line.decode("utf-8"))
+
+                if request.get('op') == 'Subscribe':
+                    if connection.subscription is None:
+                        connection.subscription = self.varstore.Subscribe(None, connection.changed)
+
+                    reply = { 'id': request['id'], 'result': None }
+
+                else:
+                    reply = self._call(request)
+
+                connection.send(reply)
+
+        except (OSError, ValueError) as e:
+            syslog.syslog("Varstore server connection failed: %s" % e)
+
+        finally:
+            if connection.subscription is not None:
+                self.varstore.Unsubscribe(connection.subscription)
+
+            self._connections_lock.acquire()
+            self._connections.discard(connection)
+            self._connections_lock.release()
+
+    def _call(self, request):
+        op = request.get('op')
+
+        try:
+            if op not in OPERATIONS:
+                raise VarstoreException("Unknown operation '%s'" % op)
+
+            args = request.get('args', [])
+            kwargs = request.get('kwargs', {})
+
+            for kwarg in kwargs:
+                if kwarg not in OPERATIONS[op]:
+                    raise VarstoreException("%s: '%s' not allowed" % (op, kwarg))
+
+            reply = { 'id': request.get('id'), 'result': getattr(self.varstore, op)(*args, **kwargs) }
+
+            if op == 'Get' and self.varstore.IsVolatile(*args):
+                reply['volatile'] = True
+
+            return reply
+
+        except VarstoreException as e:
+            return { 'id': request.get('id'), 'error': { 'type': type(e).__name__, 'state': e.__dict__ } }
+
+        except Exception as e:
+            return { 'id': request.get('id'), 'error': { 'type': 'VarstoreException', 'state': { '_msg': str(e) } } }
+
+# Varstore methods on the Varstore of a VarstoreServer.  Create it after forking: each process
+# needs its own connection.  With 'cache' the results of Get() are kept until the server
+# reports a change.
+class VarstoreClient():
+    def __init__(self, path, cache=True, timeout=None):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(path)
+        self._rfile = self._socket.makefile("rb")
+        self._timeout = timeout
+
+        self._send_lock = Lock()
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._pending_lock = Lock()
+        self._closed = False
+
+        # Cached Get() results: normalized var -> value.  The generation changes with every
+        # invalidation so a reply overtaken by a change isn't cached.
+        self._cache = {} if cache else None
+        self._cache_lock = Lock()
+        self._generation = 0
+
+        # The cached vars at and below each var: normalized var -> set of cached vars
+        self._cached_below = {}
+
+        self._reader = Thread(target=self._readerRun, name="varstore-client", daemon=True)
+        self._reader.start()
+
+        if cache:
+            self._request('Subscribe')
+
+    def Get(self, var, **kwargs):
+        cache = self._cache
+
+        if cache is None or kwargs:
+            return self._request('Get', var, **kwargs)
+
+        key = _normalize(var)
+
+        self._cache_lock.acquire()
+        found = key in cache
+        value = cache.get(key)
+        generation = self._generation
+        self._cache_lock.release()
+
+        if not found:
+            reply = self._exchange('Get', (var,), {})
+            value = reply['result']
+
+            if 'volatile' not in reply:
+                self._cache_lock.acquire()
+                if generation == self._generation:
+                    cache[key] = value
+                    for prefix in _prefixes(key):
+                        self._cached_below.setdefault(prefix, set()).add(key)
+                self._cache_lock.release()
+
+        return value if value.__class__ in _IMMUTABLE else deepcopy(value)
+
+    def Set(self, var, value, **kwargs):
+        try:
+            return self._request('Set', var, value, **kwargs)
+
+        finally:
+            self._invalidate(_normalize(var))
+
+    def SetMany(self, changes, **kwargs):
+        try:
+            return self._request('SetMany', changes, **kwargs)
+
+        finally:
+            self._invalidate(None)
+
+    def Apply(self, changes, **kwargs):
+        try:
+            return self._request('Apply', changes, **kwargs)
+
+        finally:
+            self._invalidate(_normalize(kwargs['var']) if 'var' in kwargs else None)
+
+    def Delete(self, var, **kwargs):
+        try:
+            return self._request('Delete', var, **kwargs)
+
+        finally:
+            self._invalidate(None)
+
+    def Export(self, **kwargs):
+        return self._request('Export', **kwargs)
+
+    def GetAttributes(self, var, **kwargs):
+        return self._request('GetAttributes', var, **kwargs)
+
+    def Query(self, pattern='**', **kwargs):
+        return self._request('Query', pattern, **kwargs)
+
+    def Save(self, **kwargs):
+        return self._request('Save', **kwargs)
+
+    def Version(self):
+        return self._request('Version')
+
+    def Close(self):
+        if not self._closed:
+            self._closed = True
+
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+
+            except OSError:
+                pass
+
+            self._reader.join()
+            self._socket.close()
+
+    def _request(self, op, *args, **kwargs):
+        return self._exchange(op, args, kwargs)['result']
+
+    # Send a request and return the reply (raising the error of a failed request)
+    def _exchange(self, op, args, kwargs):
+        if self._closed:
+            raise VarstoreException("Connection closed")
+
+        id = next(self._ids)
+        pending = [ Event(), None ]
+
+        self._pending_lock.acquire()
+        self._pending[id] = pending
+        self._pending_lock.release()
+
+        data = (json.dumps({ 'id': id, 'op': op, 'args': args, 'kwargs': kwargs }) + "\n").encode("utf-8")
+
+        try:
+            self._send_lock.acquire()
+            try:
+                self._socket.sendall(data)
+            finally:
+                self._send_lock.release()
+
+            if not pending[0].wait(self._timeout):
+                raise VarstoreException("No reply from server")
+
+        except OSError as e:
+            raise VarstoreException("Connection failed: %s" % e)
+
+        finally:
+            self._pending_lock.acquire()
+            self._pending.pop(id, None)
+            self._pending_lock.release()
+
+        reply = pending[1]
+
+        if 'error' in reply:
+            raise _remote_exception(reply['error'])
+
+        return reply
+
+    def _readerRun(self):
+        try:
+            for line in self._rfile:
+                message = json.loads(line.decode("utf-8"))
+
+                if 'id' in message:
+                    self._pending_lock.acquire()
+                    pending = self._pending.get(message['id'])
+                    self._pending_lock.release()
+
+                    if pending is not None:
+                        pending[1] = message
+                        pending[0].set()
+
+                elif 'changed' in message:
+                    self._invalidate(message['changed'])
+
+                elif 'reset' in message:
+                    self._invalidate(None)
+
+        except (OSError, ValueError) as e:
+            syslog.syslog("Varstore client connection failed: %s" % e)
+
+        # No more changes will be seen: stop caching and fail the waiting requests
+        self._closed = True
+        self._invalidate(None)
+        self._cache = None
+
+        self._pending_lock.acquire()
+        pending = list(self._pending.values())
+        self._pending_lock.release()
+
+        for p in pending:
+            p[1] = { 'error': { 'type': 'VarstoreException', 'state': { '_msg': "Connection closed" } } }
+            p[0].set()
+
+    # Drop the cached values of 'path', the vars below it and the tables above it (all
+    # if None)
+    def _invalidate(self, path):
+        cache = self._cache
+
+        if cache is not None:
+            self._cache_lock.acquire()
+            self._generation += 1
+
+            if path is None:
+                cache.clear()
+                self._cached_below.clear()
+
+            else:
+                keys = set(self._cached_below.get(path, ()))
+                keys.update(prefix for prefix in _prefixes(path) if prefix in cache)
+
+                for key in keys:
+                    del cache[key]
+
+                    for prefix in _prefixes(key):
+                        below = self._cached_below[prefix]
+                        below.discard(key)
+                        if not below:
+                            del self._cached_below[prefix]
+
+            self._cache_lock.release()
+
+# Canonical form of a var name (as reported in change notifications)
+def _normalize(var):
+    return _join(splitq(var, delim='.'))
+
+def _join(names):
+    return '.'.join('"%s"' % v if '.' in v else v for v in names)
+
+# Canonical names of the var 'path' (normalized) and the tables above it: 'a.b.c' gives
+# 'a', 'a.b' and 'a.b.c'
+def _prefixes(path):
+    names = splitq(path, delim='.')
+    return [ _join(names[:i]) for i in range(1, len(names) + 1) ]
+
+# Rebuild an exception raised by the server
+def _remote_exception(error):
+    cls = getattr(aoutils.varstore, error['type'], None)
+    if not (isinstance(cls, type) and issubclass(cls, VarstoreException)):
+        cls = VarstoreException
+
+    e = cls.__new__(cls)
+    Exception.__init__(e, error['state'].get('_msg'))
+    e.__dict__.update(error['state'])
+
+    return e